@@ -5,8 +5,9 @@ from typing import List, Optional, Dict
 from datetime import date, datetime
 from zoneinfo import ZoneInfo
 from app.database import get_db
-from app.models import UpdateHistory, User, UpdateSource
+from app.models import UpdateHistory, UpdateSource
 from app.schemas.update_history import UpdateHistoryWithUsers
+from app.services.user_directory import get_user_directory
 from app.auth.dependencies import get_current_user
 import logging
 
@@ -16,7 +17,7 @@ router = APIRouter(prefix="/api/history", tags=["history"])
 
 
 @router.get("", response_model=List[UpdateHistoryWithUsers])
-def get_update_history(
+async def get_update_history(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
     entity_type: Optional[str] = Query(None, description="Тип сущности (deal, contact, company)"),
@@ -57,7 +58,13 @@ def get_update_history(
         # Применяем пагинацию
         history_items = query.offset(skip).limit(limit).all()
         
-        # Получаем информацию о пользователях
+        # Получаем имена пользователей страницы (таблица users и кэш пользователей Bitrix24)
+        user_ids = set()
+        for item in history_items:
+            user_ids.add(item.old_assigned_by_id)
+            user_ids.add(item.new_assigned_by_id)
+        users = await get_user_directory().resolve_users(db, user_ids)
+        
         result = []
         for item in history_items:
             history_dict = {
@@ -75,17 +82,13 @@ def get_update_history(
                 "new_user_name": None
             }
             
-            # Получаем имя старого пользователя
-            if item.old_assigned_by_id:
-                old_user = db.query(User).filter(User.id == item.old_assigned_by_id).first()
-                if old_user:
-                    history_dict["old_user_name"] = f"{old_user.name or ''} {old_user.last_name or ''}".strip()
+            old_user = users.get(item.old_assigned_by_id)
+            if old_user:
+                history_dict["old_user_name"] = old_user['name']
             
-            # Получаем имя нового пользователя
-            if item.new_assigned_by_id:
-                new_user = db.query(User).filter(User.id == item.new_assigned_by_id).first()
-                if new_user:
-                    history_dict["new_user_name"] = f"{new_user.name or ''} {new_user.last_name or ''}".strip()
+            new_user = users.get(item.new_assigned_by_id)
+            if new_user:
+                history_dict["new_user_name"] = new_user['name']
             
             result.append(UpdateHistoryWithUsers(**history_dict))
         
@@ -9,6 +9,10 @@ from app.schemas.update_rule import (
     UpdateRuleUpdate
 )
 from app.auth.dependencies import get_current_user
+from app.scheduler.tasks import refresh_rule_jobs
+from app.services.duty_registry import get_duty_registry
+from app.services.rule_cursor import get_rule_cursor_registry
+from app.services.rule_engine import RuleEngine
 import json
 
 router = APIRouter(prefix="/api/settings", tags=["rules"])
@@ -120,6 +124,10 @@ def create_rule(
         db.add(rule_user)
     
     db.commit()
+    
+    # Перерегистрируем задачи планировщика с учетом изменившегося расписания правил
+    refresh_rule_jobs()
+    get_duty_registry().invalidate()
     db.refresh(rule)
     
     # Возвращаем правило с user_distributions и user_ids
@@ -260,6 +268,11 @@ def update_rule(
             db.add(rule_user)
     
     db.commit()
+    
+    # Перерегистрируем задачи планировщика с учетом изменившегося расписания правил
+    refresh_rule_jobs()
+    get_duty_registry().invalidate()
+    RuleEngine.forget_rule(rule_id)
     db.refresh(rule)
     
     # Преобразуем condition_config и update_days из JSON строк в словари/списки
@@ -303,8 +316,14 @@ def delete_rule(
     if not rule:
         raise HTTPException(status_code=404, detail="Правило не найдено")
     
+    get_rule_cursor_registry().forget(db, rule_id)
     db.delete(rule)
     db.commit()
+    
+    # Перерегистрируем задачи планировщика с учетом изменившегося расписания правил
+    refresh_rule_jobs()
+    get_duty_registry().invalidate()
+    RuleEngine.forget_rule(rule_id)
     return {"message": "Правило удалено"}
 
 
@@ -354,6 +373,7 @@ def add_user_to_rule(
     )
     db.add(rule_user)
     db.commit()
+    get_duty_registry().invalidate()
     return {"message": "Пользователь добавлен в правило"}
 
 
@@ -375,4 +395,5 @@ def remove_user_from_rule(
     
     db.delete(rule_user)
     db.commit()
+    get_duty_registry().invalidate()
     return {"message": "Пользователь удален из правила"}
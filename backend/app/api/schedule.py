@@ -5,7 +5,7 @@ from typing import List, Optional, Dict
 from datetime import date, datetime
 from zoneinfo import ZoneInfo
 from app.database import get_db
-from app.models import DutySchedule, DutyScheduleUser, User, UpdateHistory, UpdateSource
+from app.models import DutySchedule, DutyScheduleUser, UpdateHistory, UpdateSource
 from app.schemas.duty_schedule import (
     DutySchedule as DutyScheduleSchema,
     DutyScheduleCreate,
@@ -14,6 +14,8 @@ from app.schemas.duty_schedule import (
     DutyScheduleUserInfo
 )
 from app.services.schedule_service import ScheduleService
+from app.services.user_directory import get_user_directory
+from app.services.duty_registry import get_duty_registry
 from app.auth.dependencies import get_current_user
 import logging
 
@@ -34,6 +36,7 @@ def get_schedule(
     schedules = service.get_schedule(start_date, end_date)
     
     # Добавляем информацию о пользователях
+    user_directory = get_user_directory()
     result = []
     for schedule in schedules:
         duty_users = db.query(DutyScheduleUser).filter(
@@ -42,12 +45,12 @@ def get_schedule(
         
         users_info = []
         for duty_user in duty_users:
-            user = db.query(User).filter(User.id == duty_user.user_id).first()
+            user = user_directory.get_user(db, duty_user.user_id)
             if user:
                 users_info.append(DutyScheduleUserInfo(
-                    user_id=user.id,
-                    user_name=f"{user.name or ''} {user.last_name or ''}".strip() or None,
-                    user_email=user.email
+                    user_id=user['id'],
+                    user_name=user['name'] or None,
+                    user_email=user['email']
                 ))
         
         result.append(DutyScheduleWithUsers(
@@ -79,13 +82,14 @@ def get_schedule_by_date(
     ).all()
     
     users_info = []
+    user_directory = get_user_directory()
     for duty_user in duty_users:
-        user = db.query(User).filter(User.id == duty_user.user_id).first()
+        user = user_directory.get_user(db, duty_user.user_id)
         if user:
             users_info.append(DutyScheduleUserInfo(
-                user_id=user.id,
-                user_name=f"{user.name or ''} {user.last_name or ''}".strip() or None,
-                user_email=user.email
+                user_id=user['id'],
+                user_name=user['name'] or None,
+                user_email=user['email']
             ))
     
     return DutyScheduleWithUsers(
@@ -110,6 +114,7 @@ def create_schedule(
         
         service = ScheduleService(db)
         schedule = service.create_or_update_schedule(schedule_data)
+        get_duty_registry().invalidate()
         
         # Получаем информацию о пользователях
         duty_users = db.query(DutyScheduleUser).filter(
@@ -117,13 +122,14 @@ def create_schedule(
         ).all()
         
         users_info = []
+        user_directory = get_user_directory()
         for duty_user in duty_users:
-            user = db.query(User).filter(User.id == duty_user.user_id).first()
+            user = user_directory.get_user(db, duty_user.user_id)
             if user:
                 users_info.append(DutyScheduleUserInfo(
-                    user_id=user.id,
-                    user_name=f"{user.name or ''} {user.last_name or ''}".strip() or None,
-                    user_email=user.email
+                    user_id=user['id'],
+                    user_name=user['name'] or None,
+                    user_email=user['email']
                 ))
         
         return DutyScheduleWithUsers(
@@ -168,6 +174,7 @@ def update_schedule(
             db.add(duty_user)
     
     db.commit()
+    get_duty_registry().invalidate()
     db.refresh(schedule)
     
     # Получаем информацию о пользователях
@@ -176,13 +183,14 @@ def update_schedule(
     ).all()
     
     users_info = []
+    user_directory = get_user_directory()
     for duty_user in duty_users:
-        user = db.query(User).filter(User.id == duty_user.user_id).first()
+        user = user_directory.get_user(db, duty_user.user_id)
         if user:
             users_info.append(DutyScheduleUserInfo(
-                user_id=user.id,
-                user_name=f"{user.name or ''} {user.last_name or ''}".strip() or None,
-                user_email=user.email
+                user_id=user['id'],
+                user_name=user['name'] or None,
+                user_email=user['email']
             ))
     
     return DutyScheduleWithUsers(
@@ -203,6 +211,7 @@ def delete_schedule(
     """Удалить запись из графика"""
     service = ScheduleService(db)
     if service.delete_schedule(schedule_id):
+        get_duty_registry().invalidate()
         return {"message": "Запись удалена"}
     raise HTTPException(status_code=404, detail="Запись графика не найдена")
 
@@ -221,6 +230,7 @@ def generate_schedule(
     try:
         service = ScheduleService(db)
         schedules = service.generate_schedule_for_month(year, month)
+        get_duty_registry().invalidate()
         return {
             "message": f"График сгенерирован на {month}/{year}",
             "count": len(schedules)
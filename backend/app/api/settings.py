@@ -1,9 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 from typing import List
-from datetime import datetime
 from app.database import get_db
-from app.models import DefaultUser, User, FieldMapping, UpdateRule
+from app.models import DefaultUser, User, UpdateRule
 from app.schemas.default_users import (
     DefaultUser as DefaultUserSchema,
     DefaultUserCreate,
@@ -11,10 +10,9 @@ from app.schemas.default_users import (
     DefaultUsersReorder,
     DefaultUserWithUser
 )
-from app.services.bitrix_client import get_bitrix_client
+from app.services.metadata_cache import get_metadata_cache, ENTITY_TYPE_IDS
 from app.config import settings
 from app.auth.dependencies import get_current_user
-import json
 
 router = APIRouter(prefix="/api/settings", tags=["settings"])
 
@@ -119,10 +117,10 @@ async def get_field_values(
         raise HTTPException(status_code=400, detail=f"Недопустимый тип сущности. Допустимые: {', '.join(valid_types)}")
     
     try:
-        bitrix_client = get_bitrix_client()
+        metadata_cache = get_metadata_cache()
         
         # Получаем информацию о поле
-        fields = await bitrix_client.get_entity_fields(entity_type)
+        fields = await metadata_cache.get_entity_fields(db, entity_type)
         field_data = fields.get(field_id)
         
         if not field_data:
@@ -135,32 +133,25 @@ async def get_field_values(
         
         # Для полей типа crm_status получаем статусы
         if field_type == 'crm_status' and status_type:
-            statuses = await bitrix_client.get_status_list(status_type)
+            statuses = await metadata_cache.get_statuses(db, status_type)
             values = [
                 {
-                    'id': status.get('STATUS_ID') or status.get('ID'),
-                    'name': status.get('NAME'),
-                    'semantics': status.get('EXTRA', {}).get('SEMANTICS') if isinstance(status.get('EXTRA'), dict) else status.get('SEMANTICS')
+                    'id': status['id'],
+                    'name': status['name'],
+                    'semantics': status['semantics']
                 }
                 for status in statuses
             ]
         
         # Для полей типа crm_category получаем категории
         elif field_type == 'crm_category':
-            # Маппинг типов сущностей на entityTypeId
-            entity_type_map = {
-                'deal': 2,
-                'contact': 3,
-                'company': 4,
-                'lead': 1
-            }
-            entity_type_id = entity_type_map.get(entity_type)
+            entity_type_id = ENTITY_TYPE_IDS.get(entity_type)
             if entity_type_id:
-                categories = await bitrix_client.get_category_list(entity_type_id)
+                categories = await metadata_cache.get_categories(db, entity_type_id)
                 values = [
                     {
-                        'id': cat.get('id'),
-                        'name': cat.get('name'),
+                        'id': cat['id'],
+                        'name': cat['name'],
                     }
                     for cat in categories
                 ]
@@ -180,38 +171,20 @@ async def get_entity_fields_by_type(
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить поля сущности из Bitrix24 по типу сущности"""
+    """Получить поля сущности по типу сущности (из кэша метаданных Bitrix24)"""
     valid_types = ['deal', 'contact', 'company', 'lead']
     if entity_type not in valid_types:
         raise HTTPException(status_code=400, detail=f"Недопустимый тип сущности. Допустимые: {', '.join(valid_types)}")
     
     try:
-        bitrix_client = get_bitrix_client()
-        fields = await bitrix_client.get_entity_fields(entity_type)
-        
-        # Кэшируем поля в базу данных
-        # Удаляем старые записи для этого типа сущности
-        db.query(FieldMapping).filter(
-            FieldMapping.entity_type == entity_type
-        ).delete()
-        
-        # Добавляем новые записи
-        for field_id, field_data in fields.items():
-            field_mapping = FieldMapping(
-                entity_type=entity_type,
-                field_id=field_id,
-                field_name=field_data.get('listLabel') or field_data.get('title') or field_id,
-                field_type=field_data.get('type', 'string'),
-                cached_at=datetime.now()
-            )
-            db.add(field_mapping)
-        
-        db.commit()
+        metadata_cache = get_metadata_cache()
+        fields = await metadata_cache.get_entity_fields(db, entity_type)
+        cached_at = metadata_cache.get_fields_cached_at(db, entity_type)
         
         return {
             "entity_type": entity_type,
             "fields": fields,
-            "cached_at": datetime.now().isoformat()
+            "cached_at": cached_at.isoformat() if cached_at else None
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения полей: {str(e)}")
@@ -231,36 +204,22 @@ async def get_category_stages(
         raise HTTPException(status_code=400, detail=f"Недопустимый тип сущности. Допустимые: {', '.join(valid_types)}")
     
     try:
-        bitrix_client = get_bitrix_client()
-        # Маппинг типов сущностей на entityTypeId
-        entity_type_map = {
-            'deal': 2,
-            'contact': 3,
-            'company': 4,
-            'lead': 1
-        }
-        entity_type_id = entity_type_map.get(entity_type)
+        entity_type_id = ENTITY_TYPE_IDS.get(entity_type)
         if not entity_type_id:
             raise HTTPException(status_code=400, detail="Недопустимый тип сущности")
         
-        stages = await bitrix_client.get_category_stages(entity_type_id, category_id)
+        # Стадии приводятся к виду {id, name, semantics} при загрузке в кэш (normalize_status)
+        stages = await get_metadata_cache().get_category_stages(db, category_id)
         
-        values = []
-        for stage in stages:
-            # Стадии из crm.category.get имеют структуру с полями id, name, semantics
-            # Стадии из crm.status.list имеют структуру с полями STATUS_ID, NAME, EXTRA
-            stage_id = stage.get('id') or stage.get('STATUS_ID') or stage.get('ID')
-            stage_name = stage.get('name') or stage.get('NAME')
-            stage_semantics = stage.get('semantics') or (
-                stage.get('EXTRA', {}).get('SEMANTICS') if isinstance(stage.get('EXTRA'), dict) else stage.get('SEMANTICS')
-            )
-            
-            if stage_id and stage_name:
-                values.append({
-                    'id': str(stage_id),
-                    'name': stage_name,
-                    'semantics': stage_semantics
-                })
+        values = [
+            {
+                'id': stage['id'],
+                'name': stage['name'],
+                'semantics': stage['semantics']
+            }
+            for stage in stages
+            if stage['name']
+        ]
         
         return {
             "field_id": field_id,
@@ -277,43 +236,39 @@ async def get_entity_fields(
     db: Session = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
-    """Получить поля сущности из Bitrix24 для правила"""
+    """Получить поля сущности для правила (из кэша метаданных Bitrix24)"""
     rule = db.query(UpdateRule).filter(UpdateRule.id == rule_id).first()
     if not rule:
         raise HTTPException(status_code=404, detail="Правило не найдено")
     
     try:
-        bitrix_client = get_bitrix_client()
-        fields = await bitrix_client.get_entity_fields(rule.entity_type)
-        
-        # Кэшируем поля в базу данных
-        # Удаляем старые записи для этого типа сущности
-        db.query(FieldMapping).filter(
-            FieldMapping.entity_type == rule.entity_type
-        ).delete()
-        
-        # Добавляем новые записи
-        for field_id, field_data in fields.items():
-            field_mapping = FieldMapping(
-                entity_type=rule.entity_type,
-                field_id=field_id,
-                field_name=field_data.get('listLabel') or field_data.get('title') or field_id,
-                field_type=field_data.get('type', 'string'),
-                cached_at=datetime.now()
-            )
-            db.add(field_mapping)
-        
-        db.commit()
+        metadata_cache = get_metadata_cache()
+        fields = await metadata_cache.get_entity_fields(db, rule.entity_type)
+        cached_at = metadata_cache.get_fields_cached_at(db, rule.entity_type)
         
         return {
             "entity_type": rule.entity_type,
             "fields": fields,
-            "cached_at": datetime.now().isoformat()
+            "cached_at": cached_at.isoformat() if cached_at else None
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения полей: {str(e)}")
 
 
+@router.post("/metadata/refresh")
+async def refresh_metadata(
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Загрузить из Bitrix24 все кэшированные метаданные (поля, статусы, категории) без ожидания срока жизни кэша"""
+    try:
+        result = await get_metadata_cache().refresh(db)
+        result['stats'] = get_metadata_cache().get_stats()
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка обновления метаданных: {str(e)}")
+
+
 @router.get("/webhook")
 def get_webhook_url(
     request: Request,
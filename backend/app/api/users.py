@@ -5,6 +5,8 @@ from app.database import get_db
 from app.models import User
 from app.schemas.user import User as UserSchema
 from app.services.bitrix_client import get_bitrix_client
+from app.services.user_directory import get_user_directory
+from app.services.duty_registry import get_duty_registry
 from app.auth.dependencies import get_current_user
 import logging
 
@@ -52,6 +54,8 @@ def toggle_user_active(
     user.active = not user.active
     db.commit()
     db.refresh(user)
+    get_user_directory().invalidate()
+    get_duty_registry().invalidate()
     
     logger.info(f"Статус пользователя {user_id} изменен на {'активен' if user.active else 'неактивен'}")
     return user
@@ -105,6 +109,8 @@ async def sync_users(
                 created_count += 1
         
         db.commit()
+        get_user_directory().invalidate()
+        get_duty_registry().invalidate()
         
         logger.info(f"Синхронизировано пользователей: создано {created_count}, обновлено {updated_count}")
         
@@ -6,6 +6,10 @@ from zoneinfo import ZoneInfo
 from typing import Optional
 from app.database import get_db
 from app.services.update_service import UpdateService, get_today_msk
+from app.services.bitrix_client import get_bitrix_client
+from app.services.webhook_queue import get_webhook_queue
+from app.services.duty_registry import get_duty_registry
+from app.services.rule_cursor import get_rule_cursor_registry
 from app.auth.dependencies import get_current_user
 import json
 import logging
@@ -124,6 +128,32 @@ async def get_preview_updates(
         raise HTTPException(status_code=500, detail=f"Ошибка получения предпросмотра: {str(e)}")
 
 
+@router.get("/bitrix-stats")
+def get_bitrix_stats(
+    current_user: dict = Depends(get_current_user)
+):
+    """Счетчики HTTP сессий и соединений Bitrix24 (переиспользование keep-alive соединений)"""
+    try:
+        return get_bitrix_client().get_pool_stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики Bitrix24: {str(e)}")
+
+
+@router.get("/webhook-queue")
+def get_webhook_queue_stats(
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Состояние очереди webhook событий (количество событий по статусам, воркеры, счетчики), снимка графика и курсоров распределения для webhook"""
+    try:
+        stats = get_webhook_queue().get_stats(db)
+        stats['duty_registry'] = get_duty_registry().get_stats()
+        stats['rule_cursors'] = get_rule_cursor_registry().get_stats()
+        return stats
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения состояния очереди webhook: {str(e)}")
+
+
 @router.get("/health")
 def health_check():
     """Проверка здоровья сервиса (публичный endpoint для healthcheck)"""
@@ -10,6 +10,28 @@ class Settings(BaseSettings):
     # Bitrix24
     bitrix24_webhook: Optional[str] = None
     bitrix24_access_token: Optional[str] = None
+    bitrix24_update_chunk_size: int = 50  # Количество команд обновления в одном batch запросе
+    bitrix24_max_concurrent_batches: int = 4  # Максимум одновременных batch запросов на весь процесс
+    bitrix24_id_filter_chunk_size: int = 500  # Количество ID в одном запросе списка с фильтром по ID
+    bitrix24_stream_entities: bool = False  # Постранично загружать выборки правил по ID (меньше памяти, больше HTTP запросов)
+    bitrix24_deals_single_contact: bool = False  # У сделок портала не больше одного контакта (контакты берутся из CONTACT_ID без запроса)
+    bitrix24_connection_pool_size: int = 20  # Максимум HTTP соединений к Bitrix24 в пуле одного event loop
+    bitrix24_keepalive_timeout: int = 30  # Время жизни неактивного keep-alive соединения (секунды)
+    bitrix24_rate_limit: float = 2.0  # Запросов в секунду к порталу (общий лимит процесса)
+    bitrix24_rate_burst: int = 50  # Размер ведра токенов (запросов без ожидания)
+    bitrix24_interactive_reserve: int = 10  # Токены, которые массовое обновление оставляет для webhook
+    bitrix24_operating_soft_limit: float = 360.0  # Время выполнения метода за 10 минут (с), после которого manual и bulk запросы приостанавливаются
+    
+    # Локальная копия сущностей
+    entity_mirror_enabled: bool = False  # Применять правила к локальной копии сущностей, обновляемой по DATE_MODIFY
+    entity_mirror_full_sync_hours: int = 24  # Интервал полной сверки локальной копии с Bitrix24 (часы)
+    
+    # Кэш метаданных Bitrix24 (поля, статусы, категории)
+    metadata_cache_ttl_seconds: int = 900  # Срок жизни кэша в памяти и в базе данных до повторной загрузки из Bitrix24
+    
+    # Справочник имен пользователей
+    user_directory_ttl_seconds: int = 300  # Срок жизни справочника из таблицы users и кэша пользователей Bitrix24 (секунды)
+    user_directory_remote_cache_size: int = 1000  # Максимум пользователей Bitrix24 (не из таблицы users) в кэше
     
     # Приложение
     app_name: str = "Graph Duty B24"
@@ -28,6 +50,14 @@ class Settings(BaseSettings):
     
     # Webhook
     webhook_base_url: Optional[str] = None  # Базовый URL для генерации webhook URL (например, https://yourdomain.com)
+    webhook_async_processing: bool = True  # Сохранять событие в очередь и отвечать сразу (false - обработка в запросе webhook)
+    webhook_workers: int = 4  # Количество воркеров очереди webhook событий
+    webhook_max_attempts: int = 5  # Попыток обработки события до статуса failed
+    webhook_lease_seconds: int = 600  # Срок аренды события в обработке: после него событие другого (остановленного) процесса возвращается в очередь
+    webhook_events_retention_days: int = 7  # Срок хранения обработанных и неудачных событий (дни)
+    webhook_coalesce_seconds: float = 2.0  # Окно объединения событий одной сделки перед обработкой (секунды)
+    webhook_echo_ttl_seconds: float = 60.0  # Срок ожидания события OnCrmDealUpdate на собственную запись в сделку (секунды, 0 - не подавлять)
+    webhook_batch_max_contacts: int = 10  # Контактов сделки, читаемых в первом запросе batch webhook (остальные - отдельным запросом)
     
     # Авторизация
     admin_username: str = "admin"
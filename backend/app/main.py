@@ -4,6 +4,8 @@ from app.config import settings
 from app.database import engine, Base
 from app.api.routes import api_router
 from app.scheduler.tasks import start_scheduler, stop_scheduler
+from app.services.bitrix_client import close_bitrix_client
+from app.services.webhook_queue import get_webhook_queue
 import logging
 
 # Настройка логирования
@@ -48,6 +50,9 @@ async def startup_event():
     
     # Запускаем планировщик задач
     start_scheduler()
+    
+    # Запускаем воркеры очереди webhook событий
+    await get_webhook_queue().start()
 
 
 @app.on_event("shutdown")
@@ -55,6 +60,12 @@ async def shutdown_event():
     """Событие остановки приложения"""
     logger.info("Остановка приложения")
     stop_scheduler()
+    
+    # Останавливаем воркеры очереди webhook событий (до закрытия HTTP сессии Bitrix24)
+    await get_webhook_queue().stop()
+    
+    # Закрываем HTTP сессию Bitrix24 event loop приложения
+    await close_bitrix_client()
 
 
 @app.get("/")
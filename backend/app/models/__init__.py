@@ -6,6 +6,10 @@ from .update_rule import UpdateRule
 from .update_rule_user import UpdateRuleUser
 from .field_mapping import FieldMapping
 from .update_history import UpdateHistory, UpdateSource
+from .entity_mirror import EntityMirror, EntitySyncState
+from .metadata_cache import MetadataItem, MetadataCacheState
+from .webhook_event import WebhookEvent, WebhookEventStatus
+from .webhook_rule_cursor import WebhookRuleCursor
 
 __all__ = [
     "User",
@@ -17,4 +21,11 @@ __all__ = [
     "FieldMapping",
     "UpdateHistory",
     "UpdateSource",
+    "EntityMirror",
+    "EntitySyncState",
+    "MetadataItem",
+    "MetadataCacheState",
+    "WebhookEvent",
+    "WebhookEventStatus",
+    "WebhookRuleCursor",
 ]
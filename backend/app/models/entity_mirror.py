@@ -0,0 +1,36 @@
+from sqlalchemy import Column, Integer, String, DateTime, UniqueConstraint
+from sqlalchemy.sql import func
+from app.database import Base
+
+
+class EntityMirror(Base):
+    """Локальная копия полей сущностей Bitrix24, необходимых для применения правил"""
+    __tablename__ = "entity_mirror"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String, nullable=False, index=True)  # deal, contact, company, lead
+    entity_id = Column(Integer, nullable=False)
+    assigned_by_id = Column(Integer, nullable=True)
+    category_id = Column(String, nullable=True)  # CATEGORY_ID (сделки)
+    stage_id = Column(String, nullable=True)  # STAGE_ID (сделки) или STATUS_ID (лиды)
+    stage_semantic_id = Column(String, nullable=True)  # STAGE_SEMANTIC_ID (сделки) или STATUS_SEMANTIC_ID (лиды)
+    company_id = Column(Integer, nullable=True)
+    contact_id = Column(Integer, nullable=True)  # Основной контакт (CONTACT_ID)
+    date_modify = Column(String, nullable=True)  # DATE_MODIFY в формате Bitrix24
+    synced_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    __table_args__ = (
+        UniqueConstraint("entity_type", "entity_id", name="uq_entity_mirror_entity"),
+    )
+
+
+class EntitySyncState(Base):
+    """Состояние синхронизации локальной копии сущностей одного типа"""
+    __tablename__ = "entity_sync_state"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String, nullable=False, unique=True)
+    high_water_mark = Column(String, nullable=True)  # Максимальный полученный DATE_MODIFY
+    entities_count = Column(Integer, nullable=False, default=0)
+    last_full_sync_at = Column(DateTime(timezone=True), nullable=True)
+    last_delta_sync_at = Column(DateTime(timezone=True), nullable=True)
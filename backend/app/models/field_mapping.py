@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Text
 from sqlalchemy.sql import func
 from app.database import Base
 
@@ -12,5 +12,7 @@ class FieldMapping(Base):
     field_id = Column(String, nullable=False)  # ID поля в Bitrix24 (например, ASSIGNED_BY_ID, UF_CRM_123)
     field_name = Column(String, nullable=False)  # Человекочитаемое название поля
     field_type = Column(String, nullable=False)  # Тип поля (user, string, integer, date, etc.)
+    field_data = Column(Text, nullable=True)  # Полное описание поля из crm.*.fields (JSON)
+    content_hash = Column(String, nullable=True)  # Хэш описания поля (строка перезаписывается только при изменении)
     cached_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,34 @@
+from sqlalchemy import Column, Integer, String, DateTime, UniqueConstraint
+from sqlalchemy.sql import func
+from app.database import Base
+
+
+class MetadataItem(Base):
+    """Кэш справочников Bitrix24: статусы и стадии (crm.status.list), категории (crm.category.list)"""
+    __tablename__ = "metadata_items"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # statuses или categories
+    scope = Column(String, nullable=False, index=True)  # ENTITY_ID статусов (DEAL_STAGE_3) или entityTypeId категорий
+    item_id = Column(String, nullable=False)  # STATUS_ID статуса или ID категории
+    name = Column(String, nullable=True)
+    semantics = Column(String, nullable=True)  # Семантика стадии (P, S, F)
+    sort = Column(Integer, nullable=True)
+    content_hash = Column(String, nullable=False)  # Хэш значения (строка перезаписывается только при изменении)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    __table_args__ = (
+        UniqueConstraint("kind", "scope", "item_id", name="uq_metadata_items_item"),
+    )
+
+
+class MetadataCacheState(Base):
+    """Состояние кэша одного набора метаданных (поля типа сущности, статусы, категории)"""
+    __tablename__ = "metadata_cache_state"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, nullable=False, unique=True)  # Например fields:deal, statuses:DEAL_STAGE, categories:2
+    content_hash = Column(String, nullable=True)  # Хэш всего набора при последней загрузке из Bitrix24
+    items_count = Column(Integer, nullable=False, default=0)
+    checked_at = Column(DateTime(timezone=True), nullable=True)  # Последняя загрузка из Bitrix24
+    changed_at = Column(DateTime(timezone=True), nullable=True)  # Последнее изменение набора
@@ -0,0 +1,35 @@
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, Enum as SQLEnum
+from sqlalchemy.sql import func
+from app.database import Base
+import enum
+
+
+class WebhookEventStatus(str, enum.Enum):
+    """Статус обработки webhook события"""
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class WebhookEvent(Base):
+    """Очередь входящих webhook событий Bitrix24 (сохраняются до ответа Bitrix24, обрабатываются воркерами)"""
+    __tablename__ = "webhook_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    event_type = Column(String, nullable=True)  # ONCRMDEALADD, ONCRMDEALUPDATE и т.д.
+    deal_id = Column(Integer, nullable=False, index=True)
+    payload = Column(Text, nullable=True)  # Данные события (JSON)
+    status = Column(SQLEnum(WebhookEventStatus), nullable=False, default=WebhookEventStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime(timezone=True), nullable=False)  # Не обрабатывать раньше (повтор после ошибки)
+    result = Column(Text, nullable=True)  # Результат обработки (JSON)
+    error = Column(Text, nullable=True)  # Последняя ошибка
+    locked_by = Column(String, nullable=True)  # Процесс, обрабатывающий событие (статус processing)
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # Срок аренды события в обработке
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        Index("ix_webhook_events_status_available_at", "status", "available_at"),
+    )
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from sqlalchemy.sql import func
+from app.database import Base
+
+
+class WebhookRuleCursor(Base):
+    """Курсор поочередного распределения сделок webhook между дежурными пользователями правила"""
+    __tablename__ = "webhook_rule_cursors"
+    
+    rule_id = Column(Integer, ForeignKey("update_rules.id", ondelete="CASCADE"), primary_key=True)
+    last_user_id = Column(Integer, nullable=False)  # Последний назначенный пользователь
+    assignments = Column(Integer, nullable=False, default=0)  # Количество назначений через курсор
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -2,13 +2,16 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, date, time
 from zoneinfo import ZoneInfo
+from typing import Dict, List, Optional, Tuple
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
 from app.models import UpdateRule
 from app.services.update_service import UpdateService
+from app.services.bitrix_client import run_bitrix_task
 from app.config import settings
 import logging
-import asyncio
+import json
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +20,70 @@ MSK_TIMEZONE = ZoneInfo("Europe/Moscow")
 
 scheduler = BackgroundScheduler(timezone=MSK_TIMEZONE)
 
+# Префикс ID задач планировщика для групп правил
+RULE_GROUP_JOB_PREFIX = 'rule_group_'
 
-def daily_update_task():
-    """Задача ежедневного обновления ответственных"""
+# Названия дней недели для CronTrigger (индекс 0 = понедельник, как в update_days с 1 = понедельник)
+CRON_WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Блокировка для последовательной перерегистрации задач (вызывается из разных потоков API)
+_jobs_lock = threading.Lock()
+
+
+def _parse_default_update_time() -> time:
+    """Получить время обновления по умолчанию из настроек"""
+    default_time = settings.default_update_time.split(':')
+    hour = int(default_time[0])
+    minute = int(default_time[1]) if len(default_time) > 1 else 0
+    return time(hour, minute)
+
+
+def get_rule_schedule_group(rule: UpdateRule) -> Tuple[time, Optional[Tuple[int, ...]]]:
+    """
+    Получить группу расписания правила
+    
+    Правила с одинаковым временем обновления и днями недели выполняются одной задачей.
+    
+    Args:
+        rule: Правило обновления
+    
+    Returns:
+        Кортеж (время обновления, отсортированные дни недели или None для ежедневного обновления)
+    """
+    update_time = rule.update_time or _parse_default_update_time()
+    update_time = update_time.replace(second=0, microsecond=0)
+    
+    update_days = None
+    if rule.update_days:
+        try:
+            days = json.loads(rule.update_days) if isinstance(rule.update_days, str) else rule.update_days
+            update_days = tuple(sorted({int(day) for day in days}))
+        except Exception as e:
+            logger.error(f"Ошибка при разборе дней недели для правила {rule.id}: {e}")
+    
+    return update_time, update_days
+
+
+def _rule_group_job_id(update_time: time, update_days: Optional[Tuple[int, ...]]) -> str:
+    """Сформировать ID задачи планировщика для группы правил"""
+    days_part = '-'.join(str(day) for day in update_days) if update_days is not None else 'daily'
+    return f"{RULE_GROUP_JOB_PREFIX}{update_time.strftime('%H%M')}_{days_part}"
+
+
+def daily_update_task(
+    update_time: Optional[time] = None,
+    update_days: Optional[List[int]] = None
+):
+    """
+    Задача обновления ответственных по расписанию
+    
+    Если указана группа расписания (update_time, update_days), выполняются только правила этой группы.
+    Без аргументов выполняются все правила, для которых наступило время обновления.
+    
+    Args:
+        update_time: Время обновления группы правил
+        update_days: Дни недели группы правил (None - ежедневно)
+    """
     db = SessionLocal()
     try:
         logger.info("Запуск ежедневного обновления ответственных")
@@ -33,61 +97,111 @@ def daily_update_task():
             UpdateRule.enabled == True
         ).all()
         
+        # Оставляем только правила группы, для которой сработала задача
+        if update_time is not None:
+            group = (update_time, tuple(update_days) if update_days is not None else None)
+            rules = [rule for rule in rules if get_rule_schedule_group(rule) == group]
+        
+        # Определяем набор правил, которые нужно выполнить сейчас (используем московское время)
+        due_rules = []
+        for rule in rules:
+            if update_service.should_update_rule(rule, now_msk):
+                due_rules.append(rule)
+            else:
+                logger.debug(f"Пропущено обновление для правила {rule.id} ({rule.entity_name})")
+        skipped_count = len(rules) - len(due_rules)
+        
         async def run_updates():
-            updated_count = 0
-            skipped_count = 0
+            if not due_rules:
+                logger.info(f"Нет правил для обновления, пропущено правил: {skipped_count}")
+                return
             
-            for rule in rules:
-                # Проверяем, нужно ли обновлять для этого правила (используем московское время)
-                if update_service.should_update_rule(rule, now_msk):
-                    try:
-                        result = await update_service.update_entities_for_date(today)
-                        updated_count += result.get('updated_entities', 0)
-                        logger.info(
-                            f"Обновлено сущностей для правила {rule.id} ({rule.entity_name}): "
-                            f"{result.get('updated_entities', 0)}"
-                        )
-                    except Exception as e:
-                        logger.error(f"Ошибка при обновлении правила {rule.id} ({rule.entity_name}): {e}")
-                else:
-                    skipped_count += 1
-                    logger.debug(f"Пропущено обновление для правила {rule.id} ({rule.entity_name})")
+            # Выполняем все подходящие правила за один проход
+            result = await update_service.update_entities_for_date(today, rules=due_rules)
             
             logger.info(
-                f"Ежедневное обновление завершено. Обновлено сущностей: {updated_count}, "
-                f"пропущено правил: {skipped_count}"
+                f"Ежедневное обновление завершено. Обновлено сущностей: {result.get('updated_entities', 0)}, "
+                f"выполнено правил: {len(due_rules)}, пропущено правил: {skipped_count}"
             )
         
-        # Запускаем async функцию
-        asyncio.run(run_updates())
+        # Запускаем async функцию в новом event loop (HTTP сессия Bitrix24 закрывается по завершении)
+        run_bitrix_task(run_updates())
     except Exception as e:
         logger.error(f"Критическая ошибка при ежедневном обновлении: {e}")
     finally:
         db.close()
 
 
+def refresh_rule_jobs():
+    """
+    Перерегистрировать задачи планировщика по группам правил
+    
+    Для каждой группы включенных правил с одинаковым временем и днями недели регистрируется
+    одна задача CronTrigger. Задачи групп, для которых больше нет правил, удаляются.
+    Вызывается при запуске планировщика и после изменения правил.
+    """
+    if not settings.scheduler_enabled:
+        return
+    
+    with _jobs_lock:
+        db = SessionLocal()
+        try:
+            rules = db.query(UpdateRule).filter(
+                UpdateRule.enabled == True
+            ).all()
+            
+            groups: Dict[str, Tuple[time, Optional[Tuple[int, ...]]]] = {}
+            for rule in rules:
+                update_time, update_days = get_rule_schedule_group(rule)
+                if update_days is not None and not update_days:
+                    # Пустой список дней - правило никогда не выполняется по расписанию
+                    continue
+                groups[_rule_group_job_id(update_time, update_days)] = (update_time, update_days)
+            
+            for job_id, (update_time, update_days) in groups.items():
+                day_of_week = None
+                if update_days is not None:
+                    day_of_week = ','.join(CRON_WEEKDAYS[day - 1] for day in update_days if 1 <= day <= 7)
+                
+                scheduler.add_job(
+                    daily_update_task,
+                    trigger=CronTrigger(
+                        hour=update_time.hour,
+                        minute=update_time.minute,
+                        day_of_week=day_of_week
+                    ),
+                    kwargs={
+                        'update_time': update_time,
+                        'update_days': list(update_days) if update_days is not None else None
+                    },
+                    id=job_id,
+                    name=f"Обновление ответственных в {update_time.strftime('%H:%M')} MSK",
+                    replace_existing=True
+                )
+            
+            # Удаляем задачи групп, для которых не осталось правил
+            for job in scheduler.get_jobs():
+                if job.id.startswith(RULE_GROUP_JOB_PREFIX) and job.id not in groups:
+                    scheduler.remove_job(job.id)
+            
+            logger.info(f"Зарегистрировано задач обновления по расписанию: {len(groups)} ({', '.join(sorted(groups)) or 'нет'})")
+        except Exception as e:
+            logger.error(f"Ошибка при регистрации задач планировщика для правил: {e}")
+        finally:
+            db.close()
+
+
 def start_scheduler():
     """Запустить планировщик задач"""
     if not settings.scheduler_enabled:
         logger.info("Планировщик отключен в настройках")
         return
     
-    # Парсим время обновления по умолчанию
-    default_time = settings.default_update_time.split(':')
-    hour = int(default_time[0])
-    minute = int(default_time[1]) if len(default_time) > 1 else 0
-    
-    # Добавляем задачу на ежедневное выполнение
-    scheduler.add_job(
-        daily_update_task,
-        trigger=CronTrigger(hour=hour, minute=minute),
-        id='daily_update',
-        name='Ежедневное обновление ответственных',
-        replace_existing=True
-    )
+    # Регистрируем по одной задаче на каждую группу правил (время + дни недели)
+    refresh_rule_jobs()
     
     scheduler.start()
-    logger.info(f"Планировщик запущен. Ежедневное обновление в {settings.default_update_time} MSK (Московское время)")
+    logger.info("Планировщик запущен. Обновление выполняется по расписанию правил (MSK, Московское время)")
 
 
 def stop_scheduler():
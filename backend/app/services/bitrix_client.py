@@ -1,11 +1,133 @@
 from fast_bitrix24 import Bitrix
-from typing import List, Dict, Any, Optional
+from fast_bitrix24.utils import http_build_query
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple, AsyncGenerator
 from app.config import settings
+from app.services.bitrix_pool import BitrixSessionPool
+from app.services.bitrix_rate_limiter import BitrixRateLimiter, PRIORITY_BULK, set_bitrix_priority
+from app.services.bitrix_singleflight import SingleFlight, make_request_key
+from app.services.webhook_echo import get_webhook_echo_registry
 import logging
 import asyncio
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Максимальное количество команд в одном запросе batch Bitrix24
+BATCH_MAX_COMMANDS = 50
+
+# Размер страницы методов crm.*.list
+LIST_PAGE_SIZE = 50
+
+# Интервал повторной попытки занять место batch запроса (секунды)
+BATCH_SLOT_POLL_INTERVAL = 0.01
+
+
+def decode_deal_contact_items(result: Any) -> List[int]:
+    """
+    Разобрать ответ crm.deal.contact.items.get в список ID контактов
+    
+    Поддерживаемые форматы ответа:
+    1. Список контактов: [{'CONTACT_ID': 6, ...}, ...]
+    2. Один контакт как словарь: {'CONTACT_ID': 6, ...}
+    3. Ответ с ключом result: {'result': [...]} или {'result': {'CONTACT_ID': 6}}
+    4. Batch формат: {'result': {'result': {'order0000000000': [...]}}} или {'result': {'result': [[...]]}}
+    
+    Args:
+        result: Ответ Bitrix24 (или результат одной команды batch)
+    
+    Returns:
+        Список ID контактов (пустой, если формат не распознан)
+    """
+    contacts = []
+    
+    if isinstance(result, list):
+        contacts = result
+    elif isinstance(result, dict):
+        if 'CONTACT_ID' in result:
+            contacts = [result]
+        elif 'result' in result:
+            result_data = result['result']
+            if isinstance(result_data, dict) and 'result' in result_data:
+                # Batch формат: берем результат первой команды
+                # (словарь по ключам команд или список, если команды переданы списком)
+                batch_result = result_data['result']
+                if isinstance(batch_result, dict) and batch_result:
+                    return decode_deal_contact_items(list(batch_result.values())[0])
+                if isinstance(batch_result, list) and batch_result:
+                    return decode_deal_contact_items(batch_result[0])
+            else:
+                return decode_deal_contact_items(result_data)
+    
+    contact_ids = []
+    for contact in contacts:
+        if not isinstance(contact, dict):
+            continue
+        contact_id = contact.get('CONTACT_ID')
+        if contact_id:
+            try:
+                contact_ids.append(int(contact_id))
+            except (ValueError, TypeError):
+                logger.warning(f"Некорректный CONTACT_ID в ответе crm.deal.contact.items.get: {contact_id}")
+    return contact_ids
+
+
+def is_not_found_error(error: Any) -> bool:
+    """
+    Проверить, что ошибка команды Bitrix24 означает отсутствие сущности (удалена на портале)
+    
+    crm.*.update для удаленной сущности возвращает error_description "Not found"
+    (в некоторых методах - код NOT_FOUND).
+    
+    Args:
+        error: Ошибка команды batch (словарь error/error_description или строка)
+    
+    Returns:
+        True, если сущность не найдена
+    """
+    text = str(error).lower().replace('_', ' ')
+    return 'not found' in text
+
+
+class ChunkedFetchResult(dict):
+    """
+    Результат выборки сущностей по ID частями
+    
+    Словарь {id: данные} с объединенными результатами всех частей и списком ошибок
+    по частям в атрибуте errors: [{'ids': [...], 'error': '...'}].
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors: List[Dict[str, Any]] = []
+    
+    @property
+    def failed_ids(self) -> List[int]:
+        """ID из частей, которые не удалось получить"""
+        return [entity_id for error in self.errors for entity_id in error['ids']]
+
+
+class ProcessBatchSemaphore:
+    """
+    Ограничение одновременных batch запросов на весь процесс
+    
+    Счетчик общий для всех event loop (в том числе задач планировщика в отдельных потоках),
+    поэтому используется threading.BoundedSemaphore. Место занимается без блокировки
+    event loop: при отсутствии свободного места попытка повторяется через
+    BATCH_SLOT_POLL_INTERVAL. Отмена ожидания не оставляет занятых мест.
+    """
+    
+    def __init__(self, value: int):
+        self._semaphore = threading.BoundedSemaphore(max(1, value))
+    
+    async def __aenter__(self):
+        while not self._semaphore.acquire(blocking=False):
+            await asyncio.sleep(BATCH_SLOT_POLL_INTERVAL)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
 
 class BitrixClient:
     """Клиент для работы с Bitrix24 REST API через библиотеку fast_bitrix24"""
@@ -16,9 +138,81 @@ class BitrixClient:
         if not webhook:
             raise ValueError("Необходимо указать BITRIX24_WEBHOOK или BITRIX24_ACCESS_TOKEN в переменных окружения")
         
-        self.client = Bitrix(webhook)
+        # Общий для процесса ограничитель запросов к порталу с классами приоритета
+        self.rate_limiter = BitrixRateLimiter()
+        # HTTP сессии и клиенты fast_bitrix24 (по одному на event loop)
+        self._pool = BitrixSessionPool(webhook, self.rate_limiter)
+        # Объединение одинаковых одновременных запросов чтения
+        self._singleflight = SingleFlight()
+        # Ограничение параллельных batch запросов (общее для всех event loop процесса)
+        self._batch_semaphore = ProcessBatchSemaphore(settings.bitrix24_max_concurrent_batches)
         logger.info("Bitrix24 клиент инициализирован")
     
+    @property
+    def client(self) -> Bitrix:
+        """Клиент fast_bitrix24 с keep-alive сессией текущего event loop"""
+        return self._pool.get_client()
+    
+    async def close_loop_session(self):
+        """Закрыть HTTP сессию Bitrix24 текущего event loop"""
+        await self._pool.close_current_loop()
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Получить счетчики HTTP сессий, соединений и объединения запросов Bitrix24"""
+        stats = self._pool.get_stats()
+        stats['singleflight'] = self._singleflight.get_stats()
+        return stats
+    
+    async def _get_all_shared(self, method: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Выполнить get_all, объединив его с таким же одновременно выполняющимся запросом
+        
+        Args:
+            method: Метод REST API
+            params: Параметры запроса
+        
+        Returns:
+            Результат get_all
+        """
+        return await self._singleflight.do(
+            make_request_key(method, params),
+            lambda: self.client.get_all(method, params=params)
+        )
+    
+    def _get_batch_semaphore(self) -> ProcessBatchSemaphore:
+        """Получить общее для процесса ограничение параллельных batch запросов"""
+        return self._batch_semaphore
+    
+    async def call_batch_commands(
+        self,
+        commands: Dict[str, str],
+        halt: bool = False
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Выполнить один запрос batch (до 50 команд)
+        
+        Args:
+            commands: Словарь {ключ команды: 'метод?параметры'}
+            halt: Остановить выполнение на первой ошибке (команды после нее не выполняются
+                и отсутствуют и в результатах, и в ошибках)
+        
+        Returns:
+            Кортеж (результаты {ключ: результат}, ошибки {ключ: описание ошибки})
+        """
+        response = await self.client.call('batch', {'halt': 1 if halt else 0, 'cmd': commands}, raw=True)
+        batch_result = response.get('result') if isinstance(response, dict) else None
+        if not isinstance(batch_result, dict):
+            raise ValueError(f"Неожиданный ответ batch: {response}")
+        
+        # Пустые результаты Bitrix24 возвращает как пустой список
+        results = batch_result.get('result') or {}
+        errors = batch_result.get('result_error') or {}
+        if not isinstance(results, dict):
+            results = {}
+        if not isinstance(errors, dict):
+            errors = {}
+        return results, errors
+    
     async def get_all_users(self) -> List[Dict[str, Any]]:
         """
         Получить всех пользователей из Bitrix24
@@ -27,7 +221,7 @@ class BitrixClient:
             Список пользователей с полями ID, NAME, LAST_NAME, EMAIL, ACTIVE
         """
         try:
-            users = await self.client.get_all(
+            users = await self._get_all_shared(
                 'user.get',
                 params={
                     'select': ['ID', 'NAME', 'LAST_NAME', 'EMAIL', 'ACTIVE']
@@ -39,6 +233,33 @@ class BitrixClient:
             logger.error(f"Ошибка при получении пользователей: {e}")
             raise
     
+    async def get_users_by_ids(self, user_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        Получить пользователей Bitrix24 по списку ID одним запросом user.get
+        
+        Args:
+            user_ids: Список ID пользователей
+        
+        Returns:
+            Список найденных пользователей с полями ID, NAME, LAST_NAME, EMAIL, ACTIVE
+        """
+        if not user_ids:
+            return []
+        
+        try:
+            users = await self._get_all_shared(
+                'user.get',
+                params={
+                    'FILTER': {'ID': sorted(set(user_ids))},
+                    'select': ['ID', 'NAME', 'LAST_NAME', 'EMAIL', 'ACTIVE']
+                }
+            )
+            logger.info(f"Получено {len(users)} из {len(user_ids)} пользователей из Bitrix24 по ID")
+            return users
+        except Exception as e:
+            logger.error(f"Ошибка при получении пользователей по ID: {e}")
+            raise
+    
     async def get_entity_fields(self, entity_type: str) -> Dict[str, Any]:
         """
         Получить поля сущности из Bitrix24
@@ -51,7 +272,7 @@ class BitrixClient:
         """
         try:
             method = f'crm.{entity_type}.fields'
-            fields = await self.client.get_all(method)
+            fields = await self._get_all_shared(method)
             logger.info(f"Получено {len(fields)} полей для сущности {entity_type}")
             return fields
         except Exception as e:
@@ -85,7 +306,7 @@ class BitrixClient:
             
             method = f'crm.{entity_type}.list'
             # Используем get_all для автоматической обработки пагинации и получения всех данных
-            entities = await self.client.get_all(method, params=params)
+            entities = await self._get_all_shared(method, params=params)
             
             logger.info(f"Получено {len(entities)} сущностей типа {entity_type}")
             return entities
@@ -93,6 +314,68 @@ class BitrixClient:
             logger.error(f"Ошибка при получении списка сущностей {entity_type}: {e}")
             raise
     
+    async def iter_entities(
+        self,
+        entity_type: str,
+        select: Optional[List[str]] = None,
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> AsyncGenerator[List[Dict[str, Any]], None]:
+        """
+        Постранично получить сущности из Bitrix24 (асинхронный генератор страниц)
+        
+        Страницы запрашиваются по ключу ID: order {ID: ASC}, фильтр '>ID' по последнему
+        полученному ID и start=-1, поэтому Bitrix24 не считает общее количество и не пропускает
+        строки по смещению. В памяти одновременно находится только одна страница.
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company, lead и т.д.)
+            select: Список полей для выборки (по умолчанию ['ID', 'ASSIGNED_BY_ID'])
+            filter_dict: Словарь фильтров для выборки
+        
+        Yields:
+            Страница сущностей (не более 50)
+        """
+        if select is None:
+            select = ['ID', 'ASSIGNED_BY_ID']
+        if 'ID' not in select:
+            select = ['ID'] + list(select)
+        
+        method = f'crm.{entity_type}.list'
+        page_filter = dict(filter_dict or {})
+        last_id = int(page_filter.pop('>ID', 0) or 0)
+        total = 0
+        
+        while True:
+            params = {
+                'select': select,
+                'filter': {**page_filter, '>ID': last_id},
+                'order': {'ID': 'ASC'},
+                'start': -1
+            }
+            try:
+                response = await self.client.call(method, params, raw=True)
+            except Exception as e:
+                logger.error(f"Ошибка при постраничном получении сущностей {entity_type} (после ID {last_id}): {e}")
+                raise
+            
+            page = response.get('result') if isinstance(response, dict) else None
+            if not page:
+                break
+            
+            total += len(page)
+            last_id = int(page[-1]['ID'])
+            yield page
+            
+            if len(page) < LIST_PAGE_SIZE:
+                break
+        
+        logger.info(f"Постранично получено {total} сущностей типа {entity_type}")
+    
+    def _expect_update_echo(self, entity_type: str, entity_ids: List[Any]):
+        """Зарегистрировать события OnCrmDealUpdate, которые Bitrix24 отправит на запись в сделки"""
+        if entity_type == 'deal' and entity_ids:
+            get_webhook_echo_registry().expect(entity_ids)
+    
     async def update_entities_batch(
         self,
         entity_type: str,
@@ -112,11 +395,90 @@ class BitrixClient:
             method = f'crm.{entity_type}.update'
             results = await self.client.call(method, updates)
             logger.info(f"Обновлено {len(updates)} сущностей типа {entity_type}")
+            self._expect_update_echo(entity_type, [update.get('ID') for update in updates])
             return results
         except Exception as e:
             logger.error(f"Ошибка при обновлении сущностей {entity_type}: {e}")
             raise
     
+    async def update_entities_chunked(
+        self,
+        entity_type: str,
+        updates: List[Dict[str, Any]],
+        on_chunk: Optional[Callable[[int], Awaitable[None]]] = None,
+        chunk_size: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Массовое обновление сущностей частями по chunk_size команд (одна часть - один batch запрос)
+        
+        Части выполняются параллельно, общее количество одновременных batch запросов обновления
+        в процессе ограничено настройкой bitrix24_max_concurrent_batches. Batch выполняется без
+        остановки на ошибке (halt=0), результат разбирается по командам: ошибка одной команды
+        не отменяет успешно записанные обновления остальных. Ошибка запроса целиком относит
+        к ошибкам все обновления части и не прерывает остальные части.
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company, lead и т.д.)
+            updates: Список словарей с обновлениями в формате [{'ID': id, 'fields': {...}}, ...]
+            on_chunk: Async callback, вызываемый после каждой части (количество успешно обновленных сущностей части)
+            chunk_size: Размер части (по умолчанию bitrix24_update_chunk_size, не больше 50 команд)
+        
+        Returns:
+            Словарь {'updated': [успешно примененные обновления], 'errors': [описания ошибок],
+            'failed': [{'ID': id, 'error': описание ошибки}]} (failed - обновления, которые не записаны)
+        """
+        chunk_size = min(chunk_size or settings.bitrix24_update_chunk_size, BATCH_MAX_COMMANDS)
+        method = f'crm.{entity_type}.update'
+        semaphore = self._get_batch_semaphore()
+        chunks = [updates[i:i + chunk_size] for i in range(0, len(updates), chunk_size)]
+        
+        async def run_chunk(chunk: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+            commands = {
+                f'u{index}': f"{method}?{http_build_query({'ID': update['ID'], 'fields': update['fields']}).rstrip('&')}"
+                for index, update in enumerate(chunk)
+            }
+            async with semaphore:
+                try:
+                    results, errors = await self.call_batch_commands(commands)
+                except Exception as e:
+                    logger.error(f"Ошибка при обновлении части из {len(chunk)} сущностей {entity_type}: {e}")
+                    return [], [{'ID': update['ID'], 'error': str(e)} for update in chunk]
+            
+            chunk_updated = []
+            chunk_failed = []
+            for index, update in enumerate(chunk):
+                key = f'u{index}'
+                if key in errors:
+                    chunk_failed.append({'ID': update['ID'], 'error': str(errors[key])})
+                elif key in results:
+                    chunk_updated.append(update)
+                else:
+                    chunk_failed.append({'ID': update['ID'], 'error': 'Команда не выполнена'})
+            if chunk_failed:
+                logger.error(
+                    f"Не удалось обновить {len(chunk_failed)} из {len(chunk)} сущностей {entity_type} в части: "
+                    f"{entity_type} {chunk_failed[0]['ID']}: {chunk_failed[0]['error']}"
+                )
+            if on_chunk and chunk_updated:
+                await on_chunk(len(chunk_updated))
+            return chunk_updated, chunk_failed
+        
+        chunk_results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        
+        updated = []
+        failed = []
+        for chunk_updated, chunk_failed in chunk_results:
+            updated.extend(chunk_updated)
+            failed.extend(chunk_failed)
+        errors = [f"{entity_type} {failure['ID']}: {failure['error']}" for failure in failed]
+        
+        logger.info(
+            f"Обновлено {len(updated)} из {len(updates)} сущностей типа {entity_type} "
+            f"({len(chunks)} batch запросов, ошибок: {len(errors)})"
+        )
+        self._expect_update_echo(entity_type, [update.get('ID') for update in updated])
+        return {'updated': updated, 'errors': errors, 'failed': failed}
+    
     async def get_entity(
         self,
         entity_type: str,
@@ -179,6 +541,7 @@ class BitrixClient:
             method = f'crm.{entity_type}.update'
             result = await self.client.call(method, [{'ID': entity_id, 'fields': fields}])
             logger.info(f"Обновлена сущность {entity_type} с ID {entity_id}")
+            self._expect_update_echo(entity_type, [entity_id])
             return result
         except Exception as e:
             logger.error(f"Ошибка при обновлении сущности {entity_type} с ID {entity_id}: {e}")
@@ -195,7 +558,7 @@ class BitrixClient:
             Список статусов
         """
         try:
-            statuses = await self.client.get_all(
+            statuses = await self._get_all_shared(
                 'crm.status.list',
                 params={'filter': {'ENTITY_ID': entity_id}}
             )
@@ -217,7 +580,7 @@ class BitrixClient:
         """
         try:
             # Используем get_all для автоматической обработки batch запросов
-            categories = await self.client.get_all('crm.category.list', params={'entityTypeId': entity_type_id})
+            categories = await self._get_all_shared('crm.category.list', params={'entityTypeId': entity_type_id})
             logger.info(f"Получено {len(categories)} категорий для entityTypeId {entity_type_id}")
             return categories
         except Exception as e:
@@ -243,7 +606,7 @@ class BitrixClient:
                 # Для остальных категорий используем формат DEAL_STAGE_{category_id}
                 entity_id = f'DEAL_STAGE_{category_id}'
             
-            stages = await self.client.get_all(
+            stages = await self._get_all_shared(
                 'crm.status.list',
                 params={'filter': {'ENTITY_ID': entity_id}}
             )
@@ -265,43 +628,7 @@ class BitrixClient:
         """
         try:
             result = await self.client.call('crm.deal.contact.items.get', {'id': deal_id})
-            contact_ids = []
-            
-            # Библиотека fast_bitrix24 уже обрабатывает batch формат и может вернуть:
-            # 1. Список контактов: [{'CONTACT_ID': 6, ...}, ...]
-            # 2. Один контакт как словарь: {'CONTACT_ID': 6, ...}
-            # 3. Batch формат: {'result': {'result': {'order0000000000': [...]}}}
-            
-            contacts = []
-            
-            if isinstance(result, list):
-                # Если это список контактов
-                contacts = result
-            elif isinstance(result, dict):
-                # Проверяем, это batch формат или уже обработанный контакт
-                if 'CONTACT_ID' in result:
-                    # Это уже один контакт как словарь
-                    contacts = [result]
-                elif 'result' in result:
-                    result_data = result['result']
-                    # Проверяем batch формат
-                    if isinstance(result_data, dict) and 'result' in result_data:
-                        batch_result = result_data['result']
-                        # Извлекаем данные из первого order
-                        if batch_result:
-                            first_order = list(batch_result.values())[0]
-                            contacts = first_order if isinstance(first_order, list) else [first_order]
-                    elif isinstance(result_data, list):
-                        contacts = result_data
-                    elif isinstance(result_data, dict) and 'CONTACT_ID' in result_data:
-                        # Один контакт в result
-                        contacts = [result_data]
-            
-            if contacts:
-                for contact in contacts:
-                    contact_id = contact.get('CONTACT_ID')
-                    if contact_id:
-                        contact_ids.append(int(contact_id))
+            contact_ids = decode_deal_contact_items(result)
             
             logger.debug(f"Получено {len(contact_ids)} контактов для сделки {deal_id}")
             return contact_ids
@@ -332,99 +659,147 @@ class BitrixClient:
     
     async def get_deals_related_contacts_batch(self, deal_ids: List[int]) -> Dict[int, List[int]]:
         """
-        Получить связанные контакты для множества сделок через параллельные запросы
+        Получить связанные контакты для множества сделок через запросы batch
+        
+        Команды crm.deal.contact.items.get упаковываются по 50 в один запрос batch,
+        несколько запросов batch выполняются параллельно (в пределах bitrix24_max_concurrent_batches).
         
         Args:
             deal_ids: Список ID сделок
             
         Returns:
-            Словарь {deal_id: [contact_ids]}
+            Словарь {deal_id: [contact_ids]} (для сделок с ошибкой - пустой список)
         """
         if not deal_ids:
             return {}
         
         result_dict = {deal_id: [] for deal_id in deal_ids}
+        semaphore = self._get_batch_semaphore()
         
-        try:
-            # Используем параллельные запросы через asyncio.gather
-            # Группируем запросы по батчам для контроля нагрузки
-            batch_size = 50
+        async def run_chunk(chunk_deal_ids: List[int]):
+            commands = {
+                f'd{deal_id}': f"crm.deal.contact.items.get?{http_build_query({'id': deal_id})}"
+                for deal_id in chunk_deal_ids
+            }
+            async with semaphore:
+                try:
+                    results, errors = await self.call_batch_commands(commands)
+                except Exception as e:
+                    logger.warning(f"Ошибка batch запроса контактов для {len(chunk_deal_ids)} сделок: {e}")
+                    return
             
-            # Обрабатываем все сделки батчами
-            for i in range(0, len(deal_ids), batch_size):
-                batch_deal_ids = deal_ids[i:i + batch_size]
-                
-                # Создаем задачи для параллельного выполнения
-                batch_tasks = [
-                    self.get_deal_related_contacts(deal_id) 
-                    for deal_id in batch_deal_ids
-                ]
-                
-                # Выполняем batch запросов параллельно
-                contact_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-                
-                # Обрабатываем результаты
-                for deal_id, contact_ids in zip(batch_deal_ids, contact_results):
-                    if isinstance(contact_ids, Exception):
-                        logger.warning(f"Ошибка при получении контактов для сделки {deal_id}: {contact_ids}")
-                        result_dict[deal_id] = []
-                    else:
-                        result_dict[deal_id] = contact_ids
-                        logger.debug(f"Сделка {deal_id}: получено {len(contact_ids)} контактов: {contact_ids}")
+            for deal_id in chunk_deal_ids:
+                key = f'd{deal_id}'
+                if key in errors:
+                    logger.warning(f"Ошибка при получении контактов для сделки {deal_id}: {errors[key]}")
+                    continue
+                result_dict[deal_id] = decode_deal_contact_items(results.get(key))
+        
+        chunks = [deal_ids[i:i + BATCH_MAX_COMMANDS] for i in range(0, len(deal_ids), BATCH_MAX_COMMANDS)]
+        await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        
+        logger.info(f"Получены контакты для {len(deal_ids)} сделок через {len(chunks)} batch запросов")
+        return result_dict
+    
+    async def fetch_by_ids_chunked(
+        self,
+        entity_type: str,
+        entity_ids: List[int],
+        select: List[str],
+        chunk_size: Optional[int] = None
+    ) -> ChunkedFetchResult:
+        """
+        Получить сущности по списку ID частями с фильтром ID IN
+        
+        ID разбиваются на части по chunk_size (по умолчанию bitrix24_id_filter_chunk_size),
+        части запрашиваются параллельно в пределах bitrix24_max_concurrent_batches.
+        Ошибка одной части не прерывает остальные и записывается в errors результата.
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company)
+            entity_ids: Список ID сущностей
+            select: Список полей для выборки
+            chunk_size: Размер части
+        
+        Returns:
+            ChunkedFetchResult {entity_id: entity_data} с ошибками по частям
+        """
+        result = ChunkedFetchResult()
+        unique_ids = list(dict.fromkeys(entity_ids))
+        if not unique_ids:
+            return result
+        
+        chunk_size = max(1, chunk_size or settings.bitrix24_id_filter_chunk_size)
+        chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+        semaphore = self._get_batch_semaphore()
+        
+        async def run_chunk(chunk_ids: List[int]):
+            async with semaphore:
+                try:
+                    entities = await self.client.get_all(
+                        f'crm.{entity_type}.list',
+                        params={
+                            'select': select,
+                            'filter': {'ID': chunk_ids}
+                        }
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка при получении {len(chunk_ids)} сущностей {entity_type} по ID (с {chunk_ids[0]} по {chunk_ids[-1]}): {e}")
+                    result.errors.append({'ids': chunk_ids, 'error': str(e)})
+                    return
             
-            logger.info(f"Получены контакты для {len(deal_ids)} сделок через параллельные запросы. Результат: {result_dict}")
-            return result_dict
-        except Exception as e:
-            logger.error(f"Ошибка при batch получении контактов для сделок: {e}", exc_info=True)
-            return result_dict
+            for entity in entities or []:
+                result[int(entity.get('ID'))] = entity
+        
+        await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        
+        if result.errors:
+            logger.warning(
+                f"Получено {len(result)} сущностей {entity_type} по ID, "
+                f"не удалось получить {len(result.errors)} из {len(chunks)} частей"
+            )
+        else:
+            logger.info(f"Получено {len(result)} сущностей {entity_type} по ID ({len(chunks)} частей)")
+        return result
     
-    async def get_deals_companies_batch(self, deal_ids: List[int]) -> Dict[int, Optional[int]]:
+    async def get_deals_companies_batch(self, deal_ids: List[int]) -> ChunkedFetchResult:
         """
-        Получить связанные компании для множества сделок через batch запросы
+        Получить связанные компании для множества сделок
+        
+        Сделки запрашиваются частями по ID (fetch_by_ids_chunked).
         
         Args:
             deal_ids: Список ID сделок
             
         Returns:
-            Словарь {deal_id: company_id или None}
+            ChunkedFetchResult {deal_id: company_id или None} с ошибками по частям
         """
+        result_dict = ChunkedFetchResult({deal_id: None for deal_id in deal_ids})
         if not deal_ids:
-            return {}
+            return result_dict
         
-        result_dict = {deal_id: None for deal_id in deal_ids}
+        deals = await self.fetch_by_ids_chunked('deal', deal_ids, select=['ID', 'COMPANY_ID'])
+        result_dict.errors = deals.errors
         
-        try:
-            # Получаем все сделки одним запросом с фильтром по ID
-            # Используем get_all с фильтром IN для получения всех сделок сразу
-            deals = await self.client.get_all(
-                'crm.deal.list',
-                params={
-                    'select': ['ID', 'COMPANY_ID'],
-                    'filter': {'ID': deal_ids}
-                }
-            )
-            
-            # Формируем словарь результатов
-            for deal in deals:
-                deal_id = int(deal.get('ID'))
-                company_id = deal.get('COMPANY_ID')
-                if company_id:
-                    result_dict[deal_id] = int(company_id)
-            
-            logger.info(f"Получены компании для {len(deal_ids)} сделок через batch")
-            return result_dict
-        except Exception as e:
-            logger.error(f"Ошибка при batch получении компаний для сделок: {e}", exc_info=True)
-            return result_dict
+        # Формируем словарь результатов
+        for deal_id, deal in deals.items():
+            company_id = deal.get('COMPANY_ID')
+            if company_id and str(company_id) != '0':
+                result_dict[deal_id] = int(company_id)
+        
+        logger.info(f"Получены компании для {len(deal_ids)} сделок")
+        return result_dict
     
     async def get_entities_batch(
         self,
         entity_type: str,
         entity_ids: List[int],
         select: Optional[List[str]] = None
-    ) -> Dict[int, Dict[str, Any]]:
+    ) -> ChunkedFetchResult:
         """
-        Получить информацию о множестве сущностей одним запросом
+        Получить информацию о множестве сущностей по ID
+        
+        Сущности запрашиваются частями по ID (fetch_by_ids_chunked).
         
         Args:
             entity_type: Тип сущности (contact, company и т.д.)
@@ -432,45 +807,55 @@ class BitrixClient:
             select: Список полей для выборки
             
         Returns:
-            Словарь {entity_id: entity_data}
+            ChunkedFetchResult {entity_id: entity_data} с ошибками по частям
         """
-        if not entity_ids:
-            return {}
-        
         if select is None:
             select = ['ID', 'ASSIGNED_BY_ID']
         
-        result_dict = {}
-        
-        try:
-            # Получаем все сущности одним запросом с фильтром по ID
-            entities = await self.client.get_all(
-                f'crm.{entity_type}.list',
-                params={
-                    'select': select,
-                    'filter': {'ID': entity_ids}
-                }
-            )
-            
-            # Формируем словарь результатов
-            for entity in entities:
-                entity_id = int(entity.get('ID'))
-                result_dict[entity_id] = entity
-            
-            logger.info(f"Получено {len(result_dict)} сущностей типа {entity_type} через batch")
-            return result_dict
-        except Exception as e:
-            logger.error(f"Ошибка при batch получении сущностей {entity_type}: {e}", exc_info=True)
-            return result_dict
+        return await self.fetch_by_ids_chunked(entity_type, entity_ids, select)
 
 
 # Singleton экземпляр клиента
 _bitrix_client: Optional[BitrixClient] = None
 
 
+_bitrix_client_lock = threading.Lock()
+
+
 def get_bitrix_client() -> BitrixClient:
     """Получить экземпляр Bitrix24 клиента (singleton)"""
     global _bitrix_client
     if _bitrix_client is None:
-        _bitrix_client = BitrixClient()
+        with _bitrix_client_lock:
+            if _bitrix_client is None:
+                _bitrix_client = BitrixClient()
     return _bitrix_client
+
+
+async def close_bitrix_client():
+    """Закрыть HTTP сессию Bitrix24 текущего event loop (если клиент создавался)"""
+    if _bitrix_client is not None:
+        await _bitrix_client.close_loop_session()
+
+
+def run_bitrix_task(coroutine: Awaitable, priority: int = PRIORITY_BULK) -> Any:
+    """
+    Выполнить корутину в новом event loop (например, в потоке планировщика)
+    
+    После выполнения закрывается HTTP сессия Bitrix24, созданная для этого loop.
+    
+    Args:
+        coroutine: Корутина для выполнения
+        priority: Приоритет запросов к Bitrix24 (по умолчанию - массовое обновление)
+    
+    Returns:
+        Результат корутины
+    """
+    async def runner():
+        set_bitrix_priority(priority)
+        try:
+            return await coroutine
+        finally:
+            await close_bitrix_client()
+    
+    return asyncio.run(runner())
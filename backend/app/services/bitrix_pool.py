@@ -0,0 +1,130 @@
+from fast_bitrix24 import Bitrix
+from typing import Dict, Any
+from app.config import settings
+from app.services.bitrix_rate_limiter import BitrixRateLimiter
+import aiohttp
+import asyncio
+import threading
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _LoopSession:
+    """HTTP сессия и клиент fast_bitrix24, привязанные к одному event loop"""
+    
+    def __init__(self, session: aiohttp.ClientSession, client: Bitrix):
+        self.session = session
+        self.client = client
+
+
+class BitrixSessionPool:
+    """
+    Пул HTTP сессий Bitrix24: одна keep-alive сессия aiohttp и один клиент fast_bitrix24 на event loop
+    
+    Сессия aiohttp и примитивы синхронизации fast_bitrix24 привязаны к event loop, в котором
+    созданы. API (uvicorn) и задачи планировщика (asyncio.run в фоновом потоке) работают в разных
+    loop, поэтому каждый loop получает собственную сессию с пулом соединений (TCPConnector).
+    Соединения переиспользуются между запросами в рамках loop; сессия закрывается явно через
+    close_current_loop (по завершении задачи планировщика или при остановке приложения).
+    Счетчики соединений собираются через TraceConfig aiohttp. Все сессии используют общий
+    ограничитель запросов (BitrixRateLimiter) через middleware.
+    """
+    
+    def __init__(self, webhook: str, rate_limiter: BitrixRateLimiter):
+        self.webhook = webhook
+        self.rate_limiter = rate_limiter
+        self._sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopSession]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {
+            'sessions_created': 0,
+            'sessions_closed': 0,
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+        }
+    
+    def _increment(self, counter: str):
+        """Увеличить счетчик (вызывается из разных потоков)"""
+        with self._lock:
+            self._stats[counter] += 1
+    
+    def _create_trace_config(self) -> aiohttp.TraceConfig:
+        """Создать TraceConfig для подсчета запросов и соединений"""
+        trace_config = aiohttp.TraceConfig()
+        
+        async def on_request_start(session, context, params):
+            self._increment('requests')
+        
+        async def on_connection_create_end(session, context, params):
+            self._increment('connections_created')
+        
+        async def on_connection_reuseconn(session, context, params):
+            self._increment('connections_reused')
+        
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+    
+    def get_client(self) -> Bitrix:
+        """
+        Получить клиент fast_bitrix24 для текущего event loop
+        
+        Вызывается только из корутин: сессия создается в работающем loop при первом обращении.
+        
+        Returns:
+            Клиент fast_bitrix24, использующий сессию текущего loop
+        """
+        loop = asyncio.get_running_loop()
+        loop_session = self._sessions.get(loop)
+        if loop_session is None or loop_session.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=settings.bitrix24_connection_pool_size,
+                keepalive_timeout=settings.bitrix24_keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            # fast_bitrix24 ожидает сессию с raise_for_status=True (так создается его собственная сессия)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                raise_for_status=True,
+                trace_configs=[self._create_trace_config()],
+                middlewares=(self.rate_limiter.middleware,)
+            )
+            loop_session = _LoopSession(session, Bitrix(self.webhook, client=session))
+            self._sessions[loop] = loop_session
+            self._increment('sessions_created')
+            logger.info("Создана HTTP сессия Bitrix24 для event loop")
+        return loop_session.client
+    
+    async def close_current_loop(self):
+        """Закрыть HTTP сессию текущего event loop (если она создавалась)"""
+        loop = asyncio.get_running_loop()
+        loop_session = self._sessions.pop(loop, None)
+        if loop_session is None or loop_session.session.closed:
+            return
+        
+        try:
+            await loop_session.session.close()
+            self._increment('sessions_closed')
+            logger.info("HTTP сессия Bitrix24 для event loop закрыта")
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии HTTP сессии Bitrix24: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Получить счетчики пула
+        
+        Returns:
+            Словарь со счетчиками сессий, запросов и соединений, долей переиспользованных
+            соединений (connection_reuse_ratio) и количеством открытых сессий
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        
+        connections = stats['connections_created'] + stats['connections_reused']
+        stats['connection_reuse_ratio'] = round(stats['connections_reused'] / connections, 4) if connections else None
+        stats['open_sessions'] = sum(1 for item in list(self._sessions.values()) if not item.session.closed)
+        stats['rate_limiter'] = self.rate_limiter.get_stats()
+        return stats
@@ -0,0 +1,334 @@
+from contextvars import ContextVar, Token
+from typing import Dict, Any, Optional, Iterable
+from app.config import settings
+import aiohttp
+import asyncio
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета запросов к Bitrix24 (меньше - важнее)
+PRIORITY_INTERACTIVE = 0  # Обработка webhook
+PRIORITY_MANUAL = 1  # Действия из интерфейса (ручное обновление, подсчет, предпросмотр)
+PRIORITY_BULK = 2  # Массовое обновление по планировщику
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_MANUAL: 'manual',
+    PRIORITY_BULK: 'bulk',
+}
+
+# Приоритет запросов текущего контекста (наследуется задачами asyncio)
+_request_priority: ContextVar[int] = ContextVar('bitrix_request_priority', default=PRIORITY_MANUAL)
+
+# Максимальная пауза между проверками очереди (секунды)
+MAX_WAIT_STEP = 0.5
+
+
+def set_bitrix_priority(priority: int) -> Token:
+    """
+    Установить приоритет запросов к Bitrix24 для текущего контекста
+    
+    Args:
+        priority: PRIORITY_INTERACTIVE, PRIORITY_MANUAL или PRIORITY_BULK
+    
+    Returns:
+        Токен для восстановления предыдущего приоритета (ContextVar.reset)
+    """
+    return _request_priority.set(priority)
+
+
+def reset_bitrix_priority(token: Token):
+    """Восстановить приоритет запросов, действовавший до set_bitrix_priority"""
+    _request_priority.reset(token)
+
+
+def get_bitrix_priority() -> int:
+    """Получить приоритет запросов текущего контекста"""
+    return _request_priority.get()
+
+
+class BitrixRateLimiter:
+    """
+    Общий для процесса адаптивный token bucket запросов к порталу Bitrix24
+    
+    Все HTTP запросы к Bitrix24 (из loop API и из потоков планировщика) получают токен
+    через middleware сессии aiohttp. Приоритет берется из контекста запроса:
+    - interactive (webhook) может использовать все токены и проходит первым;
+    - manual оставляет часть ведра (половину резерва) для webhook;
+    - bulk оставляет весь резерв BITRIX24_INTERACTIVE_RESERVE и ждет, пока есть ожидающие
+      токен запросы с более высоким приоритетом (запрос, ожидающий паузу метода, не учитывается).
+    Поэтому webhook не стоит в очереди за ночным обновлением большого количества сущностей.
+    
+    Реакция на ответы Bitrix24:
+    - QUERY_LIMIT_EXCEEDED (или 503): ведро опустошается, скорость уменьшается вдвое
+      и восстанавливается постепенно после успешных запросов;
+    - time.operating метода выше BITRIX24_OPERATING_SOFT_LIMIT: запросы manual и bulk
+      к этому методу приостанавливаются до operating_reset_at. Для batch учитываются методы
+      команд (result_time каждой команды), пауза метода задерживает и batch с его командами.
+    Тело ответа отдельно не разбирается: учитывается JSON, который разбирает fast_bitrix24.
+    """
+    
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+        interactive_reserve: Optional[int] = None,
+        operating_soft_limit: Optional[float] = None
+    ):
+        self.base_rate = rate or settings.bitrix24_rate_limit
+        self.burst = burst or settings.bitrix24_rate_burst
+        self.interactive_reserve = settings.bitrix24_interactive_reserve if interactive_reserve is None else interactive_reserve
+        self.operating_soft_limit = operating_soft_limit or settings.bitrix24_operating_soft_limit
+        self.min_rate = self.base_rate / 8
+        
+        self._lock = threading.Lock()
+        self._rate = self.base_rate
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        # Приостановка manual и bulk запросов по методу: {метод: время monotonic}
+        self._method_pause_until: Dict[str, float] = {}
+        self._stats = {
+            name: {'requests': 0, 'waited': 0, 'wait_seconds': 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        self._limit_exceeded = 0
+        self._operating_pauses = 0
+    
+    def _reserve_for(self, priority: int) -> float:
+        """Количество токенов, которые запрос этого приоритета должен оставить в ведре"""
+        if priority == PRIORITY_BULK:
+            return float(self.interactive_reserve)
+        if priority == PRIORITY_MANUAL:
+            return self.interactive_reserve / 2
+        return 0.0
+    
+    def _refill(self, now: float):
+        """Пополнить ведро по текущей скорости (вызывается под блокировкой)"""
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(float(self.burst), self._tokens + elapsed * self._rate)
+            self._updated_at = now
+    
+    def _method_pause_wait(self, priority: int, methods: Iterable[str], now: float) -> float:
+        """
+        Время до окончания паузы методов запроса (вызывается под блокировкой)
+        
+        Returns:
+            0, если ни один метод не приостановлен, иначе время ожидания до следующей попытки
+        """
+        if priority == PRIORITY_INTERACTIVE:
+            return 0.0
+        for method in methods:
+            pause_until = self._method_pause_until.get(method)
+            if pause_until is None:
+                continue
+            if pause_until > now:
+                return min(pause_until - now, MAX_WAIT_STEP)
+            del self._method_pause_until[method]
+        return 0.0
+    
+    def _try_acquire(self, priority: int, now: float) -> float:
+        """
+        Попытаться взять токен (вызывается под блокировкой)
+        
+        Returns:
+            0, если токен получен, иначе время ожидания до следующей попытки
+        """
+        self._refill(now)
+        
+        if any(self._waiting[p] for p in self._waiting if p < priority):
+            return MAX_WAIT_STEP / 5
+        
+        needed = 1.0 + self._reserve_for(priority)
+        if self._tokens >= needed:
+            self._tokens -= 1.0
+            return 0.0
+        return min((needed - self._tokens) / self._rate, MAX_WAIT_STEP)
+    
+    async def acquire(self, priority: Optional[int] = None, methods: Iterable[str] = ()):
+        """
+        Дождаться токена для запроса
+        
+        Args:
+            priority: Приоритет запроса (по умолчанию - приоритет текущего контекста)
+            methods: Методы REST API запроса (для batch - методы команд), для приостановки по времени выполнения
+        """
+        if priority is None:
+            priority = get_bitrix_priority()
+        name = PRIORITY_NAMES.get(priority, 'manual')
+        
+        started = time.monotonic()
+        waited = False
+        # Ожидающим (и задерживающим запросы ниже по приоритету) запрос считается только пока
+        # ждет токен: ожидание паузы метода не должно останавливать запросы к другим методам
+        counted = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = self._method_pause_wait(priority, methods, now)
+                    if wait > 0.0:
+                        if counted:
+                            self._waiting[priority] -= 1
+                            counted = False
+                    else:
+                        wait = self._try_acquire(priority, now)
+                        if wait == 0.0:
+                            stats = self._stats[name]
+                            stats['requests'] += 1
+                            if waited:
+                                stats['waited'] += 1
+                                stats['wait_seconds'] += time.monotonic() - started
+                            return
+                        if not counted:
+                            self._waiting[priority] += 1
+                            counted = True
+                    waited = True
+                await asyncio.sleep(wait)
+        finally:
+            if counted:
+                with self._lock:
+                    self._waiting[priority] -= 1
+    
+    def record_status(self, method: str, status: int):
+        """
+        Учесть HTTP статус ответа Bitrix24: 503 - превышение лимита запросов
+        
+        Args:
+            method: Метод REST API
+            status: HTTP статус ответа
+        """
+        with self._lock:
+            if status == 503:
+                self._limit_exceeded_locked(method)
+            elif status < 400 and self._rate < self.base_rate:
+                self._rate = min(self.base_rate, self._rate + self.base_rate / 20)
+    
+    def record_payload(self, method: str, payload: Any, commands: Optional[Dict[str, str]] = None):
+        """
+        Учесть разобранный ответ Bitrix24: ошибку QUERY_LIMIT_EXCEEDED и время выполнения методов
+        
+        Args:
+            method: Метод REST API
+            payload: Разобранный JSON ответа
+            commands: Методы команд batch {ключ команды: метод} (время берется из result_time команд)
+        """
+        if not isinstance(payload, dict):
+            return
+        
+        with self._lock:
+            if payload.get('error') == 'QUERY_LIMIT_EXCEEDED':
+                self._limit_exceeded_locked(method)
+                return
+            
+            if commands is None:
+                self._record_operating_locked(method, payload.get('time'))
+                return
+            
+            result = payload.get('result')
+            result_time = result.get('result_time') if isinstance(result, dict) else None
+            if isinstance(result_time, list):
+                result_time = {str(index): timing for index, timing in enumerate(result_time)}
+            if not isinstance(result_time, dict):
+                return
+            for key, timing in result_time.items():
+                command_method = commands.get(str(key))
+                if command_method:
+                    self._record_operating_locked(command_method, timing)
+    
+    def _limit_exceeded_locked(self, method: str):
+        """Опустошить ведро и снизить скорость вдвое (вызывается под блокировкой)"""
+        self._limit_exceeded += 1
+        self._tokens = 0.0
+        self._updated_at = time.monotonic()
+        self._rate = max(self.min_rate, self._rate / 2)
+        logger.warning(f"Превышен лимит запросов Bitrix24 ({method}), скорость снижена до {self._rate:.2f} запросов/с")
+    
+    def _record_operating_locked(self, method: str, timing: Any):
+        """Приостановить manual и bulk запросы метода, если его time.operating выше мягкого лимита (под блокировкой)"""
+        if not isinstance(timing, dict):
+            return
+        operating = timing.get('operating')
+        if operating is None or float(operating) < self.operating_soft_limit:
+            return
+        
+        now = time.monotonic()
+        reset_at = timing.get('operating_reset_at')
+        pause = float(reset_at) - time.time() if reset_at else 60.0
+        pause = min(max(pause, 1.0), 600.0)
+        if self._method_pause_until.get(method, 0) < now + pause:
+            self._method_pause_until[method] = now + pause
+            self._operating_pauses += 1
+            logger.warning(
+                f"Время выполнения метода {method} в Bitrix24 {operating} с: "
+                f"запросы manual и bulk приостановлены на {pause:.0f} с"
+            )
+    
+    @staticmethod
+    def _batch_commands(request: aiohttp.ClientRequest) -> Optional[Dict[str, str]]:
+        """
+        Методы команд batch из тела запроса {ключ команды: метод}
+        
+        Returns:
+            None, если тело запроса не удалось разобрать
+        """
+        try:
+            commands = json.loads(request.body.decode()).get('cmd')
+        except Exception:
+            return None
+        if isinstance(commands, list):
+            commands = {str(index): command for index, command in enumerate(commands)}
+        if not isinstance(commands, dict):
+            return None
+        return {
+            str(key): str(command).split('?', 1)[0].strip().lower()
+            for key, command in commands.items()
+        }
+    
+    async def middleware(self, request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+        """
+        Middleware сессии aiohttp: токен перед запросом и учет ответа
+        
+        Статус учитывается сразу, тело ответа - когда его разбирает fast_bitrix24
+        (response.json), без повторного разбора JSON.
+        """
+        method = request.url.path.rstrip('/').rsplit('/', 1)[-1]
+        # Для batch, тело которого не удалось разобрать, время выполнения не учитывается
+        commands = (self._batch_commands(request) or {}) if method == 'batch' else None
+        methods = sorted(set(commands.values())) if commands else [method]
+        await self.acquire(methods=methods)
+        
+        response = await handler(request)
+        self.record_status(method, response.status)
+        
+        response_json = response.json
+        
+        async def json_and_record(*args, **kwargs):
+            payload = await response_json(*args, **kwargs)
+            self.record_payload(method, payload, commands)
+            return payload
+        
+        response.json = json_and_record
+        return response
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить состояние и счетчики ограничителя"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': round(self._rate, 3),
+                'base_rate': self.base_rate,
+                'tokens': round(self._tokens, 2),
+                'burst': self.burst,
+                'interactive_reserve': self.interactive_reserve,
+                'limit_exceeded': self._limit_exceeded,
+                'operating_pauses': self._operating_pauses,
+                'paused_methods': sorted(self._method_pause_until),
+                'waiting': {PRIORITY_NAMES[p]: count for p, count in self._waiting.items()},
+                'priorities': {name: dict(stats) for name, stats in self._stats.items()},
+            }
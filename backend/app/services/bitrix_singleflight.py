@@ -0,0 +1,141 @@
+from concurrent.futures import Future
+from typing import Dict, Any, Optional, Callable, Awaitable
+import asyncio
+import copy
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_request_key(method: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Построить ключ запроса из метода и нормализованных параметров
+    
+    Параметры сериализуются в JSON с сортировкой ключей, поэтому порядок ключей
+    в словарях фильтра и параметров не влияет на ключ.
+    
+    Args:
+        method: Метод REST API
+        params: Параметры запроса
+    
+    Returns:
+        Строковый ключ запроса
+    """
+    return f"{method}:{json.dumps(params or {}, sort_keys=True, ensure_ascii=False, default=str)}"
+
+
+class LeaderCancelledError(Exception):
+    """Вызов, к которому присоединился запрос, отменен (ожидающий запрос выполняет вызов сам)"""
+
+
+class _Call:
+    """Выполняющийся вызов: Future результата и количество присоединившихся запросов"""
+    
+    def __init__(self):
+        self.future: Future = Future()
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов чтения к Bitrix24 (singleflight)
+    
+    Первый запрос с данным ключом (промах) выполняет вызов Bitrix24, остальные запросы с тем же
+    ключом, пришедшие до его завершения (попадания), ждут и получают тот же результат или ту же
+    ошибку. Результат не кэшируется: после завершения вызова следующий запрос снова идет в Bitrix24.
+    Ожидание построено на concurrent.futures.Future, поэтому запросы объединяются и между
+    event loop (API и задачи планировщика). Ожидающие получают копию результата, чтобы изменения
+    строк одним вызывающим (например, EntitySnapshot) не влияли на других: в Future сохраняется
+    копия, первый запрос получает исходный результат. Если первый запрос отменен, ожидающие
+    не получают CancelledError, а повторяют вызов (один из них становится первым).
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, _Call] = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'takeovers': 0,
+        }
+    
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполнить вызов или присоединиться к такому же выполняющемуся вызову
+        
+        Args:
+            key: Ключ запроса (make_request_key)
+            call: Функция без аргументов, возвращающая корутину вызова Bitrix24
+        
+        Returns:
+            Результат вызова
+        """
+        while True:
+            with self._lock:
+                in_flight = self._in_flight.get(key)
+                leader = in_flight is None
+                if leader:
+                    in_flight = _Call()
+                    self._in_flight[key] = in_flight
+                    self._stats['misses'] += 1
+                else:
+                    in_flight.followers += 1
+                    self._stats['hits'] += 1
+            
+            if leader:
+                return await self._lead(key, in_flight, call)
+            
+            logger.debug(f"Запрос {key[:100]} объединен с выполняющимся вызовом")
+            try:
+                # shield: отмена одного ожидающего не должна отменять общий Future
+                result = await asyncio.shield(asyncio.wrap_future(in_flight.future))
+            except LeaderCancelledError:
+                logger.debug(f"Вызов {key[:100]} отменен первым запросом, повторяем")
+                with self._lock:
+                    self._stats['takeovers'] += 1
+                continue
+            return copy.deepcopy(result)
+    
+    async def _lead(self, key: str, in_flight: _Call, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполнить вызов первым запросом и передать результат присоединившимся"""
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self._release(key)
+            in_flight.future.set_exception(LeaderCancelledError(key))
+            raise
+        except Exception as e:
+            self._release(key)
+            in_flight.future.set_exception(e)
+            raise
+        
+        # После удаления из _in_flight новые запросы не присоединяются, количество ожидающих окончательно
+        if self._release(key):
+            in_flight.future.set_result(copy.deepcopy(result))
+        else:
+            in_flight.future.set_result(None)
+        return result
+    
+    def _release(self, key: str) -> int:
+        """Завершить вызов (новые запросы с этим ключом пойдут в Bitrix24) и вернуть количество ожидающих"""
+        with self._lock:
+            in_flight = self._in_flight.pop(key, None)
+            return in_flight.followers if in_flight is not None else 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Получить счетчики объединения запросов
+        
+        Returns:
+            Словарь с количеством попаданий (hits), промахов (misses), долей попаданий (hit_ratio),
+            повторов после отмены первого запроса (takeovers) и количеством выполняющихся вызовов (in_flight)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._in_flight)
+        
+        total = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / total, 4) if total else None
+        return stats
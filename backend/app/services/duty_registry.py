@@ -0,0 +1,210 @@
+from sqlalchemy.orm import Session, selectinload
+from datetime import date
+from typing import List, Dict, Any, Optional, FrozenSet, Callable
+from app.database import SessionLocal
+from app.models import UpdateRule
+from app.services.schedule_service import ScheduleService
+from app.services.update_service import UpdateService, get_today_msk
+from app.services.rule_engine import RuleEngine, EntityPredicate
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DutyUserInfo:
+    """Пользователь на дежурстве (копия строки users, не привязанная к сессии)"""
+    
+    def __init__(self, id: int, name: Optional[str], last_name: Optional[str]):
+        self.id = id
+        self.name = name
+        self.last_name = last_name
+
+
+class WebhookRule:
+    """
+    Правило сделок, применимое на дату графика: пользователи правила, поля для запроса сделки
+    и скомпилированный предикат условий (копия правила, не привязанная к сессии)
+    """
+    
+    def __init__(self, rule: UpdateRule, required_fields: List[str], predicate: Optional[EntityPredicate]):
+        self.id = rule.id
+        self.entity_type = rule.entity_type
+        self.entity_name = rule.entity_name
+        self.rule_type = rule.rule_type
+        self.priority = rule.priority
+        self.update_related_contacts_companies = bool(rule.update_related_contacts_companies)
+        self.user_ids: FrozenSet[int] = frozenset(ru.user_id for ru in rule.rule_users)
+        self.required_fields = required_fields
+        # None - условия правила не удалось разобрать (правило не фильтрует, как в RuleEngine.apply_rules)
+        self.predicate = predicate
+
+
+class DutySnapshot:
+    """
+    Дежурные пользователи и применимые правила сделок на одну дату (МСК)
+    
+    duty_users - пользователи графика на дату, rules_count - количество включенных правил сделок,
+    applicable_rules - включенные правила сделок, пользователи которых есть в графике (в порядке ID),
+    required_fields - объединение полей сделки, необходимых применимым правилам.
+    """
+    
+    def __init__(
+        self,
+        snapshot_date: date,
+        duty_users: List[DutyUserInfo],
+        rules_count: int,
+        applicable_rules: List[WebhookRule]
+    ):
+        self.date = snapshot_date
+        self.duty_users = duty_users
+        self.duty_user_ids: FrozenSet[int] = frozenset(u.id for u in duty_users)
+        self.rules_count = rules_count
+        self.applicable_rules = applicable_rules
+        self.required_fields = ['ID', 'ASSIGNED_BY_ID']
+        for rule in applicable_rules:
+            self.required_fields.extend([f for f in rule.required_fields if f not in self.required_fields])
+        self._rules_by_priority = sorted(applicable_rules, key=lambda r: r.priority)
+    
+    def matches(self, deal: Dict[str, Any]) -> bool:
+        """
+        Проверить сделку условиями применимых правил (последовательно по приоритету, как RuleEngine.apply_rules)
+        
+        Args:
+            deal: Сделка из Bitrix24
+        
+        Returns:
+            True, если сделка проходит все правила
+        """
+        for rule in self._rules_by_priority:
+            if rule.predicate is None:
+                continue
+            try:
+                if not rule.predicate(deal):
+                    return False
+            except Exception as e:
+                logger.error(f"Ошибка при применении правила {rule.id}: {e}", exc_info=True)
+        return True
+
+
+class DutyRegistry:
+    """
+    Дежурные пользователи на сегодня и применимые правила сделок для обработки webhook
+    
+    Снимок (DutySnapshot) загружается из базы данных при первом обращении и используется
+    обработкой webhook без запросов к базе данных. Снимок сбрасывается endpoints записи графика,
+    правил и пользователей (invalidate) и загружается заново при смене даты по московскому времени.
+    Экземпляр общий для процесса (get_duty_registry).
+    """
+    
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal):
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        self._snapshot: Optional[DutySnapshot] = None
+        # Увеличивается при каждом сбросе: снимок, загруженный до сброса, не сохраняется
+        self._version = 0
+        self._loaded_at: Optional[float] = None
+        self._stats = {
+            'hits': 0,
+            'loads': 0,
+            'invalidations': 0,
+        }
+    
+    def invalidate(self):
+        """Сбросить снимок (после изменения графика, правил или пользователей)"""
+        with self._lock:
+            self._snapshot = None
+            self._version += 1
+            self._stats['invalidations'] += 1
+    
+    def get_snapshot(self, db: Optional[Session] = None) -> DutySnapshot:
+        """
+        Получить снимок на текущую дату по московскому времени
+        
+        Args:
+            db: Сессия базы данных для загрузки снимка (по умолчанию - новая сессия)
+        
+        Returns:
+            Снимок дежурных пользователей и применимых правил
+        """
+        today = get_today_msk()
+        with self._lock:
+            snapshot = self._snapshot
+            version = self._version
+            if snapshot is not None and snapshot.date == today:
+                self._stats['hits'] += 1
+                return snapshot
+        
+        if db is not None:
+            snapshot = self._load(db, today)
+        else:
+            load_db = self.session_factory()
+            try:
+                snapshot = self._load(load_db, today)
+            finally:
+                load_db.close()
+        
+        with self._lock:
+            self._stats['loads'] += 1
+            if self._version == version:
+                self._snapshot = snapshot
+                self._loaded_at = time.monotonic()
+        return snapshot
+    
+    def _load(self, db: Session, snapshot_date: date) -> DutySnapshot:
+        """Загрузить из базы данных дежурных пользователей и применимые правила сделок на дату"""
+        duty_users = [
+            DutyUserInfo(user.id, user.name, user.last_name)
+            for user in ScheduleService(db).get_duty_users_for_date(snapshot_date)
+        ]
+        duty_user_ids = {u.id for u in duty_users}
+        
+        rules = db.query(UpdateRule).options(selectinload(UpdateRule.rule_users)).filter(
+            UpdateRule.enabled == True,
+            UpdateRule.entity_type == 'deal'
+        ).order_by(UpdateRule.id).all()
+        
+        update_service = UpdateService(db)
+        applicable_rules = []
+        for rule in rules:
+            rule_user_ids = {ru.user_id for ru in rule.rule_users}
+            if not rule_user_ids or not rule_user_ids.intersection(duty_user_ids):
+                continue
+            try:
+                predicate = RuleEngine.compile_rule(rule)
+            except Exception as e:
+                logger.error(f"Ошибка при компиляции правила {rule.id}: {e}", exc_info=True)
+                predicate = None
+            applicable_rules.append(WebhookRule(rule, update_service._get_required_fields_for_rule(rule), predicate))
+        
+        logger.info(
+            f"Загружен снимок графика на {snapshot_date}: дежурных {len(duty_users)}, "
+            f"правил сделок {len(rules)}, применимых {len(applicable_rules)}"
+        )
+        return DutySnapshot(snapshot_date, duty_users, len(rules), applicable_rules)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить состояние и счетчики снимка"""
+        with self._lock:
+            stats = dict(self._stats)
+            snapshot = self._snapshot
+            stats['date'] = str(snapshot.date) if snapshot is not None else None
+            stats['duty_users'] = len(snapshot.duty_users) if snapshot is not None else None
+            stats['applicable_rules'] = len(snapshot.applicable_rules) if snapshot is not None else None
+            stats['age_seconds'] = round(time.monotonic() - self._loaded_at, 1) if snapshot is not None and self._loaded_at else None
+        return stats
+
+
+_duty_registry: Optional[DutyRegistry] = None
+_duty_registry_lock = threading.Lock()
+
+
+def get_duty_registry() -> DutyRegistry:
+    """Получить общий для процесса снимок графика и правил для webhook"""
+    global _duty_registry
+    if _duty_registry is None:
+        with _duty_registry_lock:
+            if _duty_registry is None:
+                _duty_registry = DutyRegistry()
+    return _duty_registry
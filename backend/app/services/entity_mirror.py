@@ -0,0 +1,354 @@
+from sqlalchemy import insert, update, delete, bindparam
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional
+from app.models import EntityMirror, EntitySyncState
+from app.services.bitrix_client import BitrixClient
+from app.config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Поля Bitrix24, которые хранятся в локальной копии: {тип сущности: {поле Bitrix24: колонка}}
+MIRROR_FIELDS = {
+    'deal': {
+        'ASSIGNED_BY_ID': 'assigned_by_id',
+        'CATEGORY_ID': 'category_id',
+        'STAGE_ID': 'stage_id',
+        'STAGE_SEMANTIC_ID': 'stage_semantic_id',
+        'COMPANY_ID': 'company_id',
+        'CONTACT_ID': 'contact_id',
+    },
+    'lead': {
+        'ASSIGNED_BY_ID': 'assigned_by_id',
+        'STATUS_ID': 'stage_id',
+        'STATUS_SEMANTIC_ID': 'stage_semantic_id',
+        'COMPANY_ID': 'company_id',
+        'CONTACT_ID': 'contact_id',
+    },
+    'contact': {
+        'ASSIGNED_BY_ID': 'assigned_by_id',
+        'COMPANY_ID': 'company_id',
+    },
+    'company': {
+        'ASSIGNED_BY_ID': 'assigned_by_id',
+    },
+}
+
+# Колонки с целочисленными значениями
+INTEGER_COLUMNS = {'assigned_by_id', 'company_id', 'contact_id'}
+
+# Фильтр полной сверки: для сделок хранятся только сделки в работе
+# (закрытые после сверки сделки попадают в копию через изменения и отсекаются фильтром правил)
+FULL_SYNC_FILTERS = {
+    'deal': {'STAGE_SEMANTIC_ID': 'P'},
+}
+
+# Размер части при выборке существующих строк по ID
+ID_CHUNK_SIZE = 500
+
+
+def _parse_date_modify(value: Optional[str]) -> Optional[datetime]:
+    """Разобрать DATE_MODIFY из Bitrix24 (ISO 8601 с часовым поясом)"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+
+
+class EntityMirrorService:
+    """
+    Локальная копия сущностей Bitrix24 (ID, ответственный, воронка, стадия, DATE_MODIFY)
+    
+    Копия обновляется по изменениям: запрашиваются только сущности с DATE_MODIFY не раньше
+    сохраненной отметки (high_water_mark). Раз в ENTITY_MIRROR_FULL_SYNC_HOURS часов выполняется
+    полная сверка, которая также удаляет из копии сущности, удаленные в Bitrix24
+    (удаления не видны по DATE_MODIFY). Правила, поля которых есть в копии, применяются
+    к ней без запроса списка сущностей в Bitrix24.
+    """
+    
+    def __init__(self, db: Session, bitrix_client: BitrixClient):
+        self.db = db
+        self.bitrix_client = bitrix_client
+    
+    @staticmethod
+    def supports(entity_type: str, fields: List[str]) -> bool:
+        """
+        Проверить, что все поля есть в локальной копии сущностей этого типа
+        
+        Args:
+            entity_type: Тип сущности
+            fields: Список полей Bitrix24
+        
+        Returns:
+            True, если сущности с этими полями можно получить из копии
+        """
+        mirror_fields = MIRROR_FIELDS.get(entity_type)
+        if mirror_fields is None:
+            return False
+        return all(field == 'ID' or field in mirror_fields for field in fields)
+    
+    def _get_state(self, entity_type: str) -> EntitySyncState:
+        """Получить (или создать) состояние синхронизации типа сущности"""
+        state = self.db.query(EntitySyncState).filter(EntitySyncState.entity_type == entity_type).first()
+        if state is None:
+            state = EntitySyncState(entity_type=entity_type, entities_count=0)
+            self.db.add(state)
+            self.db.flush()
+        return state
+    
+    def _to_row(self, entity_type: str, entity: Dict[str, Any]) -> Dict[str, Any]:
+        """Преобразовать сущность Bitrix24 в строку копии"""
+        row = {
+            'entity_type': entity_type,
+            'entity_id': int(entity['ID']),
+            'date_modify': entity.get('DATE_MODIFY'),
+            'assigned_by_id': None,
+            'category_id': None,
+            'stage_id': None,
+            'stage_semantic_id': None,
+            'company_id': None,
+            'contact_id': None,
+        }
+        for field, column in MIRROR_FIELDS[entity_type].items():
+            value = entity.get(field)
+            if column in INTEGER_COLUMNS:
+                try:
+                    value = int(value) if value else None
+                except (ValueError, TypeError):
+                    value = None
+                # Bitrix24 возвращает 0 для незаполненных связей
+                row[column] = value or None
+            else:
+                row[column] = str(value) if value is not None else None
+        return row
+    
+    @staticmethod
+    def _max_date_modify(entities: List[Dict[str, Any]], current: Optional[str]) -> Optional[str]:
+        """Найти максимальный DATE_MODIFY среди сущностей (значение сохраняется в формате Bitrix24)"""
+        best = current
+        best_parsed = _parse_date_modify(current)
+        for entity in entities:
+            value = entity.get('DATE_MODIFY')
+            parsed = _parse_date_modify(value)
+            if parsed is not None and (best_parsed is None or parsed > best_parsed):
+                best, best_parsed = value, parsed
+        return best
+    
+    async def sync(self, entity_type: str, full: bool = False) -> Dict[str, Any]:
+        """
+        Синхронизировать локальную копию сущностей типа с Bitrix24
+        
+        Полная сверка выполняется, если она запрошена явно, копия еще не заполнялась
+        или с последней полной сверки прошло больше ENTITY_MIRROR_FULL_SYNC_HOURS часов.
+        Иначе запрашиваются только сущности, измененные с момента high_water_mark.
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company, lead)
+            full: Выполнить полную сверку
+        
+        Returns:
+            Словарь {'entity_type', 'mode': 'full'|'delta', 'fetched', 'total'}
+        """
+        if entity_type not in MIRROR_FIELDS:
+            raise ValueError(f"Тип сущности {entity_type} не поддерживается локальной копией")
+        
+        state = self._get_state(entity_type)
+        now = datetime.now(timezone.utc)
+        last_full = state.last_full_sync_at
+        if last_full is not None and last_full.tzinfo is None:
+            last_full = last_full.replace(tzinfo=timezone.utc)
+        
+        if (
+            full
+            or state.high_water_mark is None
+            or last_full is None
+            or now - last_full >= timedelta(hours=settings.entity_mirror_full_sync_hours)
+        ):
+            return await self._full_sync(entity_type, state, now)
+        return await self._delta_sync(entity_type, state, now)
+    
+    async def _full_sync(self, entity_type: str, state: EntitySyncState, now: datetime) -> Dict[str, Any]:
+        """Полная сверка: копия типа сущности заменяется текущим списком из Bitrix24"""
+        select = ['ID', 'DATE_MODIFY'] + list(MIRROR_FIELDS[entity_type])
+        entities = await self.bitrix_client.get_entities_list(
+            entity_type,
+            select=select,
+            filter_dict=FULL_SYNC_FILTERS.get(entity_type)
+        )
+        rows = [self._to_row(entity_type, entity) for entity in entities or []]
+        
+        try:
+            self.db.execute(delete(EntityMirror).where(EntityMirror.entity_type == entity_type))
+            for start in range(0, len(rows), ID_CHUNK_SIZE):
+                self.db.execute(insert(EntityMirror.__table__), rows[start:start + ID_CHUNK_SIZE])
+            
+            state.high_water_mark = self._max_date_modify(entities or [], None)
+            state.entities_count = len(rows)
+            state.last_full_sync_at = now
+            state.last_delta_sync_at = now
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при полной сверке локальной копии {entity_type}: {e}")
+            self.db.rollback()
+            raise
+        
+        logger.info(f"Полная сверка локальной копии {entity_type}: {len(rows)} сущностей")
+        return {'entity_type': entity_type, 'mode': 'full', 'fetched': len(rows), 'total': len(rows)}
+    
+    async def _delta_sync(self, entity_type: str, state: EntitySyncState, now: datetime) -> Dict[str, Any]:
+        """Синхронизация изменений: запрашиваются сущности с DATE_MODIFY не раньше high_water_mark"""
+        select = ['ID', 'DATE_MODIFY'] + list(MIRROR_FIELDS[entity_type])
+        # Используется >=, чтобы не потерять изменения в ту же секунду, что и отметка;
+        # повторно полученные сущности просто перезаписываются
+        entities = await self.bitrix_client.get_entities_list(
+            entity_type,
+            select=select,
+            filter_dict={'>=DATE_MODIFY': state.high_water_mark}
+        )
+        entities = entities or []
+        rows = {row['entity_id']: row for row in (self._to_row(entity_type, e) for e in entities)}
+        
+        try:
+            entity_ids = list(rows)
+            new_rows = []
+            for start in range(0, len(entity_ids), ID_CHUNK_SIZE):
+                chunk_ids = entity_ids[start:start + ID_CHUNK_SIZE]
+                existing = {
+                    item.entity_id: item
+                    for item in self.db.query(EntityMirror).filter(
+                        EntityMirror.entity_type == entity_type,
+                        EntityMirror.entity_id.in_(chunk_ids)
+                    )
+                }
+                for entity_id in chunk_ids:
+                    item = existing.get(entity_id)
+                    if item is None:
+                        new_rows.append(rows[entity_id])
+                        continue
+                    for column, value in rows[entity_id].items():
+                        setattr(item, column, value)
+            
+            if new_rows:
+                self.db.execute(insert(EntityMirror.__table__), new_rows)
+            
+            state.high_water_mark = self._max_date_modify(entities, state.high_water_mark)
+            state.entities_count = state.entities_count + len(new_rows)
+            state.last_delta_sync_at = now
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при синхронизации изменений локальной копии {entity_type}: {e}")
+            self.db.rollback()
+            raise
+        
+        logger.info(f"Синхронизация изменений {entity_type}: получено {len(rows)}, новых {len(new_rows)}")
+        return {'entity_type': entity_type, 'mode': 'delta', 'fetched': len(rows), 'total': state.entities_count}
+    
+    def get_entities(
+        self,
+        entity_type: str,
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Получить сущности из локальной копии в формате Bitrix24
+        
+        Args:
+            entity_type: Тип сущности
+            filter_dict: Фильтр на равенство по полям Bitrix24 (например, {'STAGE_SEMANTIC_ID': 'P'})
+        
+        Returns:
+            Список сущностей {'ID': '...', 'ASSIGNED_BY_ID': '...', ...}, упорядоченный по ID
+        """
+        fields = MIRROR_FIELDS[entity_type]
+        query = self.db.query(EntityMirror).filter(EntityMirror.entity_type == entity_type)
+        for field, value in (filter_dict or {}).items():
+            column = fields.get(field)
+            if column is None:
+                raise ValueError(f"Поле {field} отсутствует в локальной копии {entity_type}")
+            values = value if isinstance(value, list) else [value]
+            if column in INTEGER_COLUMNS:
+                values = [int(v) for v in values]
+            else:
+                values = [str(v) for v in values]
+            query = query.filter(getattr(EntityMirror, column).in_(values))
+        
+        entities = []
+        for item in query.order_by(EntityMirror.entity_id):
+            entity = {'ID': str(item.entity_id)}
+            for field, column in fields.items():
+                value = getattr(item, column)
+                entity[field] = str(value) if value is not None else None
+            entities.append(entity)
+        return entities
+    
+    def apply_updates(self, entity_type: str, updates: List[Dict[str, Any]]):
+        """
+        Записать в копию ответственных, успешно обновленных в Bitrix24
+        
+        Args:
+            entity_type: Тип сущности
+            updates: Список обновлений [{'ID': '...', 'fields': {'ASSIGNED_BY_ID': ...}}]
+        """
+        if entity_type not in MIRROR_FIELDS:
+            return
+        
+        params = [
+            {'b_entity_id': int(u['ID']), 'b_assigned_by_id': int(u['fields']['ASSIGNED_BY_ID'])}
+            for u in updates
+            if 'ASSIGNED_BY_ID' in u.get('fields', {})
+        ]
+        if not params:
+            return
+        
+        statement = (
+            update(EntityMirror.__table__)
+            .where(
+                EntityMirror.__table__.c.entity_type == entity_type,
+                EntityMirror.__table__.c.entity_id == bindparam('b_entity_id')
+            )
+            .values(assigned_by_id=bindparam('b_assigned_by_id'))
+        )
+        self.db.execute(statement, params)
+        self.db.commit()
+    
+    def remove(self, entity_type: str, entity_ids: List[Any]) -> int:
+        """
+        Удалить из копии сущности, которых больше нет в Bitrix24
+        
+        Синхронизация изменений не получает удаленные сущности, поэтому без удаления они
+        оставались бы в копии до полной сверки и снова выбирались бы правилами.
+        
+        Args:
+            entity_type: Тип сущности
+            entity_ids: ID удаленных сущностей
+        
+        Returns:
+            Количество удаленных строк
+        """
+        if entity_type not in MIRROR_FIELDS or not entity_ids:
+            return 0
+        
+        ids = list({int(entity_id) for entity_id in entity_ids})
+        try:
+            removed = 0
+            for start in range(0, len(ids), ID_CHUNK_SIZE):
+                result = self.db.execute(
+                    delete(EntityMirror).where(
+                        EntityMirror.entity_type == entity_type,
+                        EntityMirror.entity_id.in_(ids[start:start + ID_CHUNK_SIZE])
+                    )
+                )
+                removed += result.rowcount or 0
+            if removed:
+                state = self._get_state(entity_type)
+                state.entities_count = max(0, (state.entities_count or 0) - removed)
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сущностей {entity_type} из локальной копии: {e}")
+            self.db.rollback()
+            raise
+        
+        logger.info(f"Из локальной копии {entity_type} удалено {removed} сущностей, не найденных в Bitrix24")
+        return removed
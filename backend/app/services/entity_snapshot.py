@@ -0,0 +1,138 @@
+from typing import List, Optional, Set, Dict, Tuple, Any
+from app.services.bitrix_client import BitrixClient
+import logging
+import json
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+
+class EntitySnapshot:
+    """
+    Снимок сущностей Bitrix24 в рамках одного запуска обновления
+    
+    Правила одного типа сущности с одинаковым фильтром регистрируют нужные им поля,
+    после чего список сущностей запрашивается из Bitrix24 один раз с объединением полей.
+    Каждое правило получает собственный список (представление) поверх общих строк снимка.
+    """
+    
+    def __init__(self, bitrix_client: BitrixClient):
+        self.bitrix_client = bitrix_client
+        self._requested_fields: Dict[Tuple[str, str], Set[str]] = {}
+        self._fetched_fields: Dict[Tuple[str, str], Set[str]] = {}
+        self._rows: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._index: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._registrations: Dict[Tuple[str, str], int] = {}
+    
+    @staticmethod
+    def _make_key(entity_type: str, filter_dict: Optional[Dict[str, Any]]) -> Tuple[str, str]:
+        """Сформировать ключ снимка по типу сущности и фильтру"""
+        return entity_type, json.dumps(filter_dict or {}, sort_keys=True, default=str)
+    
+    def register(
+        self,
+        entity_type: str,
+        fields: List[str],
+        filter_dict: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Зарегистрировать поля, которые понадобятся правилу
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company)
+            fields: Список полей для запроса
+            filter_dict: Фильтр для запроса сущностей
+        """
+        key = self._make_key(entity_type, filter_dict)
+        self._requested_fields.setdefault(key, set()).update(fields)
+        self._registrations[key] = self._registrations.get(key, 0) + 1
+    
+    def is_shared(self, entity_type: str, filter_dict: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Проверить, зарегистрировано ли несколько правил с этим типом сущности и фильтром
+        
+        Строки снимка имеет смысл хранить только для общих выборок, остальные правила
+        могут получать сущности потоком (BitrixClient.iter_entities).
+        """
+        return self._registrations.get(self._make_key(entity_type, filter_dict), 0) > 1
+    
+    async def get_entities(
+        self,
+        entity_type: str,
+        fields: List[str],
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Получить сущности из снимка (запрос в Bitrix24 выполняется только при первом обращении)
+        
+        Если запрошены поля, которых нет в уже загруженном снимке, снимок загружается повторно
+        с объединением всех известных полей.
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company)
+            fields: Список полей, необходимых вызывающему коду
+            filter_dict: Фильтр для запроса сущностей
+        
+        Returns:
+            Новый список с общими строками снимка
+        """
+        key = self._make_key(entity_type, filter_dict)
+        requested = self._requested_fields.setdefault(key, set())
+        requested.update(fields)
+        
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            fetched = self._fetched_fields.get(key)
+            if fetched is None or not requested.issubset(fetched):
+                select = sorted(requested)
+                logger.info(f"Загрузка снимка сущностей {entity_type} (фильтр: {filter_dict}) с полями: {select}")
+                rows = await self.bitrix_client.get_entities_list(
+                    entity_type,
+                    select=select,
+                    filter_dict=filter_dict
+                )
+                rows = rows or []
+                self._rows[key] = rows
+                self._index[key] = {row['ID']: row for row in rows if 'ID' in row}
+                self._fetched_fields[key] = set(select)
+                logger.info(f"Снимок сущностей {entity_type}: загружено {len(rows)} сущностей")
+        
+        return list(self._rows[key])
+    
+    def apply_updates(self, entity_type: str, updates: List[Dict[str, Any]]):
+        """
+        Применить успешно записанные в Bitrix24 изменения к строкам снимка
+        
+        Следующие правила того же запуска видят актуальные значения (например, ASSIGNED_BY_ID)
+        без повторной загрузки списка. Если измененное поле участвует в фильтре снимка,
+        состав выборки мог измениться, поэтому такой снимок сбрасывается и будет загружен заново.
+        
+        Args:
+            entity_type: Тип сущности
+            updates: Список обновлений [{'ID': '...', 'fields': {...}}]
+        """
+        updated_fields = set()
+        for update in updates:
+            updated_fields.update(update.get('fields', {}))
+        
+        for key in list(self._index):
+            if key[0] != entity_type:
+                continue
+            
+            filter_fields = {name.lstrip('!<>=%@') for name in json.loads(key[1])}
+            if filter_fields.intersection(updated_fields):
+                logger.debug(f"Сброс снимка сущностей {entity_type} (фильтр: {key[1]}): изменены поля фильтра")
+                del self._index[key]
+                del self._rows[key]
+                del self._fetched_fields[key]
+                continue
+            
+            index = self._index[key]
+            for update in updates:
+                row = index.get(str(update.get('ID')))
+                if row is None:
+                    continue
+                for field, value in update.get('fields', {}).items():
+                    if field in row:
+                        row[field] = str(value) if value is not None else None
@@ -0,0 +1,114 @@
+from typing import List, Dict, Any, Optional
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from app.models import UpdateHistory
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Колонки истории, которые заполняются при записи (created_at заполняется базой данных)
+HISTORY_COLUMNS = (
+    'entity_type',
+    'entity_id',
+    'old_assigned_by_id',
+    'new_assigned_by_id',
+    'update_source',
+    'rule_id',
+    'related_entity_type',
+    'related_entity_id',
+)
+
+
+class HistoryWriter:
+    """
+    Пакетная запись истории изменений ответственных (UpdateHistory)
+    
+    Записи накапливаются в буфере и вставляются через SQLAlchemy Core insert() в режиме executemany
+    частями по chunk_size строк, без создания ORM объектов на каждую запись. Многострочный
+    insert().values([...]) не используется: его SQL компилируется заново для каждой части и на SQLite
+    работает медленнее построчного ORM.
+    Используется при обновлении по планировщику, ручном обновлении и обработке webhook.
+    """
+    
+    # Размер части вставки (ограничивает объем одного executemany)
+    DEFAULT_CHUNK_SIZE = 1000
+    
+    def __init__(self, db: Session, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self._buffer: List[Dict[str, Any]] = []
+    
+    def __len__(self) -> int:
+        return len(self._buffer)
+    
+    def add(
+        self,
+        entity_type: str,
+        entity_id: int,
+        new_assigned_by_id: int,
+        update_source: Any,
+        old_assigned_by_id: Optional[int] = None,
+        rule_id: Optional[int] = None,
+        related_entity_type: Optional[str] = None,
+        related_entity_id: Optional[int] = None
+    ):
+        """
+        Добавить запись истории в буфер
+        
+        Args:
+            entity_type: Тип сущности (deal, contact, company)
+            entity_id: ID сущности
+            new_assigned_by_id: Новый ответственный
+            update_source: Источник обновления (UpdateSource)
+            old_assigned_by_id: Предыдущий ответственный
+            rule_id: ID правила
+            related_entity_type: Тип связанной сущности (для контактов и компаний сделки)
+            related_entity_id: ID связанной сущности
+        """
+        self._buffer.append({
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'old_assigned_by_id': old_assigned_by_id,
+            'new_assigned_by_id': new_assigned_by_id,
+            'update_source': update_source,
+            'rule_id': rule_id,
+            'related_entity_type': related_entity_type,
+            'related_entity_id': related_entity_id,
+        })
+    
+    def extend(self, entries: List[Dict[str, Any]]):
+        """
+        Добавить в буфер готовые записи истории (словари с полями UpdateHistory)
+        
+        Args:
+            entries: Список записей истории
+        """
+        for entry in entries:
+            self._buffer.append({column: entry.get(column) for column in HISTORY_COLUMNS})
+    
+    def flush(self, commit: bool = True) -> int:
+        """
+        Вставить накопленные записи в базу данных
+        
+        Args:
+            commit: Зафиксировать транзакцию после вставки
+        
+        Returns:
+            Количество вставленных записей
+        """
+        if not self._buffer:
+            if commit:
+                self.db.commit()
+            return 0
+        
+        rows = self._buffer
+        self._buffer = []
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            self.db.execute(insert(UpdateHistory.__table__), chunk)
+        
+        if commit:
+            self.db.commit()
+        
+        logger.debug(f"Записано {len(rows)} записей истории изменений")
+        return len(rows)
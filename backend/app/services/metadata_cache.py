@@ -0,0 +1,494 @@
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable
+from app.models import FieldMapping, MetadataItem, MetadataCacheState
+from app.services.bitrix_client import get_bitrix_client
+from app.config import settings
+import copy
+import hashlib
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Типы метаданных (первая часть ключа кэша)
+KIND_FIELDS = 'fields'
+KIND_STATUSES = 'statuses'
+KIND_CATEGORIES = 'categories'
+
+# Маппинг типов сущностей на entityTypeId Bitrix24
+ENTITY_TYPE_IDS = {
+    'lead': 1,
+    'deal': 2,
+    'contact': 3,
+    'company': 4,
+}
+
+
+def content_hash(data: Any) -> str:
+    """Хэш содержимого (JSON с сортировкой ключей), не зависящий от порядка ключей"""
+    serialized = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def normalize_status(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Привести статус или стадию из crm.status.list к виду {'id', 'name', 'semantics', 'sort'}
+    
+    Поддерживаются оба формата ответа: STATUS_ID, NAME, EXTRA.SEMANTICS и id, name, semantics.
+    
+    Returns:
+        Словарь значения или None, если у статуса нет ID
+    """
+    status_id = item.get('STATUS_ID') or item.get('id') or item.get('ID')
+    if not status_id:
+        return None
+    extra = item.get('EXTRA')
+    semantics = item.get('semantics') or (
+        extra.get('SEMANTICS') if isinstance(extra, dict) else item.get('SEMANTICS')
+    )
+    sort = item.get('SORT') or item.get('sort')
+    return {
+        'id': str(status_id),
+        'name': item.get('NAME') or item.get('name'),
+        'semantics': semantics,
+        'sort': int(sort) if sort not in (None, '') else None,
+    }
+
+
+def normalize_category(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Привести категорию из crm.category.list к виду {'id', 'name', 'semantics', 'sort'}
+    
+    Returns:
+        Словарь значения или None, если у категории нет ID
+    """
+    category_id = item.get('id', item.get('ID'))
+    if category_id is None:
+        return None
+    sort = item.get('sort')
+    return {
+        'id': str(category_id),
+        'name': item.get('name') or item.get('NAME'),
+        'semantics': None,
+        'sort': int(sort) if sort not in (None, '') else None,
+    }
+
+
+def sort_values(values: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Упорядочить значения справочника по sort (значения без sort - в конце, порядок Bitrix24 сохраняется)"""
+    return sorted(values, key=lambda value: (value['sort'] is None, value['sort'] or 0))
+
+
+class MetadataCache:
+    """
+    Кэш метаданных Bitrix24 с чтением через кэш: поля сущностей, статусы и стадии, категории
+    
+    Уровни чтения:
+    1. Память процесса со сроком жизни METADATA_CACHE_TTL_SECONDS;
+    2. База данных (FieldMapping, MetadataItem), если набор загружался из Bitrix24 не раньше срока жизни
+       (MetadataCacheState.checked_at);
+    3. Bitrix24. Если хэш набора не изменился, обновляется только отметка checked_at; иначе
+       перезаписываются только строки с изменившимся хэшем, новые добавляются, исчезнувшие удаляются.
+    Если Bitrix24 недоступен, возвращается устаревший набор из базы данных (если он есть).
+    Экземпляр общий для процесса (get_metadata_cache); сессия базы данных передается в каждый вызов.
+    """
+    
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        self.ttl_seconds = settings.metadata_cache_ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._lock = threading.Lock()
+        # {ключ кэша: (время истечения monotonic, значение)}
+        self._memory: Dict[str, Tuple[float, Any]] = {}
+        self._stats = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'bitrix_loads': 0,
+            'unchanged_loads': 0,
+            'stale_fallbacks': 0,
+        }
+    
+    def _increment(self, counter: str):
+        with self._lock:
+            self._stats[counter] += 1
+    
+    def _memory_get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._memory[key]
+                return None
+            self._stats['memory_hits'] += 1
+            return entry[1]
+    
+    def _memory_set(self, key: str, value: Any):
+        with self._lock:
+            self._memory[key] = (time.monotonic() + self.ttl_seconds, value)
+    
+    def invalidate(self, key: Optional[str] = None):
+        """
+        Сбросить значения в памяти процесса
+        
+        Args:
+            key: Ключ кэша (по умолчанию - все ключи)
+        """
+        with self._lock:
+            if key is None:
+                self._memory.clear()
+            else:
+                self._memory.pop(key, None)
+    
+    def _is_fresh(self, state: Optional[MetadataCacheState], now: datetime) -> bool:
+        """Проверить, что набор загружался из Bitrix24 не раньше срока жизни кэша"""
+        if state is None or state.checked_at is None:
+            return False
+        checked_at = state.checked_at
+        if checked_at.tzinfo is None:
+            checked_at = checked_at.replace(tzinfo=timezone.utc)
+        return now - checked_at < timedelta(seconds=self.ttl_seconds)
+    
+    async def _read_through(
+        self,
+        db: Session,
+        key: str,
+        load_db: Callable[[], Any],
+        fetch_bitrix: Callable[[], Awaitable[Any]],
+        store: Callable[[Any], int],
+        force: bool = False
+    ) -> Any:
+        """
+        Прочитать набор метаданных через кэш
+        
+        Args:
+            db: Сессия базы данных
+            key: Ключ кэша
+            load_db: Загрузка набора из базы данных
+            fetch_bitrix: Загрузка набора из Bitrix24 (возвращает нормализованный набор)
+            store: Запись изменившихся строк набора в базу данных (возвращает количество измененных строк)
+            force: Загрузить из Bitrix24 независимо от срока жизни
+        
+        Returns:
+            Набор метаданных
+        """
+        if not force:
+            value = self._memory_get(key)
+            if value is not None:
+                return copy.deepcopy(value)
+        
+        now = datetime.now(timezone.utc)
+        state = db.query(MetadataCacheState).filter(MetadataCacheState.cache_key == key).first()
+        if not force and self._is_fresh(state, now):
+            value = load_db()
+            self._increment('db_hits')
+            self._memory_set(key, value)
+            return copy.deepcopy(value)
+        
+        try:
+            value = await fetch_bitrix()
+        except Exception as e:
+            if state is None:
+                raise
+            logger.warning(f"Не удалось обновить метаданные {key} из Bitrix24, используется кэш базы данных: {e}")
+            self._increment('stale_fallbacks')
+            return load_db()
+        self._increment('bitrix_loads')
+        
+        if state is None:
+            state = MetadataCacheState(cache_key=key, items_count=0)
+            db.add(state)
+        
+        value_hash = content_hash(value)
+        if state.content_hash == value_hash:
+            self._increment('unchanged_loads')
+        else:
+            changed = store(value)
+            state.content_hash = value_hash
+            state.changed_at = now
+            logger.info(f"Метаданные {key} изменились в Bitrix24: записано строк {changed}")
+        state.items_count = len(value)
+        state.checked_at = now
+        
+        try:
+            db.commit()
+        except Exception as e:
+            # Например, тот же набор одновременно записан другим запросом: данные из Bitrix24 актуальны
+            db.rollback()
+            logger.error(f"Ошибка при сохранении метаданных {key}: {e}")
+        
+        self._memory_set(key, value)
+        return copy.deepcopy(value)
+    
+    async def get_entity_fields(self, db: Session, entity_type: str, force: bool = False) -> Dict[str, Any]:
+        """
+        Получить поля сущности (ответ crm.*.fields)
+        
+        Args:
+            db: Сессия базы данных
+            entity_type: Тип сущности (deal, contact, company, lead)
+            force: Загрузить из Bitrix24 независимо от срока жизни
+        
+        Returns:
+            Словарь {ID поля: описание поля}
+        """
+        async def fetch_bitrix():
+            return await get_bitrix_client().get_entity_fields(entity_type)
+        
+        return await self._read_through(
+            db,
+            f"{KIND_FIELDS}:{entity_type}",
+            lambda: self._load_fields(db, entity_type),
+            fetch_bitrix,
+            lambda fields: self._store_fields(db, entity_type, fields),
+            force
+        )
+    
+    @staticmethod
+    def get_fields_cached_at(db: Session, entity_type: str) -> Optional[datetime]:
+        """
+        Получить время последней загрузки полей сущности из Bitrix24
+        
+        Args:
+            db: Сессия базы данных
+            entity_type: Тип сущности
+        
+        Returns:
+            Время загрузки или None, если поля еще не загружались
+        """
+        state = db.query(MetadataCacheState).filter(
+            MetadataCacheState.cache_key == f"{KIND_FIELDS}:{entity_type}"
+        ).first()
+        return state.checked_at if state else None
+    
+    async def get_statuses(self, db: Session, status_entity_id: str, force: bool = False) -> List[Dict[str, Any]]:
+        """
+        Получить статусы или стадии (crm.status.list) для ENTITY_ID
+        
+        Args:
+            db: Сессия базы данных
+            status_entity_id: ENTITY_ID (например, DEAL_STAGE, DEAL_STAGE_3, SOURCE)
+            force: Загрузить из Bitrix24 независимо от срока жизни
+        
+        Returns:
+            Список значений {'id', 'name', 'semantics', 'sort'}
+        """
+        async def fetch_bitrix():
+            statuses = await get_bitrix_client().get_status_list(status_entity_id)
+            return sort_values([value for value in (normalize_status(item) for item in statuses) if value])
+        
+        return await self._read_through(
+            db,
+            f"{KIND_STATUSES}:{status_entity_id}",
+            lambda: self._load_items(db, KIND_STATUSES, status_entity_id),
+            fetch_bitrix,
+            lambda values: self._store_items(db, KIND_STATUSES, status_entity_id, values),
+            force
+        )
+    
+    async def get_category_stages(
+        self,
+        db: Session,
+        category_id: int,
+        force: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Получить стадии воронки сделок (DEAL_STAGE для нулевой воронки, DEAL_STAGE_{ID} для остальных)
+        
+        Args:
+            db: Сессия базы данных
+            category_id: ID воронки
+            force: Загрузить из Bitrix24 независимо от срока жизни
+        
+        Returns:
+            Список значений {'id', 'name', 'semantics', 'sort'}
+        """
+        status_entity_id = 'DEAL_STAGE' if category_id == 0 else f'DEAL_STAGE_{category_id}'
+        return await self.get_statuses(db, status_entity_id, force)
+    
+    async def get_categories(self, db: Session, entity_type_id: int, force: bool = False) -> List[Dict[str, Any]]:
+        """
+        Получить категории (воронки) типа сущности
+        
+        Args:
+            db: Сессия базы данных
+            entity_type_id: entityTypeId (1 - Лиды, 2 - Сделки, 3 - Контакты, 4 - Компании)
+            force: Загрузить из Bitrix24 независимо от срока жизни
+        
+        Returns:
+            Список значений {'id', 'name', 'semantics', 'sort'}
+        """
+        async def fetch_bitrix():
+            categories = await get_bitrix_client().get_category_list(entity_type_id)
+            return sort_values([value for value in (normalize_category(item) for item in categories) if value])
+        
+        scope = str(entity_type_id)
+        return await self._read_through(
+            db,
+            f"{KIND_CATEGORIES}:{scope}",
+            lambda: self._load_items(db, KIND_CATEGORIES, scope),
+            fetch_bitrix,
+            lambda values: self._store_items(db, KIND_CATEGORIES, scope, values),
+            force
+        )
+    
+    async def refresh(self, db: Session) -> Dict[str, Any]:
+        """
+        Загрузить из Bitrix24 все наборы, которые уже есть в кэше
+        
+        Args:
+            db: Сессия базы данных
+        
+        Returns:
+            Словарь {'refreshed': количество наборов, 'changed': [ключи изменившихся наборов], 'errors': {ключ: ошибка}}
+        """
+        self.invalidate()
+        states = db.query(MetadataCacheState).order_by(MetadataCacheState.cache_key).all()
+        previous_hashes = {state.cache_key: state.content_hash for state in states}
+        
+        refreshed = 0
+        errors = {}
+        for key in previous_hashes:
+            kind, _, scope = key.partition(':')
+            try:
+                if kind == KIND_FIELDS:
+                    await self.get_entity_fields(db, scope, force=True)
+                elif kind == KIND_STATUSES:
+                    await self.get_statuses(db, scope, force=True)
+                elif kind == KIND_CATEGORIES:
+                    await self.get_categories(db, int(scope), force=True)
+                else:
+                    continue
+                refreshed += 1
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении метаданных {key}: {e}")
+                errors[key] = str(e)
+        
+        current_hashes = {
+            state.cache_key: state.content_hash
+            for state in db.query(MetadataCacheState).all()
+        }
+        changed = [key for key, value in previous_hashes.items() if current_hashes.get(key) != value]
+        logger.info(f"Метаданные Bitrix24 обновлены: наборов {refreshed}, изменилось {len(changed)}")
+        return {
+            'refreshed': refreshed,
+            'changed': changed,
+            'errors': errors,
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить счетчики кэша"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_keys'] = len(self._memory)
+        stats['ttl_seconds'] = self.ttl_seconds
+        return stats
+    
+    @staticmethod
+    def _load_fields(db: Session, entity_type: str) -> Dict[str, Any]:
+        """Загрузить поля сущности из FieldMapping"""
+        mappings = db.query(FieldMapping).filter(
+            FieldMapping.entity_type == entity_type
+        ).order_by(FieldMapping.id).all()
+        
+        fields = {}
+        for mapping in mappings:
+            if mapping.field_data:
+                fields[mapping.field_id] = json.loads(mapping.field_data)
+            else:
+                # Строки, записанные до появления field_data
+                fields[mapping.field_id] = {'type': mapping.field_type, 'title': mapping.field_name}
+        return fields
+    
+    @staticmethod
+    def _store_fields(db: Session, entity_type: str, fields: Dict[str, Any]) -> int:
+        """Записать изменившиеся поля сущности в FieldMapping (без фиксации транзакции)"""
+        existing = {
+            mapping.field_id: mapping
+            for mapping in db.query(FieldMapping).filter(FieldMapping.entity_type == entity_type).all()
+        }
+        
+        changed = 0
+        now = datetime.now(timezone.utc)
+        for field_id, field_data in fields.items():
+            field_hash = content_hash(field_data)
+            mapping = existing.pop(field_id, None)
+            if mapping is not None and mapping.content_hash == field_hash:
+                continue
+            if mapping is None:
+                mapping = FieldMapping(entity_type=entity_type, field_id=field_id)
+                db.add(mapping)
+            mapping.field_name = field_data.get('listLabel') or field_data.get('title') or field_id
+            mapping.field_type = field_data.get('type', 'string')
+            mapping.field_data = json.dumps(field_data, ensure_ascii=False)
+            mapping.content_hash = field_hash
+            mapping.cached_at = now
+            changed += 1
+        
+        for mapping in existing.values():
+            db.delete(mapping)
+            changed += 1
+        return changed
+    
+    @staticmethod
+    def _load_items(db: Session, kind: str, scope: str) -> List[Dict[str, Any]]:
+        """Загрузить значения справочника из MetadataItem"""
+        items = db.query(MetadataItem).filter(
+            MetadataItem.kind == kind,
+            MetadataItem.scope == scope
+        ).order_by(MetadataItem.id).all()
+        return sort_values([
+            {
+                'id': item.item_id,
+                'name': item.name,
+                'semantics': item.semantics,
+                'sort': item.sort,
+            }
+            for item in items
+        ])
+    
+    @staticmethod
+    def _store_items(db: Session, kind: str, scope: str, values: List[Dict[str, Any]]) -> int:
+        """Записать изменившиеся значения справочника в MetadataItem (без фиксации транзакции)"""
+        existing = {
+            item.item_id: item
+            for item in db.query(MetadataItem).filter(
+                MetadataItem.kind == kind,
+                MetadataItem.scope == scope
+            ).all()
+        }
+        
+        changed = 0
+        for value in values:
+            value_hash = content_hash(value)
+            item = existing.pop(value['id'], None)
+            if item is not None and item.content_hash == value_hash:
+                continue
+            if item is None:
+                item = MetadataItem(kind=kind, scope=scope, item_id=value['id'])
+                db.add(item)
+            item.name = value['name']
+            item.semantics = value['semantics']
+            item.sort = value['sort']
+            item.content_hash = value_hash
+            changed += 1
+        
+        for item in existing.values():
+            db.delete(item)
+            changed += 1
+        return changed
+
+
+_metadata_cache: Optional[MetadataCache] = None
+_metadata_cache_lock = threading.Lock()
+
+
+def get_metadata_cache() -> MetadataCache:
+    """Получить общий для процесса кэш метаданных Bitrix24"""
+    global _metadata_cache
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                _metadata_cache = MetadataCache()
+    return _metadata_cache
@@ -0,0 +1,221 @@
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from typing import Dict, Any, Optional, Iterable, Callable, List
+from app.database import SessionLocal
+from app.models import WebhookRuleCursor
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def next_user_id(user_ids: List[int], last_user_id: Optional[int]) -> int:
+    """
+    Выбрать следующего пользователя по кругу
+    
+    Следующий - пользователь с наименьшим ID больше последнего назначенного, после самого
+    большого ID - снова первый. Если последний назначенный пользователь убран из графика
+    в течение дня, очередь продолжается со следующего за ним ID, а не с начала списка.
+    
+    Args:
+        user_ids: ID дежурных пользователей правила, отсортированные по возрастанию
+        last_user_id: ID последнего назначенного пользователя (None - назначений не было)
+    
+    Returns:
+        ID пользователя для назначения
+    """
+    if last_user_id is not None:
+        for user_id in user_ids:
+            if user_id > last_user_id:
+                return user_id
+    return user_ids[0]
+
+
+class CursorReservation:
+    """
+    Пользователь, выбранный курсором правила, но еще не зафиксированный (RuleCursorRegistry.peek)
+    
+    user_id - пользователь для назначения, previous_user_id - значение курсора, от которого
+    выполнен выбор (ожидаемое значение при фиксации).
+    """
+    
+    def __init__(self, rule_id: int, user_id: int, previous_user_id: Optional[int]):
+        self.rule_id = rule_id
+        self.user_id = user_id
+        self.previous_user_id = previous_user_id
+
+
+class RuleCursorRegistry:
+    """
+    Курсоры поочередного распределения сделок webhook по правилам
+    
+    Для каждого правила хранится последний назначенный пользователь (таблица webhook_rule_cursors)
+    и его копия в памяти процесса. Назначение выполняется в два шага:
+    - peek выбирает следующего пользователя без записи в базу данных и резервирует его в памяти
+      процесса, чтобы одновременные обработчики событий того же правила получили следующих по кругу;
+    - commit после успешного обновления сделки фиксирует курсор одним UPDATE с проверкой прежнего
+      значения (compare-and-set) в отдельной сессии, release отменяет резерв, если назначения
+      не было (ответственный уже правильный или обновление сделки не удалось).
+    Поэтому пропущенные и неудачные обновления не расходуют очередь. Если курсор тем временем
+    продвинул другой процесс, фиксация пропускается и значение перечитывается из базы данных.
+    Экземпляр общий для процесса (get_rule_cursor_registry).
+    """
+    
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal):
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        # {ID правила: ID последнего назначенного пользователя по базе данных (None - назначений не было)}
+        self._cursors: Dict[int, Optional[int]] = {}
+        # {ID правила: ID последнего зарезервированного пользователя} и количество незавершенных резервов
+        self._heads: Dict[int, Optional[int]] = {}
+        self._reserved: Dict[int, int] = {}
+        self._stats = {
+            'advances': 0,
+            'released': 0,
+            'loads': 0,
+            'conflicts': 0,
+        }
+    
+    def _load_locked(self, db: Session, rule_id: int) -> Optional[int]:
+        """Прочитать курсор правила из базы данных в память (вызывается под блокировкой)"""
+        cursor = db.get(WebhookRuleCursor, rule_id)
+        self._stats['loads'] += 1
+        self._cursors[rule_id] = cursor.last_user_id if cursor is not None else None
+        return self._cursors[rule_id]
+    
+    def _finish_locked(self, rule_id: int):
+        """Завершить резерв: без незавершенных резервов следующий выбор идет от значения курсора"""
+        left = self._reserved.get(rule_id, 0) - 1
+        if left > 0:
+            self._reserved[rule_id] = left
+        else:
+            self._reserved.pop(rule_id, None)
+            self._heads.pop(rule_id, None)
+    
+    def peek(self, rule_id: int, user_ids: Iterable[int]) -> CursorReservation:
+        """
+        Выбрать следующего пользователя правила без фиксации курсора
+        
+        Args:
+            rule_id: ID правила
+            user_ids: ID дежурных пользователей правила (текущий график)
+        
+        Returns:
+            CursorReservation (передается в commit или release)
+        """
+        candidates = sorted(set(user_ids))
+        if not candidates:
+            raise ValueError(f"Нет пользователей для курсора правила {rule_id}")
+        
+        with self._lock:
+            if rule_id not in self._cursors:
+                db = self.session_factory()
+                try:
+                    self._load_locked(db, rule_id)
+                finally:
+                    db.close()
+            
+            previous_user_id = self._heads[rule_id] if rule_id in self._heads else self._cursors[rule_id]
+            user_id = next_user_id(candidates, previous_user_id)
+            self._heads[rule_id] = user_id
+            self._reserved[rule_id] = self._reserved.get(rule_id, 0) + 1
+        return CursorReservation(rule_id, user_id, previous_user_id)
+    
+    def release(self, reservation: CursorReservation):
+        """
+        Отменить резерв: пользователь не был назначен
+        
+        Args:
+            reservation: Результат peek
+        """
+        with self._lock:
+            if self._heads.get(reservation.rule_id) == reservation.user_id:
+                self._heads[reservation.rule_id] = reservation.previous_user_id
+            self._stats['released'] += 1
+            self._finish_locked(reservation.rule_id)
+    
+    def commit(self, reservation: CursorReservation) -> bool:
+        """
+        Зафиксировать назначение пользователя из резерва (после успешного обновления сделки)
+        
+        Args:
+            reservation: Результат peek
+        
+        Returns:
+            True, если курсор продвинут; False, если курсор тем временем изменен другим процессом
+            или удален вместе с правилом (значение перечитано из базы данных)
+        """
+        rule_id = reservation.rule_id
+        with self._lock:
+            db = self.session_factory()
+            try:
+                if reservation.previous_user_id is None:
+                    db.add(WebhookRuleCursor(rule_id=rule_id, last_user_id=reservation.user_id, assignments=1))
+                    try:
+                        db.commit()
+                        updated = 1
+                    except IntegrityError:
+                        # Курсор создан другим процессом
+                        db.rollback()
+                        updated = 0
+                else:
+                    updated = db.query(WebhookRuleCursor).filter(
+                        WebhookRuleCursor.rule_id == rule_id,
+                        WebhookRuleCursor.last_user_id == reservation.previous_user_id
+                    ).update({
+                        WebhookRuleCursor.last_user_id: reservation.user_id,
+                        WebhookRuleCursor.assignments: WebhookRuleCursor.assignments + 1,
+                        WebhookRuleCursor.updated_at: func.now(),
+                    }, synchronize_session=False)
+                    db.commit()
+                
+                if updated:
+                    self._cursors[rule_id] = reservation.user_id
+                    self._stats['advances'] += 1
+                else:
+                    self._stats['conflicts'] += 1
+                    current = self._load_locked(db, rule_id)
+                    logger.info(
+                        f"Курсор правила {rule_id} изменен другим обработчиком: назначен пользователь "
+                        f"{reservation.user_id}, в курсоре {current}"
+                    )
+                return bool(updated)
+            finally:
+                db.close()
+                self._finish_locked(rule_id)
+    
+    def forget(self, db: Session, rule_id: int):
+        """
+        Удалить курсор правила (при удалении правила, фиксируется вызывающим вместе с удалением правила)
+        
+        Args:
+            db: Сессия базы данных
+            rule_id: ID правила
+        """
+        db.query(WebhookRuleCursor).filter(WebhookRuleCursor.rule_id == rule_id).delete(synchronize_session=False)
+        with self._lock:
+            self._cursors.pop(rule_id, None)
+            self._heads.pop(rule_id, None)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить счетчики курсоров, последних назначенных пользователей и незавершенных резервов в памяти"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cursors'] = dict(self._cursors)
+            stats['reserved'] = dict(self._reserved)
+        return stats
+
+
+_rule_cursor_registry: Optional[RuleCursorRegistry] = None
+_rule_cursor_registry_lock = threading.Lock()
+
+
+def get_rule_cursor_registry() -> RuleCursorRegistry:
+    """Получить общие для процесса курсоры распределения сделок webhook"""
+    global _rule_cursor_registry
+    if _rule_cursor_registry is None:
+        with _rule_cursor_registry_lock:
+            if _rule_cursor_registry is None:
+                _rule_cursor_registry = RuleCursorRegistry()
+    return _rule_cursor_registry
@@ -1,10 +1,51 @@
-from typing import List, Dict, Any, Set, Optional
+from typing import List, Dict, Any, Set, Optional, Tuple, Callable, AsyncIterator, AsyncGenerator
 from app.models import UpdateRule
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Типы полей Bitrix24, для которых сравнение > / < в фильтре совпадает с числовым сравнением в Python
+NUMERIC_FIELD_TYPES = {'integer', 'double'}
+
+# Предикат сущности: возвращает True, если сущность проходит условие
+EntityPredicate = Callable[[Dict[str, Any]], bool]
+
+# Кэш скомпилированных условий: {(тип условия, конфигурация в JSON с сортировкой ключей): предикат}
+_compiled_conditions: Dict[Tuple[str, str], EntityPredicate] = {}
+
+# Ключи кэша условий, скомпилированных для правил: {rule_id: {ключ}} (для удаления вместе с правилом)
+_rule_condition_keys: Dict[int, Set[Tuple[str, str]]] = {}
+
+# Типы полей Bitrix24, для которых поиск по подстроке (%) можно использовать для сужения выборки
+STRING_FIELD_TYPES = {'string'}
+
+
+class RuleFilterPushdown:
+    """
+    Результат переноса условий правила в фильтр запроса Bitrix24
+    
+    filter_dict - условия для параметра filter метода *.list.
+    residual_rule_type / residual_config - часть правила, которую нужно проверить в Python
+    (None - правило полностью выполнено фильтром Bitrix24).
+    pushed - описание перенесенных условий, residual - описание условий, оставшихся в Python.
+    
+    Перенесенные условия либо точно совпадают с проверкой в Python, либо только сужают выборку
+    (тогда условие остается и в residual_config), поэтому итоговый набор сущностей не меняется.
+    """
+    
+    def __init__(self):
+        self.filter_dict: Dict[str, Any] = {}
+        self.residual_rule_type: Optional[str] = None
+        self.residual_config: Optional[Dict[str, Any]] = None
+        self.pushed: List[str] = []
+        self.residual: List[str] = []
+    
+    @property
+    def fully_pushed(self) -> bool:
+        """Правило полностью выполняется фильтром Bitrix24"""
+        return self.residual_rule_type is None
+
 
 class RuleEngine:
     """Движок выполнения правил обновления для фильтрации сущностей"""
@@ -38,9 +79,9 @@ class RuleEngine:
                 continue
             
             try:
-                condition_config = json.loads(rule.condition_config) if isinstance(rule.condition_config, str) else rule.condition_config
+                predicate = self.compile_rule(rule)
                 logger.info(f"Применение правила {rule.id} ({rule.entity_name}, тип: {rule.rule_type}): было {len(filtered_entities)} сущностей")
-                filtered_entities = self._apply_rule(filtered_entities, rule.rule_type, condition_config)
+                filtered_entities = [e for e in filtered_entities if predicate(e)]
                 logger.info(f"Правило {rule.id} ({rule.rule_type}) отфильтровало до {len(filtered_entities)} сущностей")
             except Exception as e:
                 logger.error(f"Ошибка при применении правила {rule.id}: {e}", exc_info=True)
@@ -48,11 +89,383 @@ class RuleEngine:
         
         return filtered_entities
     
+    @classmethod
+    def compile_rule(cls, rule: UpdateRule) -> EntityPredicate:
+        """
+        Получить скомпилированный предикат правила
+        
+        Предикат берется из кэша условий (compile_cached), поэтому после изменения условий
+        правила компилируется заново независимо от updated_at.
+        
+        Args:
+            rule: Правило обновления
+        
+        Returns:
+            Предикат сущности
+        """
+        condition_config = json.loads(rule.condition_config) if isinstance(rule.condition_config, str) else rule.condition_config
+        return cls.compile_cached(rule.rule_type, condition_config, rule_id=rule.id)
+    
+    @classmethod
+    def compile_cached(
+        cls,
+        rule_type: str,
+        condition_config: Dict[str, Any],
+        rule_id: Optional[int] = None
+    ) -> EntityPredicate:
+        """
+        Получить скомпилированный предикат условия из кэша
+        
+        Ключ кэша - тип условия и конфигурация, сериализованная в JSON с сортировкой ключей:
+        одинаковые условия (в том числе остаток правила после переноса в фильтр Bitrix24)
+        компилируются один раз, измененное условие получает новый ключ.
+        
+        Args:
+            rule_type: Тип условия (assigned_by_condition, field_condition, combined)
+            condition_config: Конфигурация условия
+            rule_id: ID правила, для которого компилируется условие (ключ удаляется в forget_rule)
+        
+        Returns:
+            Предикат сущности
+        """
+        try:
+            key = (rule_type, json.dumps(condition_config, sort_keys=True, default=str))
+        except (TypeError, ValueError):
+            return cls.compile_condition(rule_type, condition_config)
+        
+        predicate = _compiled_conditions.get(key)
+        if predicate is None:
+            predicate = cls.compile_condition(rule_type, condition_config)
+            _compiled_conditions[key] = predicate
+        if rule_id is not None:
+            _rule_condition_keys.setdefault(rule_id, set()).add(key)
+        return predicate
+    
+    @staticmethod
+    def forget_rule(rule_id: int):
+        """
+        Удалить из кэша условия, скомпилированные для правила (при изменении и удалении правила)
+        
+        Args:
+            rule_id: ID правила
+        """
+        for key in _rule_condition_keys.pop(rule_id, ()):
+            _compiled_conditions.pop(key, None)
+    
+    @staticmethod
+    def compile_pushdown(
+        rule: UpdateRule,
+        field_types: Optional[Dict[str, str]] = None,
+        base_filter: Optional[Dict[str, Any]] = None
+    ) -> RuleFilterPushdown:
+        """
+        Перенести условия правила в фильтр запроса Bitrix24
+        
+        Переносятся:
+        - assigned_by_condition (equals/in -> ASSIGNED_BY_ID, not_equals/not_in -> !ASSIGNED_BY_ID)
+        - условия по воронкам и стадиям (CATEGORY_ID, STAGE_ID)
+        - greater_than / less_than для числовых полей (>FIELD, <FIELD)
+        - contains для строковых полей (%FIELD) - только сужение, проверка остается в Python
+        - условия combined с логикой AND (каждое условие отдельно)
+        Условия combined с логикой OR выполняются только в Python.
+        
+        Args:
+            rule: Правило обновления
+            field_types: Типы полей сущности {field_id: field_type} из кэша полей Bitrix24
+            base_filter: Фильтр, который уже используется для запроса (его ключи не перезаписываются)
+        
+        Returns:
+            Результат переноса условий
+        """
+        pushdown = RuleFilterPushdown()
+        pushdown.residual_rule_type = rule.rule_type
+        field_types = field_types or {}
+        used_keys = set(base_filter or {})
+        
+        try:
+            condition_config = json.loads(rule.condition_config) if isinstance(rule.condition_config, str) else rule.condition_config
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать условия правила {rule.id} для фильтра Bitrix24: {e}")
+            pushdown.residual_config = rule.condition_config
+            pushdown.residual.append(f"{rule.rule_type} (ошибка разбора условий)")
+            return pushdown
+        
+        pushdown.residual_config = condition_config
+        
+        if rule.rule_type in ('assigned_by_condition', 'field_condition'):
+            condition_filter, exact, description = RuleEngine._compile_condition_filter(
+                rule.rule_type, condition_config, field_types, used_keys
+            )
+            if condition_filter:
+                pushdown.filter_dict.update(condition_filter)
+                pushdown.pushed.append(description)
+            if exact:
+                pushdown.residual_rule_type = None
+                pushdown.residual_config = None
+            else:
+                pushdown.residual.append(description or rule.rule_type)
+        elif rule.rule_type == 'combined' and condition_config.get('logic', 'AND') == 'AND':
+            residual_conditions = RuleEngine._push_and_conditions(
+                condition_config.get('conditions', []), field_types, used_keys, pushdown
+            )
+            
+            if residual_conditions:
+                pushdown.residual_config = dict(condition_config, conditions=residual_conditions)
+            elif condition_config.get('conditions'):
+                pushdown.residual_rule_type = None
+                pushdown.residual_config = None
+        else:
+            pushdown.residual.append(f"{rule.rule_type} ({condition_config.get('logic', '')})".strip())
+        
+        return pushdown
+    
+    @staticmethod
+    def without_pushdown(rule: UpdateRule) -> RuleFilterPushdown:
+        """
+        Оставить правило целиком для проверки в Python
+        
+        Используется для сущностей, полученных не запросом Bitrix24 с фильтром
+        (например, из локальной копии сущностей).
+        
+        Args:
+            rule: Правило обновления
+        
+        Returns:
+            Результат без перенесенных условий
+        """
+        pushdown = RuleFilterPushdown()
+        pushdown.residual_rule_type = rule.rule_type
+        try:
+            pushdown.residual_config = json.loads(rule.condition_config) if isinstance(rule.condition_config, str) else rule.condition_config
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать условия правила {rule.id}: {e}")
+            pushdown.residual_config = rule.condition_config
+        pushdown.residual.append(rule.rule_type)
+        return pushdown
+    
+    @staticmethod
+    def _push_and_conditions(
+        conditions: List[Dict[str, Any]],
+        field_types: Dict[str, str],
+        used_keys: Set[str],
+        pushdown: RuleFilterPushdown
+    ) -> List[Dict[str, Any]]:
+        """
+        Перенести в фильтр Bitrix24 условия, объединенные логикой AND
+        
+        Вложенные условия combined с логикой AND обрабатываются рекурсивно,
+        вложенные условия с логикой OR остаются в Python целиком.
+        
+        Args:
+            conditions: Список условий
+            field_types: Типы полей сущности {field_id: field_type}
+            used_keys: Ключи фильтра, которые уже заняты (дополняется)
+            pushdown: Результат переноса условий (дополняется)
+        
+        Returns:
+            Список условий, которые нужно проверить в Python
+        """
+        residual_conditions = []
+        for condition in conditions:
+            condition_type = condition.get('type')
+            
+            if condition_type == 'combined':
+                if condition.get('logic', 'AND') != 'AND':
+                    residual_conditions.append(condition)
+                    pushdown.residual.append(f"combined ({condition.get('logic')})")
+                    continue
+                nested_residual = RuleEngine._push_and_conditions(
+                    condition.get('conditions', []), field_types, used_keys, pushdown
+                )
+                if nested_residual:
+                    residual_conditions.append(dict(condition, conditions=nested_residual))
+                continue
+            
+            if condition_type not in ('assigned_by_condition', 'field_condition'):
+                # Такие условия игнорируются при выполнении в Python
+                continue
+            
+            condition_filter, exact, description = RuleEngine._compile_condition_filter(
+                condition_type, condition, field_types, used_keys
+            )
+            if condition_filter:
+                pushdown.filter_dict.update(condition_filter)
+                used_keys.update(condition_filter)
+                pushdown.pushed.append(description)
+            if not exact:
+                residual_conditions.append(condition)
+                pushdown.residual.append(description or condition_type)
+        
+        return residual_conditions
+    
+    @staticmethod
+    def _compile_condition_filter(
+        condition_type: str,
+        condition: Dict[str, Any],
+        field_types: Dict[str, str],
+        used_keys: Set[str]
+    ) -> Tuple[Dict[str, Any], bool, str]:
+        """
+        Перенести одно условие в фильтр Bitrix24
+        
+        Args:
+            condition_type: Тип условия (assigned_by_condition, field_condition)
+            condition: Конфигурация условия
+            field_types: Типы полей сущности {field_id: field_type}
+            used_keys: Ключи фильтра, которые уже заняты
+        
+        Returns:
+            Кортеж (фильтр, точное совпадение с проверкой в Python, описание условия).
+            Пустой фильтр - условие не переносится.
+        """
+        if condition_type == 'assigned_by_condition':
+            operator = condition.get('operator', 'in')
+            user_ids = [str(uid) for uid in condition.get('user_ids', [])]
+            if not user_ids:
+                return {}, False, f"ASSIGNED_BY_ID {operator} []"
+            if operator in ('equals', 'in'):
+                key = 'ASSIGNED_BY_ID'
+            elif operator in ('not_equals', 'not_in'):
+                key = '!ASSIGNED_BY_ID'
+            else:
+                return {}, False, f"ASSIGNED_BY_ID {operator}"
+            if key in used_keys:
+                return {}, False, f"{key} {user_ids}"
+            return {key: user_ids}, True, f"{key} {user_ids}"
+        
+        if condition_type != 'field_condition':
+            return {}, False, condition_type
+        
+        field_id = condition.get('field_id')
+        if not field_id:
+            return {}, False, condition_type
+        
+        # Условие по воронкам и стадиям
+        category_id = condition.get('category_id')
+        category_ids = condition.get('category_ids', [])
+        stage_ids = condition.get('stage_ids', [])
+        if category_id is not None and not category_ids:
+            category_ids = [category_id]
+        
+        if category_ids or stage_ids:
+            description = f"CATEGORY_ID {category_ids or '*'}, STAGE_ID {stage_ids or '*'}"
+            condition_filter = {}
+            if category_ids:
+                condition_filter['CATEGORY_ID'] = [str(cid) for cid in category_ids]
+            if stage_ids:
+                # В Python стадии сравниваются как есть, поэтому переносим только строковые ID
+                if not all(isinstance(stage_id, str) for stage_id in stage_ids):
+                    return {}, False, description
+                condition_filter['STAGE_ID'] = list(stage_ids)
+            if used_keys.intersection(condition_filter):
+                return {}, False, description
+            return condition_filter, True, description
+        
+        operator = condition.get('operator', 'equals')
+        value = condition.get('value')
+        field_type = field_types.get(field_id)
+        description = f"{field_id} {operator} {value}"
+        
+        if operator in ('greater_than', 'less_than'):
+            if field_type not in NUMERIC_FIELD_TYPES:
+                return {}, False, description
+            try:
+                number = float(value)
+            except (ValueError, TypeError):
+                return {}, False, description
+            key = ('>' if operator == 'greater_than' else '<') + field_id
+            if key in used_keys:
+                return {}, False, description
+            # Пользовательские поля могут быть множественными - тогда фильтр только сужает выборку
+            exact = not field_id.startswith('UF_')
+            return {key: number}, exact, description
+        
+        if operator == 'contains':
+            # Поиск %FIELD в Bitrix24 не учитывает регистр, поэтому только сужает выборку
+            if field_type not in STRING_FIELD_TYPES or value is None or str(value) == '':
+                return {}, False, description
+            key = '%' + field_id
+            if key in used_keys:
+                return {}, False, description
+            return {key: str(value)}, False, description
+        
+        return {}, False, description
+    
+    def apply_residual(
+        self,
+        entities: List[Dict[str, Any]],
+        rule: UpdateRule,
+        pushdown: RuleFilterPushdown
+    ) -> List[Dict[str, Any]]:
+        """
+        Применить к сущностям часть правила, которая не была перенесена в фильтр Bitrix24
+        
+        Args:
+            entities: Сущности, полученные с фильтром pushdown.filter_dict
+            rule: Правило обновления
+            pushdown: Результат переноса условий правила
+        
+        Returns:
+            Отфильтрованный список сущностей
+        """
+        if pushdown.fully_pushed:
+            logger.info(f"Правило {rule.id} полностью выполнено фильтром Bitrix24: {len(entities)} сущностей")
+            return list(entities)
+        
+        try:
+            filtered_entities = self._apply_rule(
+                list(entities), pushdown.residual_rule_type, pushdown.residual_config, rule_id=rule.id
+            )
+            logger.info(f"Правило {rule.id} ({rule.rule_type}): после проверки в Python осталось {len(filtered_entities)} из {len(entities)} сущностей")
+            return filtered_entities
+        except Exception as e:
+            logger.error(f"Ошибка при применении правила {rule.id}: {e}", exc_info=True)
+            return list(entities)
+    
+    async def apply_residual_stream(
+        self,
+        pages: AsyncIterator[List[Dict[str, Any]]],
+        rule: UpdateRule,
+        pushdown: RuleFilterPushdown
+    ) -> AsyncGenerator[List[Dict[str, Any]], None]:
+        """
+        Применить непереносимую часть правила к потоку страниц сущностей
+        
+        Условие берется из кэша (compile_cached), каждая страница фильтруется сразу после получения,
+        поэтому в памяти остаются только прошедшие фильтр сущности.
+        
+        Args:
+            pages: Асинхронный поток страниц (например, BitrixClient.iter_entities)
+            rule: Правило обновления
+            pushdown: Результат переноса условий правила
+        
+        Yields:
+            Отфильтрованная страница сущностей (пустые страницы пропускаются)
+        """
+        predicate = _accept_all
+        if not pushdown.fully_pushed:
+            try:
+                predicate = self.compile_cached(pushdown.residual_rule_type, pushdown.residual_config, rule_id=rule.id)
+            except Exception as e:
+                logger.error(f"Ошибка при компиляции правила {rule.id}: {e}", exc_info=True)
+        
+        total = 0
+        matched = 0
+        async for page in pages:
+            total += len(page)
+            filtered_page = [e for e in page if predicate(e)]
+            matched += len(filtered_page)
+            if filtered_page:
+                yield filtered_page
+        
+        logger.info(f"Правило {rule.id} ({rule.rule_type}): после потоковой проверки осталось {matched} из {total} сущностей")
+    
     def _apply_rule(
         self,
         entities: List[Dict[str, Any]],
         rule_type: str,
-        condition_config: Dict[str, Any]
+        condition_config: Dict[str, Any],
+        rule_id: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """
         Применить одно правило к списку сущностей
@@ -61,29 +474,44 @@ class RuleEngine:
             entities: Список сущностей
             rule_type: Тип правила
             condition_config: Конфигурация условий
+            rule_id: ID правила (для удаления скомпилированного условия из кэша вместе с правилом)
             
         Returns:
             Отфильтрованный список сущностей
         """
-        logger.debug(f"Применение правила типа {rule_type} с конфигурацией: {condition_config}")
+        predicate = self.compile_cached(rule_type, condition_config, rule_id=rule_id)
+        return [e for e in entities if predicate(e)]
+    
+    @classmethod
+    def compile_condition(cls, rule_type: str, condition_config: Dict[str, Any]) -> EntityPredicate:
+        """
+        Скомпилировать условие в предикат сущности
+        
+        Все значения условия (множества ID, строки, числа) преобразуются один раз при компиляции.
+        
+        Args:
+            rule_type: Тип условия (assigned_by_condition, field_condition, combined)
+            condition_config: Конфигурация условия
+        
+        Returns:
+            Предикат сущности
+        """
+        logger.debug(f"Компиляция условия типа {rule_type} с конфигурацией: {condition_config}")
         
         if rule_type == 'assigned_by_condition':
-            return self._apply_assigned_by_condition(entities, condition_config)
+            return cls._compile_assigned_by_condition(condition_config)
         elif rule_type == 'field_condition':
-            return self._apply_field_condition(entities, condition_config)
+            return cls._compile_field_condition(condition_config)
         elif rule_type == 'combined':
-            return self._apply_combined_condition(entities, condition_config)
+            return cls._compile_combined_condition(condition_config)
         else:
             logger.warning(f"Неизвестный тип правила: {rule_type}, возвращаем все сущности")
-            return entities
+            return _accept_all
     
-    def _apply_assigned_by_condition(
-        self,
-        entities: List[Dict[str, Any]],
-        condition_config: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
+    @staticmethod
+    def _compile_assigned_by_condition(condition_config: Dict[str, Any]) -> EntityPredicate:
         """
-        Применить условие по текущему ответственному
+        Скомпилировать условие по текущему ответственному
         
         condition_config: {
             "operator": "equals|not_equals|in|not_in",
@@ -93,29 +521,20 @@ class RuleEngine:
         operator = condition_config.get('operator', 'in')
         user_ids_raw = condition_config.get('user_ids', [])
         # Преобразуем user_ids в множество строк, так как ASSIGNED_BY_ID из Bitrix24 приходит как строка
-        user_ids = {str(uid) for uid in user_ids_raw}
-        
-        logger.debug(f"Применение assigned_by_condition: operator={operator}, user_ids={user_ids}, entities_count={len(entities)}")
+        user_ids = frozenset(str(uid) for uid in user_ids_raw)
         
         if operator == 'equals' or operator == 'in':
-            filtered = [e for e in entities if str(e.get('ASSIGNED_BY_ID', '')) in user_ids]
-            logger.debug(f"Фильтрация по {operator}: {len(filtered)} из {len(entities)} сущностей")
-            return filtered
+            return lambda e: str(e.get('ASSIGNED_BY_ID', '')) in user_ids
         elif operator == 'not_equals' or operator == 'not_in':
-            filtered = [e for e in entities if str(e.get('ASSIGNED_BY_ID', '')) not in user_ids]
-            logger.debug(f"Фильтрация по {operator}: {len(filtered)} из {len(entities)} сущностей")
-            return filtered
+            return lambda e: str(e.get('ASSIGNED_BY_ID', '')) not in user_ids
         else:
             logger.warning(f"Неизвестный оператор для assigned_by_condition: {operator}")
-            return entities
+            return _accept_all
     
-    def _apply_field_condition(
-        self,
-        entities: List[Dict[str, Any]],
-        condition_config: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
+    @classmethod
+    def _compile_field_condition(cls, condition_config: Dict[str, Any]) -> EntityPredicate:
         """
-        Применить условие по полю сущности
+        Скомпилировать условие по полю сущности
         
         condition_config может быть в двух форматах:
         1. Стандартный: {"field_id": "ASSIGNED_BY_ID", "operator": "equals", "value": "..."}
@@ -126,7 +545,7 @@ class RuleEngine:
         
         if not field_id:
             logger.warning("Не указано поле для условия field_condition")
-            return entities
+            return _accept_all
         
         # Проверяем, есть ли специальные поля для категорий/стадий
         # Поддержка обратной совместимости: если есть category_id, преобразуем в category_ids
@@ -140,113 +559,99 @@ class RuleEngine:
         
         # Если есть category_ids или stage_ids, используем специальную обработку
         if category_ids or stage_ids:
-            return self._apply_category_stage_condition(entities, condition_config, field_id, category_ids, stage_ids)
+            return cls._compile_category_stage_condition(category_ids, stage_ids)
         
         # Стандартная обработка с operator и value
         operator = condition_config.get('operator', 'equals')
         value = condition_config.get('value')
+        value_str = str(value)
         
-        logger.info(f"Применение field_condition: field_id={field_id}, operator={operator}, value={value}, entities_count={len(entities)}")
-        
-        filtered = []
-        for entity in entities:
-            field_value = entity.get(field_id)
-            
-            # Логируем первые несколько значений для отладки
-            if len(filtered) < 3:
-                logger.debug(f"Сущность ID={entity.get('ID')}, поле {field_id}={field_value}, сравниваем с {value}")
+        if operator == 'equals':
+            return lambda e: str(e.get(field_id)) == value_str
+        elif operator == 'not_equals':
+            return lambda e: str(e.get(field_id)) != value_str
+        elif operator == 'contains':
+            def contains(e):
+                field_value = e.get(field_id)
+                return bool(field_value) and value_str in str(field_value)
+            return contains
+        elif operator == 'greater_than' or operator == 'less_than':
+            try:
+                number = float(value)
+            except (ValueError, TypeError):
+                # Значение условия не число - ни одна сущность не проходит сравнение
+                return _reject_all
+            greater = operator == 'greater_than'
             
-            if operator == 'equals':
-                if str(field_value) == str(value):
-                    filtered.append(entity)
-            elif operator == 'not_equals':
-                if str(field_value) != str(value):
-                    filtered.append(entity)
-            elif operator == 'contains':
-                if field_value and str(value) in str(field_value):
-                    filtered.append(entity)
-            elif operator == 'greater_than':
+            def compare(e):
                 try:
-                    if float(field_value) > float(value):
-                        filtered.append(entity)
+                    field_number = float(e.get(field_id))
                 except (ValueError, TypeError):
-                    pass
-            elif operator == 'less_than':
-                try:
-                    if float(field_value) < float(value):
-                        filtered.append(entity)
-                except (ValueError, TypeError):
-                    pass
-            else:
-                logger.warning(f"Неизвестный оператор для field_condition: {operator}")
-        
-        logger.info(f"Фильтрация по field_condition ({field_id} {operator} {value}): {len(filtered)} из {len(entities)} сущностей")
-        return filtered
+                    return False
+                return field_number > number if greater else field_number < number
+            return compare
+        else:
+            logger.warning(f"Неизвестный оператор для field_condition: {operator}")
+            return _reject_all
     
-    def _apply_category_stage_condition(
-        self,
-        entities: List[Dict[str, Any]],
-        condition_config: Dict[str, Any],
-        field_id: str,
+    @staticmethod
+    def _compile_category_stage_condition(
         category_ids: List[int],
         stage_ids: List[str]
-    ) -> List[Dict[str, Any]]:
+    ) -> EntityPredicate:
         """
-        Применить условие по категории и/или стадиям
+        Скомпилировать условие по категории и/или стадиям
         
         Логика:
-        - Если указаны category_ids: фильтруем сущности из любой из указанных категорий (воронок)
-        - Если указаны stage_ids: дополнительно фильтруем по стадиям (применяется ко всем выбранным воронкам)
-        - Если stage_ids пустой: берем ВСЕ сделки из указанных категорий (все стадии)
+        - Если указаны category_ids: сущность должна быть в любой из указанных категорий (воронок)
+        - Если указаны stage_ids: дополнительно проверяем стадию (применяется ко всем выбранным воронкам)
+        - Если stage_ids пустой: подходят ВСЕ сделки из указанных категорий (все стадии)
         
         Args:
-            entities: Список сущностей
-            condition_config: Конфигурация условий
-            field_id: ID поля (обычно CATEGORY_ID)
-            category_ids: Список ID категорий для фильтрации (пустой список = все категории)
-            stage_ids: Список ID стадий для фильтрации (пустой список = все стадии в категориях)
+            category_ids: Список ID категорий (пустой список = все категории)
+            stage_ids: Список ID стадий (пустой список = все стадии в категориях)
         """
-        logger.info(f"Применение category_stage_condition: category_ids={category_ids}, stage_ids={stage_ids} (пустой = все стадии), entities_count={len(entities)}")
-        
         # Преобразуем category_ids в множество строк для быстрого поиска
-        category_ids_set = {str(cid) for cid in category_ids} if category_ids else None
+        category_ids_set = frozenset(str(cid) for cid in category_ids) if category_ids else None
+        try:
+            stage_ids_set = frozenset(stage_ids) if stage_ids else None
+        except TypeError:
+            # Нехешируемые значения стадий - проверяем по списку
+            stage_ids_set = list(stage_ids)
         
-        filtered = []
-        for entity in entities:
-            entity_category_id = entity.get('CATEGORY_ID')
-            entity_stage_id = entity.get('STAGE_ID')
-            
+        def category_stage(e):
             # Фильтруем по категориям, если указаны
-            if category_ids_set is not None:
-                if str(entity_category_id) not in category_ids_set:
-                    continue
+            if category_ids_set is not None and str(e.get('CATEGORY_ID')) not in category_ids_set:
+                return False
             
             # Фильтруем по стадиям, если указаны
-            # Если stage_ids пустой - НЕ фильтруем по стадиям (берем все стадии в категориях)
-            if stage_ids:
-                if not entity_stage_id or entity_stage_id not in stage_ids:
-                    continue
+            if stage_ids_set is not None:
+                entity_stage_id = e.get('STAGE_ID')
+                if not entity_stage_id:
+                    return False
+                try:
+                    return entity_stage_id in stage_ids_set
+                except TypeError:
+                    return entity_stage_id in stage_ids
             
-            filtered.append(entity)
-        
-        stage_info = stage_ids if stage_ids else "все стадии"
-        category_info = category_ids if category_ids else "все категории"
-        logger.info(f"Фильтрация по category_stage_condition (category_ids={category_info}, stage_ids={stage_info}): {len(filtered)} из {len(entities)} сущностей")
-        return filtered
+            return True
+        return category_stage
     
-    def _apply_combined_condition(
-        self,
-        entities: List[Dict[str, Any]],
-        condition_config: Dict[str, Any]
-    ) -> List[Dict[str, Any]]:
+    @classmethod
+    def _compile_combined_condition(cls, condition_config: Dict[str, Any]) -> EntityPredicate:
         """
-        Применить комбинированное условие
+        Скомпилировать комбинированное условие
+        
+        Условия проверяются для каждой сущности за один проход без промежуточных списков:
+        AND останавливается на первом невыполненном условии, OR - на первом выполненном.
+        Условия могут быть вложенными (type: combined со своими logic и conditions).
         
         condition_config: {
             "logic": "AND|OR",
             "conditions": [
                 {"type": "assigned_by_condition", ...},
-                {"type": "field_condition", ...}
+                {"type": "field_condition", ...},
+                {"type": "combined", "logic": "OR", "conditions": [...]}
             ]
         }
         """
@@ -254,34 +659,45 @@ class RuleEngine:
         conditions = condition_config.get('conditions', [])
         
         if not conditions:
-            return entities
+            return _accept_all
+        
+        # Условия неизвестного типа не участвуют в проверке
+        predicates = []
+        for condition in conditions:
+            condition_type = condition.get('type')
+            if condition_type == 'assigned_by_condition':
+                predicates.append(cls._compile_assigned_by_condition(condition))
+            elif condition_type == 'field_condition':
+                predicates.append(cls._compile_field_condition(condition))
+            elif condition_type == 'combined':
+                predicates.append(cls._compile_combined_condition(condition))
         
         if logic == 'AND':
             # Все условия должны выполняться
-            result = entities
-            for condition in conditions:
-                condition_type = condition.get('type')
-                if condition_type == 'assigned_by_condition':
-                    result = self._apply_assigned_by_condition(result, condition)
-                elif condition_type == 'field_condition':
-                    result = self._apply_field_condition(result, condition)
-            return result
+            def all_conditions(e):
+                for predicate in predicates:
+                    if not predicate(e):
+                        return False
+                return True
+            return all_conditions
         elif logic == 'OR':
             # Хотя бы одно условие должно выполняться
-            result_set = set()
-            for condition in conditions:
-                condition_type = condition.get('type')
-                if condition_type == 'assigned_by_condition':
-                    filtered = self._apply_assigned_by_condition(entities, condition)
-                elif condition_type == 'field_condition':
-                    filtered = self._apply_field_condition(entities, condition)
-                else:
-                    continue
-                
-                for entity in filtered:
-                    result_set.add(entity.get('ID'))
-            
-            return [e for e in entities if e.get('ID') in result_set]
+            def any_condition(e):
+                for predicate in predicates:
+                    if predicate(e):
+                        return True
+                return False
+            return any_condition
         else:
             logger.warning(f"Неизвестная логика для combined: {logic}")
-            return entities
+            return _accept_all
+
+
+def _accept_all(entity: Dict[str, Any]) -> bool:
+    """Предикат, пропускающий любую сущность"""
+    return True
+
+
+def _reject_all(entity: Dict[str, Any]) -> bool:
+    """Предикат, отклоняющий любую сущность"""
+    return False
@@ -1,11 +1,16 @@
 from sqlalchemy.orm import Session
 from datetime import date, datetime, time
 from zoneinfo import ZoneInfo
-from typing import List, Optional, Set, Dict, Generator, AsyncGenerator
-from app.models import UpdateRule, DutySchedule, User, UpdateHistory, UpdateSource
-from app.services.bitrix_client import get_bitrix_client
-from app.services.rule_engine import RuleEngine
+from typing import List, Optional, Set, Dict, Tuple, Generator, AsyncGenerator
+from app.models import UpdateRule, DutySchedule, User, UpdateSource, FieldMapping
+from app.services.bitrix_client import get_bitrix_client, ChunkedFetchResult, is_not_found_error
+from app.services.rule_engine import RuleEngine, RuleFilterPushdown
+from app.services.entity_snapshot import EntitySnapshot
+from app.services.entity_mirror import EntityMirrorService
+from app.services.history_writer import HistoryWriter
 from app.services.schedule_service import ScheduleService
+from app.services.user_directory import get_user_directory
+from app.config import settings
 import logging
 import json
 import asyncio
@@ -21,6 +26,88 @@ def get_today_msk() -> date:
     return datetime.now(MSK_TIMEZONE).date()
 
 
+class RuleExecutionPlan:
+    """
+    План выполнения правила
+    
+    Содержит сущности правила, загруженные из Bitrix24 один раз, результат фильтрации,
+    распределение по дежурным пользователям и индекс сущностей по ID. Один и тот же план
+    используется для подсчета количества, прогресса, предпросмотра и самого обновления,
+    чтобы не запрашивать список сущностей повторно.
+    
+    Если план построен из снимка сущностей, после успешного обновления изменения
+    применяются к снимку, чтобы следующие правила запуска видели актуальные данные.
+    План, построенный потоковой загрузкой, сохраняется между подсчетом и обновлением;
+    изменения предыдущих правил применяются к нему через apply_updates.
+    """
+    
+    def __init__(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        entities: List[dict],
+        filtered_entities: List[dict],
+        user_assignments: Dict[int, List],
+        snapshot: Optional[EntitySnapshot] = None,
+        pushdown: Optional[RuleFilterPushdown] = None,
+        filter_fields: Optional[Set[str]] = None,
+        streamed: bool = False
+    ):
+        self.rule = rule
+        self.duty_users = duty_users
+        self.entities = entities
+        self.filtered_entities = filtered_entities
+        self.user_assignments = user_assignments
+        self.snapshot = snapshot
+        self.pushdown = pushdown
+        self.filter_fields = filter_fields or set()
+        self.streamed = streamed
+        self.entity_index = UpdateService._build_entity_index(filtered_entities)
+    
+    @property
+    def pending_count(self) -> int:
+        """Количество сущностей, у которых ответственный отличается от назначенного"""
+        count = 0
+        for user_id, entity_ids in self.user_assignments.items():
+            for entity_id in entity_ids:
+                entity = self.entity_index.get(entity_id)
+                if entity and entity.get('ASSIGNED_BY_ID') != str(user_id):
+                    count += 1
+        return count
+    
+    def apply_updates(self, entity_type: str, updates: List[dict]) -> bool:
+        """
+        Применить успешно записанные в Bitrix24 изменения к сущностям плана
+        
+        Если измененное поле участвует в фильтре или условиях правила, состав выборки мог
+        измениться: план устарел и должен быть построен заново.
+        
+        Args:
+            entity_type: Тип сущности
+            updates: Список обновлений [{'ID': '...', 'fields': {...}}]
+        
+        Returns:
+            True, если план остается актуальным
+        """
+        if entity_type != self.rule.entity_type:
+            return True
+        
+        updated_fields = set()
+        for update in updates:
+            updated_fields.update(update.get('fields', {}))
+        if updated_fields.intersection(self.filter_fields):
+            return False
+        
+        for update in updates:
+            entity = self.entity_index.get(str(update.get('ID')))
+            if entity is None:
+                continue
+            for field, value in update.get('fields', {}).items():
+                if field in entity:
+                    entity[field] = str(value) if value is not None else None
+        return True
+
+
 class UpdateService:
     """Сервис для обновления ответственных в сущностях Bitrix24"""
     
@@ -28,13 +115,38 @@ class UpdateService:
         self.db = db
         self.bitrix_client = get_bitrix_client()
         self.schedule_service = ScheduleService(db)
+        self._field_types: Dict[str, Dict[str, str]] = {}
+        self._entity_mirror = EntityMirrorService(db, self.bitrix_client) if settings.entity_mirror_enabled else None
+        self._mirror_synced: Set[str] = set()
+    
+    def _get_field_types(self, entity_type: str) -> Dict[str, str]:
+        """
+        Получить типы полей сущности из кэша полей Bitrix24 (FieldMapping)
+        
+        Args:
+            entity_type: Тип сущности
+        
+        Returns:
+            Словарь {field_id: field_type} (пустой, если поля еще не кэшировались)
+        """
+        if entity_type not in self._field_types:
+            mappings = self.db.query(FieldMapping).filter(
+                FieldMapping.entity_type == entity_type
+            ).all()
+            self._field_types[entity_type] = {m.field_id: m.field_type for m in mappings}
+        return self._field_types[entity_type]
     
-    async def update_entities_for_date(self, update_date: date) -> dict:
+    async def update_entities_for_date(
+        self,
+        update_date: date,
+        rules: Optional[List[UpdateRule]] = None
+    ) -> dict:
         """
         Обновить ответственных в сущностях на указанную дату
         
         Args:
             update_date: Дата для обновления
+            rules: Явный набор правил для выполнения (по умолчанию все включенные правила)
             
         Returns:
             Словарь с результатами обновления
@@ -53,14 +165,18 @@ class UpdateService:
         
         duty_user_ids = {u.id for u in duty_users}
         
-        # Получаем все включенные правила
-        rules = self.db.query(UpdateRule).filter(
-            UpdateRule.enabled == True
-        ).all()
+        # Получаем все включенные правила, если набор правил не передан явно
+        if rules is None:
+            rules = self.db.query(UpdateRule).filter(
+                UpdateRule.enabled == True
+            ).all()
         
         total_updated = 0
         errors = []
         
+        # Общий снимок сущностей: один запрос списка на тип сущности для всех правил
+        snapshot = self._create_entity_snapshot(rules)
+        
         for rule in rules:
             try:
                 # Проверяем, что пользователи из правила находятся на дежурстве
@@ -77,10 +193,12 @@ class UpdateService:
                 # Фильтруем дежурных пользователей - оставляем только тех, кто есть в правиле
                 rule_duty_users = [u for u in duty_users if u.id in rule_user_ids]
                 
+                plan = await self._build_rule_plan(rule, rule_duty_users, snapshot=snapshot)
                 updated_count = await self._update_rule(
                     rule,
                     rule_duty_users,
-                    update_date
+                    update_date,
+                    plan=plan
                 )
                 total_updated += updated_count
                 logger.info(
@@ -111,7 +229,20 @@ class UpdateService:
         Returns:
             Список полей для запроса
         """
-        fields = {'ID', 'ASSIGNED_BY_ID'}  # Базовые поля всегда нужны
+        # Базовые поля всегда нужны
+        return list({'ID', 'ASSIGNED_BY_ID'} | self._get_rule_condition_fields(rule))
+    
+    def _get_rule_condition_fields(self, rule: UpdateRule) -> Set[str]:
+        """
+        Определить поля, которые проверяются условиями правила
+        
+        Args:
+            rule: Правило обновления
+        
+        Returns:
+            Множество полей условий правила
+        """
+        fields = set()
         
         try:
             condition_config = json.loads(rule.condition_config) if isinstance(rule.condition_config, str) else rule.condition_config
@@ -145,9 +276,13 @@ class UpdateService:
                     logger.debug(f"Фильтрация по стадиям {stage_ids}")
                     
             elif rule.rule_type == 'combined':
-                conditions = condition_config.get('conditions', [])
-                for condition in conditions:
-                    if condition.get('type') == 'field_condition':
+                # Обходим условия, включая вложенные combined
+                conditions = list(condition_config.get('conditions', []))
+                while conditions:
+                    condition = conditions.pop()
+                    if condition.get('type') == 'combined':
+                        conditions.extend(condition.get('conditions', []))
+                    elif condition.get('type') == 'field_condition':
                         field_id = condition.get('field_id')
                         if field_id:
                             fields.add(field_id)
@@ -174,26 +309,37 @@ class UpdateService:
         except Exception as e:
             logger.warning(f"Ошибка при определении полей для правила {rule.id}: {e}")
         
-        return list(fields)
+        return fields
     
-    async def _update_rule(
-        self,
-        rule: UpdateRule,
-        duty_users: List[User],
-        update_date: date,
-        progress_callback: Optional[callable] = None
-    ) -> int:
+    @staticmethod
+    def _get_base_filter(entity_type: str) -> Optional[dict]:
         """
-        Обновить ответственных для конкретного правила с распределением по пользователям
+        Получить базовый фильтр выборки сущностей типа (без условий правил)
+        
+        Args:
+            entity_type: Тип сущности
+        
+        Returns:
+            Фильтр или None
+        """
+        if entity_type == 'deal':
+            # STAGE_SEMANTIC_ID = 'P' означает "первичный контакт" (в работе)
+            # Также можно использовать 'W' для "winning" (в работе)
+            logger.info(f"Применение фильтра для сделок: только STAGE_SEMANTIC_ID='P' (в работе)")
+            return {'STAGE_SEMANTIC_ID': 'P'}
+        return None
+    
+    def _get_rule_fetch_params(self, rule: UpdateRule) -> Tuple[List[str], Optional[dict], RuleFilterPushdown]:
+        """
+        Определить поля и фильтр для запроса списка сущностей правила
+        
+        Условия правила, которые можно выполнить на стороне Bitrix24, переносятся в фильтр запроса.
         
         Args:
             rule: Правило обновления
-            duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
-            update_date: Дата обновления
-            progress_callback: Опциональный callback для отправки прогресса (current_count, total_count)
             
         Returns:
-            Количество обновленных сущностей
+            Кортеж (список полей, фильтр или None, результат переноса условий в фильтр)
         """
         # Определяем необходимые поля для запроса на основе правила
         required_fields = self._get_required_fields_for_rule(rule)
@@ -206,33 +352,99 @@ class UpdateService:
         logger.debug(f"Правило {rule.id} требует поля: {required_fields}")
         
         # Для сделок добавляем фильтр по STAGE_SEMANTIC_ID - только сделки "в работе"
-        filter_dict = None
-        if rule.entity_type == 'deal':
-            # STAGE_SEMANTIC_ID = 'P' означает "первичный контакт" (в работе)
-            # Также можно использовать 'W' для "winning" (в работе)
-            filter_dict = {'STAGE_SEMANTIC_ID': 'P'}
-            logger.info(f"Применение фильтра для сделок: только STAGE_SEMANTIC_ID='P' (в работе)")
+        filter_dict = self._get_base_filter(rule.entity_type)
         
-        # Получаем все сущности этого типа из Bitrix24 с необходимыми полями
-        entities = await self.bitrix_client.get_entities_list(
-            rule.entity_type,
-            select=required_fields,
-            filter_dict=filter_dict
+        # Переносим условия правила в фильтр Bitrix24, в Python проверяется только остаток
+        pushdown = RuleEngine.compile_pushdown(
+            rule,
+            field_types=self._get_field_types(rule.entity_type),
+            base_filter=filter_dict
+        )
+        if pushdown.filter_dict:
+            filter_dict = {**(filter_dict or {}), **pushdown.filter_dict}
+        logger.info(
+            f"Правило {rule.id}: в фильтр Bitrix24 перенесено: {pushdown.pushed or 'ничего'}; "
+            f"проверяется в Python: {pushdown.residual or 'ничего'}"
         )
         
+        return required_fields, filter_dict, pushdown
+    
+    def _create_entity_snapshot(self, rules: List[UpdateRule]) -> EntitySnapshot:
+        """
+        Создать снимок сущностей для запуска и зарегистрировать в нем поля всех правил
+        
+        Правила одного типа сущности с одинаковым фильтром загружаются одним запросом
+        с объединением необходимых полей.
+        
+        Args:
+            rules: Список правил запуска
+        
+        Returns:
+            Снимок сущностей
+        """
+        snapshot = EntitySnapshot(self.bitrix_client)
+        for rule in rules:
+            try:
+                required_fields, filter_dict, _ = self._get_rule_fetch_params(rule)
+                snapshot.register(rule.entity_type, required_fields, filter_dict)
+            except Exception as e:
+                logger.warning(f"Ошибка при определении полей для снимка по правилу {rule.id}: {e}")
+        return snapshot
+    
+    async def _build_rule_plan(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        snapshot: Optional[EntitySnapshot] = None
+    ) -> RuleExecutionPlan:
+        """
+        Загрузить сущности правила из Bitrix24, отфильтровать и распределить их
+        
+        Args:
+            rule: Правило обновления
+            duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            snapshot: Снимок сущностей запуска (если не указан, список запрашивается из Bitrix24 напрямую)
+        
+        Returns:
+            План выполнения правила
+        """
+        required_fields, filter_dict, pushdown = self._get_rule_fetch_params(rule)
+        
+        # Если все поля правила есть в локальной копии, сущности берутся из нее без запроса списка в Bitrix24
+        if self._entity_mirror is not None and EntityMirrorService.supports(rule.entity_type, required_fields):
+            try:
+                return await self._build_rule_plan_from_mirror(rule, duty_users, snapshot)
+            except Exception as e:
+                logger.warning(f"Не удалось использовать локальную копию {rule.entity_type} для правила {rule.id}, сущности запрашиваются из Bitrix24: {e}")
+        
+        # Выборку, не общую с другими правилами, при включенной потоковой загрузке получаем постранично
+        # и сразу фильтруем: в памяти остаются только прошедшие правило сущности
+        if settings.bitrix24_stream_entities and (snapshot is None or not snapshot.is_shared(rule.entity_type, filter_dict)):
+            return await self._build_rule_plan_streaming(rule, duty_users, required_fields, filter_dict, pushdown, snapshot)
+        
+        # Получаем все сущности этого типа с необходимыми полями (из снимка или из Bitrix24)
+        if snapshot is not None:
+            entities = await snapshot.get_entities(
+                rule.entity_type,
+                required_fields,
+                filter_dict=filter_dict
+            )
+        else:
+            entities = await self.bitrix_client.get_entities_list(
+                rule.entity_type,
+                select=required_fields,
+                filter_dict=filter_dict
+            )
+        
         if not entities:
-            return 0
+            return RuleExecutionPlan(rule, duty_users, [], [], {}, snapshot=snapshot, pushdown=pushdown)
         
-        # Применяем правило для фильтрации (используем одно правило)
+        # Применяем часть правила, не перенесенную в фильтр Bitrix24
         logger.info(f"Применение правила {rule.id} ({rule.entity_name}): получено {len(entities)} сущностей типа {rule.entity_type}")
         rule_engine = RuleEngine([rule])
-        filtered_entities = rule_engine.apply_rules(entities)
+        filtered_entities = rule_engine.apply_residual(entities, rule, pushdown)
         logger.info(f"После фильтрации правилом {rule.id}: осталось {len(filtered_entities)} сущностей")
         
-        if not filtered_entities:
-            logger.info(f"Нет сущностей типа {rule.entity_type}, прошедших фильтрацию по правилу {rule.id}")
-            return 0
-        
         # Распределяем сущности между пользователями
         user_assignments = self._distribute_entities(
             filtered_entities,
@@ -240,6 +452,311 @@ class UpdateService:
             rule.distribution_percentage
         )
         
+        return RuleExecutionPlan(
+            rule,
+            duty_users,
+            entities,
+            filtered_entities,
+            user_assignments,
+            snapshot=snapshot,
+            pushdown=pushdown
+        )
+    
+    async def _sync_entity_mirror(self, entity_type: str):
+        """Синхронизировать локальную копию типа сущности (один раз на экземпляр сервиса)"""
+        if entity_type in self._mirror_synced:
+            return
+        await self._entity_mirror.sync(entity_type)
+        self._mirror_synced.add(entity_type)
+    
+    async def _build_rule_plan_from_mirror(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        snapshot: Optional[EntitySnapshot] = None
+    ) -> RuleExecutionPlan:
+        """
+        Построить план правила по локальной копии сущностей
+        
+        Перед первым использованием копия синхронизируется с Bitrix24 по изменениям (DATE_MODIFY),
+        правило целиком проверяется в Python.
+        
+        Args:
+            rule: Правило обновления
+            duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            snapshot: Снимок сущностей запуска
+        
+        Returns:
+            План выполнения правила
+        """
+        await self._sync_entity_mirror(rule.entity_type)
+        entities = self._entity_mirror.get_entities(rule.entity_type, self._get_base_filter(rule.entity_type))
+        logger.info(f"Применение правила {rule.id} ({rule.entity_name}): из локальной копии получено {len(entities)} сущностей типа {rule.entity_type}")
+        
+        pushdown = RuleEngine.without_pushdown(rule)
+        filtered_entities = RuleEngine([rule]).apply_residual(entities, rule, pushdown)
+        logger.info(f"После фильтрации правилом {rule.id}: осталось {len(filtered_entities)} сущностей")
+        
+        user_assignments = self._distribute_entities(
+            filtered_entities,
+            duty_users,
+            rule.distribution_percentage
+        )
+        
+        return RuleExecutionPlan(
+            rule,
+            duty_users,
+            entities,
+            filtered_entities,
+            user_assignments,
+            snapshot=snapshot,
+            pushdown=pushdown
+        )
+    
+    async def _build_rule_plan_streaming(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        required_fields: List[str],
+        filter_dict: Dict,
+        pushdown: RuleFilterPushdown,
+        snapshot: Optional[EntitySnapshot] = None
+    ) -> RuleExecutionPlan:
+        """
+        Построить план правила по потоку страниц сущностей (BitrixClient.iter_entities)
+        
+        Страницы фильтруются по мере получения, полный список сущностей правила не хранится.
+        Распределению нужен итоговый размер выборки, поэтому оно выполняется по собранным
+        отфильтрованным сущностям.
+        
+        Args:
+            rule: Правило обновления
+            duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            required_fields: Поля для выборки
+            filter_dict: Фильтр запроса Bitrix24
+            pushdown: Результат переноса условий правила
+            snapshot: Снимок сущностей запуска
+        
+        Returns:
+            План выполнения правила
+        """
+        logger.info(f"Потоковая загрузка сущностей типа {rule.entity_type} для правила {rule.id} ({rule.entity_name})")
+        rule_engine = RuleEngine([rule])
+        pages = self.bitrix_client.iter_entities(
+            rule.entity_type,
+            select=required_fields,
+            filter_dict=filter_dict
+        )
+        
+        filtered_entities = []
+        async for page in rule_engine.apply_residual_stream(pages, rule, pushdown):
+            filtered_entities.extend(page)
+        logger.info(f"После фильтрации правилом {rule.id}: осталось {len(filtered_entities)} сущностей")
+        
+        user_assignments = self._distribute_entities(
+            filtered_entities,
+            duty_users,
+            rule.distribution_percentage
+        )
+        
+        # Поля, изменение которых меняет состав выборки: фильтр запроса и условия правила
+        filter_fields = {name.lstrip('!<>=%@') for name in (filter_dict or {})}
+        filter_fields.update(self._get_rule_condition_fields(rule))
+        
+        return RuleExecutionPlan(
+            rule,
+            duty_users,
+            filtered_entities,
+            filtered_entities,
+            user_assignments,
+            snapshot=snapshot,
+            pushdown=pushdown,
+            filter_fields=filter_fields,
+            streamed=True
+        )
+    
+    async def _count_pending_entities(
+        self,
+        rules: List[UpdateRule],
+        duty_users: List[User],
+        snapshot: Optional[EntitySnapshot] = None,
+        kept_plans: Optional[Dict[int, RuleExecutionPlan]] = None
+    ) -> int:
+        """
+        Посчитать общее количество сущностей для обновления по всем применимым правилам
+        
+        Планы, построенные из снимка или локальной копии, после подсчета отбрасываются: их
+        повторное построение перед обновлением правила не запрашивает список из Bitrix24 и
+        учитывает изменения предыдущих правил. План потоковой загрузки (выборка не хранится
+        в снимке) сохраняется в kept_plans, чтобы не загружать сущности правила второй раз;
+        в нем хранятся только отфильтрованные сущности.
+        Правила без пользователей или с пользователями не на дежурстве пропускаются.
+        Ошибка при построении плана одного правила не прерывает остальные.
+        
+        Args:
+            rules: Список правил
+            duty_users: Список пользователей на дежурстве
+            snapshot: Снимок сущностей запуска (если не указан, создается для переданных правил)
+            kept_plans: Словарь {rule_id: план} для сохранения планов потоковой загрузки
+        
+        Returns:
+            Количество сущностей для обновления
+        """
+        if snapshot is None:
+            snapshot = self._create_entity_snapshot(rules)
+        
+        duty_user_ids = {u.id for u in duty_users}
+        total_count = 0
+        
+        for rule in rules:
+            rule_user_ids = {ru.user_id for ru in rule.rule_users}
+            if not rule_user_ids or not rule_user_ids.intersection(duty_user_ids):
+                continue
+            
+            rule_duty_users = [u for u in duty_users if u.id in rule_user_ids]
+            try:
+                plan = await self._build_rule_plan(rule, rule_duty_users, snapshot=snapshot)
+                total_count += plan.pending_count
+                if plan.streamed and kept_plans is not None:
+                    kept_plans[rule.id] = plan
+            except Exception as e:
+                logger.error(f"Ошибка при подсчете сущностей для правила {rule.id}: {e}")
+        
+        return total_count
+    
+    async def _resolve_deal_related_entities(
+        self,
+        deals: List[Dict]
+    ) -> Tuple[Dict[int, List[int]], Dict[int, Optional[int]], Dict[int, Dict], Dict[int, Dict]]:
+        """
+        Получить связанные контакты и компании сделок
+        
+        COMPANY_ID и CONTACT_ID берутся из уже загруженных строк сделок (поля добавляются в select
+        правил с update_related_contacts_companies). crm.deal.list возвращает в CONTACT_ID только
+        основной контакт, поэтому отдельный запрос crm.deal.contact.items.get выполняется только
+        для сделок с контактом (сделки без CONTACT_ID не имеют контактов). Если на портале у сделок
+        всегда один контакт (BITRIX24_DEALS_SINGLE_CONTACT), запрос не выполняется совсем.
+        Для строк без полей CONTACT_ID/COMPANY_ID используются запросы к Bitrix24.
+        
+        Args:
+            deals: Строки сделок
+        
+        Returns:
+            Кортеж (контакты сделок {deal_id: [contact_ids]}, компании сделок {deal_id: company_id},
+            данные контактов {contact_id: данные}, данные компаний {company_id: данные})
+        """
+        deals_contacts = {}
+        deals_companies = {}
+        contacts_lookup_ids = []
+        companies_lookup_ids = []
+        
+        for deal in deals:
+            try:
+                deal_id = int(deal.get('ID'))
+            except (ValueError, TypeError):
+                continue
+            
+            if 'COMPANY_ID' in deal:
+                company_id = deal.get('COMPANY_ID')
+                try:
+                    deals_companies[deal_id] = int(company_id) if company_id and int(company_id) else None
+                except (ValueError, TypeError):
+                    deals_companies[deal_id] = None
+            else:
+                companies_lookup_ids.append(deal_id)
+            
+            if 'CONTACT_ID' in deal:
+                contact_id = deal.get('CONTACT_ID')
+                try:
+                    contact_id = int(contact_id) if contact_id else 0
+                except (ValueError, TypeError):
+                    contact_id = 0
+                
+                if not contact_id:
+                    deals_contacts[deal_id] = []
+                elif settings.bitrix24_deals_single_contact:
+                    deals_contacts[deal_id] = [contact_id]
+                else:
+                    contacts_lookup_ids.append(deal_id)
+            else:
+                contacts_lookup_ids.append(deal_id)
+        
+        if contacts_lookup_ids:
+            deals_contacts.update(await self.bitrix_client.get_deals_related_contacts_batch(contacts_lookup_ids))
+        if companies_lookup_ids:
+            deals_companies.update(await self.bitrix_client.get_deals_companies_batch(companies_lookup_ids))
+        
+        logger.info(
+            f"Связанные сущности для {len(deals)} сделок: запрос контактов для {len(contacts_lookup_ids)}, "
+            f"запрос компаний для {len(companies_lookup_ids)}"
+        )
+        
+        # Собираем все уникальные ID контактов и компаний
+        all_contact_ids = set()
+        for contact_ids in deals_contacts.values():
+            all_contact_ids.update(contact_ids)
+        all_company_ids = {cid for cid in deals_companies.values() if cid is not None}
+        
+        # Получаем информацию о всех контактах и компаниях (частями по ID)
+        contacts_data = ChunkedFetchResult()
+        companies_data = ChunkedFetchResult()
+        if all_contact_ids:
+            contacts_data = await self.bitrix_client.get_entities_batch(
+                'contact',
+                list(all_contact_ids),
+                select=['ID', 'ASSIGNED_BY_ID']
+            )
+        if all_company_ids:
+            companies_data = await self.bitrix_client.get_entities_batch(
+                'company',
+                list(all_company_ids),
+                select=['ID', 'ASSIGNED_BY_ID']
+            )
+        
+        for related_type, related_data in (('contact', contacts_data), ('company', companies_data)):
+            if related_data.errors:
+                logger.warning(
+                    f"Не удалось получить {len(related_data.failed_ids)} связанных сущностей {related_type}: "
+                    f"ответственные для них не будут обновлены"
+                )
+        
+        return deals_contacts, deals_companies, contacts_data, companies_data
+    
+    async def _update_rule(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        update_date: date,
+        progress_callback: Optional[callable] = None,
+        plan: Optional[RuleExecutionPlan] = None,
+        kept_plans: Optional[Dict[int, RuleExecutionPlan]] = None
+    ) -> int:
+        """
+        Обновить ответственных для конкретного правила с распределением по пользователям
+        
+        Args:
+            rule: Правило обновления
+            duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            update_date: Дата обновления
+            progress_callback: Опциональный callback для отправки прогресса (current_count, total_count)
+            plan: Заранее построенный план выполнения правила (если не указан, сущности загружаются из Bitrix24)
+            kept_plans: Сохраненные планы следующих правил запуска, к которым применяются изменения
+                (устаревшие планы удаляются и строятся заново)
+        
+        Returns:
+            Количество обновленных сущностей
+        """
+        if plan is None:
+            plan = await self._build_rule_plan(rule, duty_users)
+        
+        filtered_entities = plan.filtered_entities
+        if not filtered_entities:
+            logger.info(f"Нет сущностей типа {rule.entity_type}, прошедших фильтрацию по правилу {rule.id}")
+            return 0
+        
+        user_assignments = plan.user_assignments
+        entity_index = plan.entity_index
+        
         # Если правило для сделок и включено обновление связанных контактов и компаний,
         # получаем все данные заранее через batch запросы
         deals_contacts_dict = {}
@@ -249,47 +766,17 @@ class UpdateService:
         
         if rule.entity_type == 'deal' and rule.update_related_contacts_companies:
             try:
-                # Получаем все ID сделок из assignments
-                all_deal_ids = []
-                for entity_ids in user_assignments.values():
-                    for entity_id in entity_ids:
-                        entity = next((e for e in filtered_entities if e['ID'] == entity_id), None)
-                        if entity:
-                            try:
-                                all_deal_ids.append(int(entity_id))
-                            except (ValueError, TypeError):
-                                pass
+                # Получаем все сделки из assignments
+                assigned_deals = [
+                    entity_index[entity_id]
+                    for entity_ids in user_assignments.values()
+                    for entity_id in entity_ids
+                    if entity_id in entity_index
+                ]
                 
-                if all_deal_ids:
-                    # Получаем контакты для всех сделок одним batch запросом
-                    deals_contacts_dict = await self.bitrix_client.get_deals_related_contacts_batch(all_deal_ids)
-                    
-                    # Собираем все уникальные ID контактов
-                    all_contact_ids = set()
-                    for contact_ids in deals_contacts_dict.values():
-                        all_contact_ids.update(contact_ids)
-                    
-                    # Получаем информацию о всех контактах одним запросом
-                    if all_contact_ids:
-                        contacts_data_dict = await self.bitrix_client.get_entities_batch(
-                            'contact',
-                            list(all_contact_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
-                    
-                    # Получаем компании для всех сделок одним batch запросом
-                    deals_companies_dict = await self.bitrix_client.get_deals_companies_batch(all_deal_ids)
-                    
-                    # Собираем все уникальные ID компаний
-                    all_company_ids = {cid for cid in deals_companies_dict.values() if cid is not None}
-                    
-                    # Получаем информацию о всех компаниях одним запросом
-                    if all_company_ids:
-                        companies_data_dict = await self.bitrix_client.get_entities_batch(
-                            'company',
-                            list(all_company_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
+                if assigned_deals:
+                    deals_contacts_dict, deals_companies_dict, contacts_data_dict, companies_data_dict = \
+                        await self._resolve_deal_related_entities(assigned_deals)
             except Exception as e:
                 logger.warning(f"Ошибка при batch получении связанных сущностей для обновления: {e}")
         
@@ -300,7 +787,7 @@ class UpdateService:
         
         for user_id, entity_ids in user_assignments.items():
             for entity_id in entity_ids:
-                entity = next((e for e in filtered_entities if e['ID'] == entity_id), None)
+                entity = entity_index.get(entity_id)
                 if entity:
                     # Сохраняем старый ответственный для истории
                     current_assigned = entity.get('ASSIGNED_BY_ID')
@@ -436,64 +923,100 @@ class UpdateService:
         # Вычисляем общее количество сущностей для обновления
         total_to_update = len(updates) + len(related_updates)
         
-        # Выполняем массовое обновление через batch
-        total_updated = 0
-        current_count = 0
+        # Группируем обновления по типу сущности: основные сущности, контакты и компании
+        update_groups = [(rule.entity_type, updates)]
+        if related_updates:
+            for related_type in ('contact', 'company'):
+                related_batch = [
+                    {'ID': u['ID'], 'fields': u['fields']}
+                    for u in related_updates if u.get('entity_type') == related_type
+                ]
+                update_groups.append((related_type, related_batch))
+        update_groups = [(entity_type, batch) for entity_type, batch in update_groups if batch]
+        
+        # Используем список для хранения счетчика, чтобы изменять его из callback
+        current_count_ref = [0]
+        
+        async def chunk_progress(chunk_count: int):
+            current_count_ref[0] += chunk_count
+            # Отправляем прогресс после каждой обновленной части
+            if progress_callback:
+                await progress_callback(current_count_ref[0], total_to_update)
+        
+        # Выполняем массовое обновление частями; сделки, контакты и компании обновляются параллельно
         try:
-            if updates:
-                await self.bitrix_client.update_entities_batch(
-                    rule.entity_type,
-                    updates
-                )
-                total_updated += len(updates)
-                current_count += len(updates)
-                
-                # Отправляем прогресс после обновления основных сущностей
-                if progress_callback:
-                    await progress_callback(current_count, total_to_update)
+            results = await asyncio.gather(*(
+                self.bitrix_client.update_entities_chunked(entity_type, batch, on_chunk=chunk_progress)
+                for entity_type, batch in update_groups
+            ))
             
-            # Обновляем связанные контакты и компании
-            if related_updates:
-                # Группируем обновления по типу сущности
-                contact_updates = [u for u in related_updates if u.get('entity_type') == 'contact']
-                company_updates = [u for u in related_updates if u.get('entity_type') == 'company']
-                
-                if contact_updates:
-                    contact_batch = [{'ID': u['ID'], 'fields': u['fields']} for u in contact_updates]
-                    await self.bitrix_client.update_entities_batch('contact', contact_batch)
-                    total_updated += len(contact_updates)
-                    current_count += len(contact_updates)
-                    logger.info(f"Обновлено {len(contact_updates)} связанных контактов для правила {rule.id}")
-                    
-                    # Отправляем прогресс после обновления контактов
-                    if progress_callback:
-                        await progress_callback(current_count, total_to_update)
-                
-                if company_updates:
-                    company_batch = [{'ID': u['ID'], 'fields': u['fields']} for u in company_updates]
-                    await self.bitrix_client.update_entities_batch('company', company_batch)
-                    total_updated += len(company_updates)
-                    current_count += len(company_updates)
-                    logger.info(f"Обновлено {len(company_updates)} связанных компаний для правила {rule.id}")
-                    
-                    # Отправляем прогресс после обновления компаний
-                    if progress_callback:
-                        await progress_callback(current_count, total_to_update)
+            total_updated = 0
+            applied = set()
+            errors = []
+            for (entity_type, batch), result in zip(update_groups, results):
+                updated = result['updated']
+                total_updated += len(updated)
+                applied.update((entity_type, str(u['ID'])) for u in updated)
+                errors.extend(result['errors'])
+                # Сущности, удаленные в Bitrix24, убираем из локальной копии: иначе правила
+                # продолжат выбирать их до полной сверки
+                not_found_ids = [f['ID'] for f in result.get('failed', []) if is_not_found_error(f['error'])]
+                if not_found_ids and self._entity_mirror is not None:
+                    try:
+                        self._entity_mirror.remove(entity_type, not_found_ids)
+                    except Exception as e:
+                        logger.warning(f"Не удалось удалить из локальной копии {entity_type} сущности {not_found_ids}: {e}")
+                if updated and plan.snapshot is not None:
+                    plan.snapshot.apply_updates(entity_type, updated)
+                if updated and self._entity_mirror is not None:
+                    self._entity_mirror.apply_updates(entity_type, updated)
+                if updated and kept_plans:
+                    for kept_rule_id, kept_plan in list(kept_plans.items()):
+                        if not kept_plan.apply_updates(entity_type, updated):
+                            logger.debug(f"План правила {kept_rule_id} устарел после обновления правила {rule.id} и будет построен заново")
+                            del kept_plans[kept_rule_id]
+                if entity_type != rule.entity_type:
+                    logger.info(f"Обновлено {len(updated)} из {len(batch)} связанных сущностей {entity_type} для правила {rule.id}")
             
-            # Сохраняем историю изменений после успешного обновления
+            # Сохраняем историю изменений только для успешно обновленных сущностей
+            history_entries = [
+                entry for entry in history_entries
+                if (entry['entity_type'], str(entry['entity_id'])) in applied
+            ]
             if history_entries:
-                for entry in history_entries:
-                    history = UpdateHistory(**entry)
-                    self.db.add(history)
-                self.db.commit()
+                history_writer = HistoryWriter(self.db)
+                history_writer.extend(history_entries)
+                history_writer.flush()
                 logger.info(f"Сохранено {len(history_entries)} записей истории для правила {rule.id}")
             
+            if errors:
+                raise Exception(
+                    f"Не удалось обновить часть сущностей ({total_updated} из {total_to_update} обновлено, "
+                    f"ошибок: {len(errors)}): {errors[0]}"
+                )
+            
             return total_updated
         except Exception as e:
             logger.error(f"Ошибка при batch обновлении сущностей {rule.entity_type} для правила {rule.id}: {e}")
             self.db.rollback()
             raise
     
+    @staticmethod
+    def _build_entity_index(entities: List[dict]) -> Dict[str, dict]:
+        """
+        Построить индекс сущностей по ID
+        
+        Индекс строится один раз на выполнение правила и используется для поиска
+        сущности по ID за O(1) вместо линейного прохода по списку.
+        
+        Args:
+            entities: Список сущностей из Bitrix24
+        
+        Returns:
+            Словарь {ID: сущность} (ключ в том же виде, в каком ID пришел из Bitrix24)
+        """
+        return {e['ID']: e for e in entities if 'ID' in e}
+    
     def _distribute_entities(
         self,
         entities: List[dict],
@@ -630,6 +1153,9 @@ class UpdateService:
         rules_info = []
         total_count = 0
         
+        # Общий снимок сущностей: один запрос списка на тип сущности для всех правил
+        snapshot = self._create_entity_snapshot(rules)
+        
         for rule in rules:
             try:
                 # Проверяем, что пользователи из правила находятся на дежурстве
@@ -645,14 +1171,16 @@ class UpdateService:
                 rule_duty_users = [u for u in duty_users if u.id in rule_user_ids]
                 
                 # Получаем количество сущностей для этого правила
-                count = await self._get_rule_entities_count(rule, rule_duty_users)
+                plan = await self._build_rule_plan(rule, rule_duty_users, snapshot=snapshot)
+                count = await self._get_rule_entities_count(rule, rule_duty_users, plan=plan)
                 total_count += count
                 
                 rules_info.append({
                     "rule_id": rule.id,
                     "rule_name": rule.entity_name,
                     "entity_type": rule.entity_type,
-                    "count": count
+                    "count": count,
+                    "pushed_conditions": plan.pushdown.pushed if plan.pushdown else []
                 })
             except Exception as e:
                 logger.error(f"Ошибка при подсчете сущностей для правила {rule.id}: {e}")
@@ -663,62 +1191,28 @@ class UpdateService:
             "rules": rules_info
         }
     
-    async def _get_rule_entities_count(self, rule: UpdateRule, duty_users: List[User]) -> int:
+    async def _get_rule_entities_count(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        plan: Optional[RuleExecutionPlan] = None
+    ) -> int:
         """
         Получить количество сущностей, которые будут обновлены для конкретного правила
         
         Args:
             rule: Правило обновления
             duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            plan: Заранее построенный план выполнения правила (если не указан, сущности загружаются из Bitrix24)
             
         Returns:
             Количество сущностей для обновления
         """
-        # Определяем необходимые поля для запроса на основе правила
-        required_fields = self._get_required_fields_for_rule(rule)
-        
-        # Для сделок добавляем фильтр по STAGE_SEMANTIC_ID - только сделки "в работе"
-        filter_dict = None
-        if rule.entity_type == 'deal':
-            # STAGE_SEMANTIC_ID = 'P' означает "первичный контакт" (в работе)
-            filter_dict = {'STAGE_SEMANTIC_ID': 'P'}
-            logger.info(f"Применение фильтра для сделок: только STAGE_SEMANTIC_ID='P' (в работе)")
-        
-        # Получаем все сущности этого типа из Bitrix24 с необходимыми полями
-        entities = await self.bitrix_client.get_entities_list(
-            rule.entity_type,
-            select=required_fields,
-            filter_dict=filter_dict
-        )
-        
-        if not entities:
-            return 0
-        
-        # Применяем правило для фильтрации
-        rule_engine = RuleEngine([rule])
-        filtered_entities = rule_engine.apply_rules(entities)
-        
-        if not filtered_entities:
-            return 0
-        
-        # Распределяем сущности между пользователями
-        user_assignments = self._distribute_entities(
-            filtered_entities,
-            duty_users,
-            rule.distribution_percentage
-        )
+        if plan is None:
+            plan = await self._build_rule_plan(rule, duty_users)
         
-        # Подсчитываем количество сущностей, которые нужно обновить
-        count = 0
-        for user_id, entity_ids in user_assignments.items():
-            for entity_id in entity_ids:
-                entity = next((e for e in filtered_entities if e['ID'] == entity_id), None)
-                if entity:
-                    # Считаем только те, которые нужно обновить
-                    if entity.get('ASSIGNED_BY_ID') != str(user_id):
-                        count += 1
-        
-        return count
+        # Считаем только те сущности, которые нужно обновить
+        return plan.pending_count
     
     async def get_preview_updates(self, update_date: date) -> dict:
         """
@@ -749,6 +1243,9 @@ class UpdateService:
         all_preview_entities = []
         total_count = 0
         
+        # Общий снимок сущностей: один запрос списка на тип сущности для всех правил
+        snapshot = self._create_entity_snapshot(rules)
+        
         for rule in rules:
             try:
                 # Проверяем, что пользователи из правила находятся на дежурстве
@@ -764,7 +1261,8 @@ class UpdateService:
                 rule_duty_users = [u for u in duty_users if u.id in rule_user_ids]
                 
                 # Получаем предпросмотр сущностей для этого правила
-                rule_preview = await self._get_rule_preview_updates(rule, rule_duty_users)
+                plan = await self._build_rule_plan(rule, rule_duty_users, snapshot=snapshot)
+                rule_preview = await self._get_rule_preview_updates(rule, rule_duty_users, plan=plan)
                 all_preview_entities.extend(rule_preview)
                 total_count += len(rule_preview)
             except Exception as e:
@@ -776,55 +1274,33 @@ class UpdateService:
             "entities": all_preview_entities
         }
     
-    async def _get_rule_preview_updates(self, rule: UpdateRule, duty_users: List[User]) -> List[dict]:
+    async def _get_rule_preview_updates(
+        self,
+        rule: UpdateRule,
+        duty_users: List[User],
+        plan: Optional[RuleExecutionPlan] = None
+    ) -> List[dict]:
         """
         Получить предпросмотр сущностей, которые будут обновлены для конкретного правила
         
         Args:
             rule: Правило обновления
             duty_users: Список пользователей на дежурстве (отфильтрованные по правилу)
+            plan: Заранее построенный план выполнения правила (если не указан, сущности загружаются из Bitrix24)
             
         Returns:
             Список словарей с информацией о сущностях для обновления
         """
-        # Определяем необходимые поля для запроса на основе правила
-        required_fields = self._get_required_fields_for_rule(rule)
-        
-        # Если правило для сделок и включено обновление связанных контактов и компаний,
-        # добавляем поля CONTACT_ID и COMPANY_ID для получения связанных сущностей
-        if rule.entity_type == 'deal' and rule.update_related_contacts_companies:
-            required_fields.extend(['CONTACT_ID', 'COMPANY_ID'])
-        
-        # Для сделок добавляем фильтр по STAGE_SEMANTIC_ID - только сделки "в работе"
-        filter_dict = None
-        if rule.entity_type == 'deal':
-            # STAGE_SEMANTIC_ID = 'P' означает "первичный контакт" (в работе)
-            filter_dict = {'STAGE_SEMANTIC_ID': 'P'}
-            logger.info(f"Применение фильтра для сделок в предпросмотре: только STAGE_SEMANTIC_ID='P' (в работе)")
-        
-        # Получаем все сущности этого типа из Bitrix24 с необходимыми полями
-        entities = await self.bitrix_client.get_entities_list(
-            rule.entity_type,
-            select=required_fields,
-            filter_dict=filter_dict
-        )
-        
-        if not entities:
-            return []
-        
-        # Применяем правило для фильтрации
-        rule_engine = RuleEngine([rule])
-        filtered_entities = rule_engine.apply_rules(entities)
+        if plan is None:
+            plan = await self._build_rule_plan(rule, duty_users)
         
+        filtered_entities = plan.filtered_entities
         if not filtered_entities:
             return []
         
-        # Распределяем сущности между пользователями
-        user_assignments = self._distribute_entities(
-            filtered_entities,
-            duty_users,
-            rule.distribution_percentage
-        )
+        user_assignments = plan.user_assignments
+        entity_index = plan.entity_index
+        duty_users_by_id = {u.id: u for u in duty_users}
         
         # Получаем всех пользователей из БД для получения имен текущих ответственных
         # Сначала собираем ID пользователей из основных сущностей
@@ -838,168 +1314,45 @@ class UpdateService:
                     pass
         
         # Если правило для сделок и включено обновление связанных контактов и компаний,
-        # собираем ID пользователей из связанных сущностей через batch запросы
+        # получаем связанные сущности один раз: они нужны и для сбора ID пользователей, и для предпросмотра
+        deals_contacts_dict = {}
+        deals_companies_dict = {}
+        contacts_data_dict = {}
+        companies_data_dict = {}
+        
         if rule.entity_type == 'deal' and rule.update_related_contacts_companies:
             try:
-                # Получаем все ID сделок
-                deal_ids = []
-                for entity in filtered_entities:
-                    entity_id = entity.get('ID')
-                    if entity_id:
+                deals_contacts_dict, deals_companies_dict, contacts_data_dict, companies_data_dict = \
+                    await self._resolve_deal_related_entities(filtered_entities)
+                
+                # Добавляем ID пользователей из контактов и компаний
+                for related_data in list(contacts_data_dict.values()) + list(companies_data_dict.values()):
+                    current_related_assigned = related_data.get('ASSIGNED_BY_ID')
+                    if current_related_assigned:
                         try:
-                            deal_ids.append(int(entity_id))
+                            all_user_ids.add(int(current_related_assigned))
                         except (ValueError, TypeError):
                             pass
-                
-                if deal_ids:
-                    # Получаем контакты для всех сделок одним batch запросом
-                    deals_contacts = await self.bitrix_client.get_deals_related_contacts_batch(deal_ids)
-                    
-                    # Собираем все уникальные ID контактов
-                    all_contact_ids = set()
-                    for contact_ids in deals_contacts.values():
-                        all_contact_ids.update(contact_ids)
-                    
-                    # Получаем информацию о всех контактах одним запросом
-                    if all_contact_ids:
-                        contacts_dict = await self.bitrix_client.get_entities_batch(
-                            'contact',
-                            list(all_contact_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
-                        
-                        # Добавляем ID пользователей из контактов
-                        for contact_data in contacts_dict.values():
-                            current_contact_assigned = contact_data.get('ASSIGNED_BY_ID')
-                            if current_contact_assigned:
-                                try:
-                                    all_user_ids.add(int(current_contact_assigned))
-                                except (ValueError, TypeError):
-                                    pass
-                    
-                    # Получаем компании для всех сделок одним batch запросом
-                    deals_companies = await self.bitrix_client.get_deals_companies_batch(deal_ids)
-                    
-                    # Собираем все уникальные ID компаний
-                    all_company_ids = {cid for cid in deals_companies.values() if cid is not None}
-                    
-                    # Получаем информацию о всех компаниях одним запросом
-                    if all_company_ids:
-                        companies_dict = await self.bitrix_client.get_entities_batch(
-                            'company',
-                            list(all_company_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
-                        
-                        # Добавляем ID пользователей из компаний
-                        for company_data in companies_dict.values():
-                            current_company_assigned = company_data.get('ASSIGNED_BY_ID')
-                            if current_company_assigned:
-                                try:
-                                    all_user_ids.add(int(current_company_assigned))
-                                except (ValueError, TypeError):
-                                    pass
             except Exception as e:
                 logger.warning(f"Ошибка при batch получении связанных сущностей при сборе ID пользователей: {e}")
         
-        # Получаем пользователей из БД
-        from app.models import User
+        # Имена текущих ответственных: таблица users, затем кэш пользователей Bitrix24
+        # (user.get только по ID, которых нет ни в таблице, ни в кэше)
         users_dict = {}
         if all_user_ids:
-            users = self.db.query(User).filter(User.id.in_(all_user_ids)).all()
-            found_user_ids = {u.id for u in users}
-            missing_user_ids = all_user_ids - found_user_ids
-            
-            # Заполняем словарь найденными пользователями
-            for u in users:
-                users_dict[u.id] = f"{u.name} {u.last_name}".strip() or u.email or f"ID: {u.id}"
-            
-            # Для пользователей, которых нет в БД, получаем имена из Bitrix24
-            if missing_user_ids:
-                logger.debug(f"Получение имен пользователей из Bitrix24 для ID: {missing_user_ids}")
-                try:
-                    bitrix_users = await self.bitrix_client.get_all_users()
-                    for bitrix_user in bitrix_users:
-                        user_id = int(bitrix_user.get('ID', 0))
-                        if user_id in missing_user_ids:
-                            name = bitrix_user.get('NAME', '')
-                            last_name = bitrix_user.get('LAST_NAME', '')
-                            email = bitrix_user.get('EMAIL', '')
-                            user_name = f"{name} {last_name}".strip() or email or f"ID: {user_id}"
-                            users_dict[user_id] = user_name
-                except Exception as e:
-                    logger.warning(f"Ошибка при получении пользователей из Bitrix24: {e}")
-        
-        # Если правило для сделок и включено обновление связанных контактов и компаний,
-        # получаем все данные заранее через batch запросы
-        deals_contacts_dict = {}
-        deals_companies_dict = {}
-        contacts_data_dict = {}
-        companies_data_dict = {}
-        
-        if rule.entity_type == 'deal' and rule.update_related_contacts_companies:
-            try:
-                # Получаем все ID сделок из preview
-                all_preview_deal_ids = []
-                for entity_ids in user_assignments.values():
-                    for entity_id in entity_ids:
-                        entity = next((e for e in filtered_entities if e['ID'] == entity_id), None)
-                        if entity:
-                            try:
-                                all_preview_deal_ids.append(int(entity_id))
-                            except (ValueError, TypeError):
-                                pass
-                
-                if all_preview_deal_ids:
-                    # Получаем контакты для всех сделок одним batch запросом
-                    deals_contacts_dict = await self.bitrix_client.get_deals_related_contacts_batch(all_preview_deal_ids)
-                    logger.info(f"Получены контакты для {len(deals_contacts_dict)} сделок через batch")
-                    for deal_id, contact_ids in deals_contacts_dict.items():
-                        logger.debug(f"Сделка {deal_id}: контакты {contact_ids}")
-                    
-                    # Собираем все уникальные ID контактов
-                    all_contact_ids = set()
-                    for contact_ids in deals_contacts_dict.values():
-                        all_contact_ids.update(contact_ids)
-                    logger.debug(f"Собрано {len(all_contact_ids)} уникальных ID контактов: {all_contact_ids}")
-                    
-                    # Получаем информацию о всех контактах одним запросом
-                    if all_contact_ids:
-                        contacts_data_dict = await self.bitrix_client.get_entities_batch(
-                            'contact',
-                            list(all_contact_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
-                        logger.debug(f"Получены данные для {len(contacts_data_dict)} контактов")
-                    
-                    # Получаем компании для всех сделок одним batch запросом
-                    deals_companies_dict = await self.bitrix_client.get_deals_companies_batch(all_preview_deal_ids)
-                    logger.debug(f"Получены компании для {len(deals_companies_dict)} сделок: {deals_companies_dict}")
-                    
-                    # Собираем все уникальные ID компаний
-                    all_company_ids = {cid for cid in deals_companies_dict.values() if cid is not None}
-                    logger.debug(f"Собрано {len(all_company_ids)} уникальных ID компаний: {all_company_ids}")
-                    
-                    # Получаем информацию о всех компаниях одним запросом
-                    if all_company_ids:
-                        companies_data_dict = await self.bitrix_client.get_entities_batch(
-                            'company',
-                            list(all_company_ids),
-                            select=['ID', 'ASSIGNED_BY_ID']
-                        )
-                        logger.debug(f"Получены данные для {len(companies_data_dict)} компаний")
-            except Exception as e:
-                logger.warning(f"Ошибка при batch получении связанных сущностей для preview: {e}", exc_info=True)
+            resolved_users = await get_user_directory().resolve_users(self.db, all_user_ids)
+            for user_id, user in resolved_users.items():
+                users_dict[user_id] = user['name'] or user['email'] or f"ID: {user_id}"
         
         # Формируем список предпросмотра обновлений
         preview_entities = []
         
         for user_id, entity_ids in user_assignments.items():
-            user = next((u for u in duty_users if u.id == user_id), None)
+            user = duty_users_by_id.get(user_id)
             user_name = f"{user.name} {user.last_name}".strip() if user else f"ID: {user_id}"
             
             for entity_id in entity_ids:
-                entity = next((e for e in filtered_entities if e['ID'] == entity_id), None)
+                entity = entity_index.get(entity_id)
                 if entity:
                     current_assigned = entity.get('ASSIGNED_BY_ID')
                     # Показываем только те, которые нужно обновить
@@ -1146,9 +1499,11 @@ class UpdateService:
         errors = []
         processed_rules = 0
         
-        # Получаем общее количество сущностей для обновления
-        total_entities_count = await self.get_entities_count_for_date(update_date)
-        total_count = total_entities_count.get("total_count", 0)
+        # Общий снимок сущностей запуска: подсчет и планы правил используют одни и те же списки.
+        # Планы потоковой загрузки сохраняются после подсчета и используются для обновления
+        snapshot = self._create_entity_snapshot(rules)
+        kept_plans: Dict[int, RuleExecutionPlan] = {}
+        total_count = await self._count_pending_entities(rules, duty_users, snapshot=snapshot, kept_plans=kept_plans)
         current_entity_count = 0
         
         # Сначала отправляем информацию о начале
@@ -1199,8 +1554,15 @@ class UpdateService:
                 # Фильтруем дежурных пользователей - оставляем только тех, кто есть в правиле
                 rule_duty_users = [u for u in duty_users if u.id in rule_user_ids]
                 
+                # План строится непосредственно перед обновлением правила: снимок уже содержит
+                # изменения предыдущих правил запуска. Сохраненный план потоковой загрузки
+                # используется повторно, изменения предыдущих правил к нему уже применены
+                plan = kept_plans.pop(rule.id, None)
+                if plan is None:
+                    plan = await self._build_rule_plan(rule, rule_duty_users, snapshot=snapshot)
+                
                 # Получаем количество сущностей для этого правила
-                rule_entities_count = await self._get_rule_entities_count(rule, rule_duty_users)
+                rule_entities_count = await self._get_rule_entities_count(rule, rule_duty_users, plan=plan)
                 
                 yield {
                     "type": "progress",
@@ -1243,7 +1605,9 @@ class UpdateService:
                         rule,
                         rule_duty_users,
                         update_date,
-                        progress_callback=progress_callback
+                        progress_callback=progress_callback,
+                        plan=plan,
+                        kept_plans=kept_plans
                     )
                 )
                 
@@ -0,0 +1,198 @@
+from collections import OrderedDict
+from sqlalchemy.orm import Session
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+from app.models import User
+from app.services.bitrix_client import get_bitrix_client
+from app.config import settings
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def format_user_name(name: Optional[str], last_name: Optional[str]) -> str:
+    """Имя и фамилия пользователя через пробел (пустая строка, если оба не заданы)"""
+    return f"{name or ''} {last_name or ''}".strip()
+
+
+class UserDirectory:
+    """
+    Справочник имен пользователей для предпросмотра, истории и графика дежурств
+    
+    Два источника:
+    - таблица users: загружается целиком в память процесса и перечитывается по истечении
+      USER_DIRECTORY_TTL_SECONDS или после синхронизации пользователей (invalidate);
+    - пользователи Bitrix24, которых нет в таблице users (например, ответственные сущностей, не
+      синхронизированные в приложение): запрашиваются одним user.get по списку ID и хранятся в
+      ограниченном кэше (USER_DIRECTORY_REMOTE_CACHE_SIZE, вытеснение давно использованных) с тем же
+      сроком жизни. Ненайденные в Bitrix24 ID тоже кэшируются, чтобы не запрашивать их повторно.
+    Экземпляр общий для процесса (get_user_directory).
+    """
+    
+    def __init__(self, ttl_seconds: Optional[int] = None, remote_cache_size: Optional[int] = None):
+        self.ttl_seconds = settings.user_directory_ttl_seconds if ttl_seconds is None else ttl_seconds
+        self.remote_cache_size = settings.user_directory_remote_cache_size if remote_cache_size is None else remote_cache_size
+        self._lock = threading.Lock()
+        self._local: Optional[Dict[int, Dict[str, Any]]] = None
+        self._local_expires_at = 0.0
+        # {ID: (время истечения monotonic, пользователь или None, если не найден в Bitrix24)}
+        self._remote: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self._stats = {
+            'local_loads': 0,
+            'remote_hits': 0,
+            'remote_requests': 0,
+            'remote_fetched': 0,
+        }
+    
+    def invalidate(self):
+        """Сбросить справочник таблицы users (например, после синхронизации пользователей)"""
+        with self._lock:
+            self._local = None
+    
+    def _get_local(self, db: Session) -> Dict[int, Dict[str, Any]]:
+        """Получить пользователей таблицы users {ID: пользователь} (загружается при первом обращении и по истечении TTL)"""
+        with self._lock:
+            if self._local is not None and self._local_expires_at > time.monotonic():
+                return self._local
+        
+        rows = db.query(User.id, User.name, User.last_name, User.email, User.active).all()
+        local = {
+            row.id: {
+                'id': row.id,
+                'name': format_user_name(row.name, row.last_name),
+                'email': row.email,
+                'active': row.active,
+            }
+            for row in rows
+        }
+        with self._lock:
+            self._local = local
+            self._local_expires_at = time.monotonic() + self.ttl_seconds
+            self._stats['local_loads'] += 1
+        logger.debug(f"Справочник пользователей загружен из базы данных: {len(local)}")
+        return local
+    
+    def get_user(self, db: Session, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Получить пользователя из таблицы users
+        
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+        
+        Returns:
+            Словарь {'id', 'name', 'email', 'active'} или None, если пользователя нет в таблице users
+        """
+        return self._get_local(db).get(user_id)
+    
+    def _get_remote_cached(self, user_ids: Iterable[int]) -> Tuple[Dict[int, Optional[Dict[str, Any]]], List[int]]:
+        """
+        Найти пользователей в кэше Bitrix24
+        
+        Returns:
+            Кортеж (найденные в кэше {ID: пользователь или None}, ID, которых нет в кэше)
+        """
+        cached = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._remote.get(user_id)
+                if entry is None or entry[0] <= now:
+                    self._remote.pop(user_id, None)
+                    missing.append(user_id)
+                    continue
+                self._remote.move_to_end(user_id)
+                cached[user_id] = entry[1]
+            self._stats['remote_hits'] += len(cached)
+        return cached, missing
+    
+    def _put_remote(self, users: Dict[int, Optional[Dict[str, Any]]]):
+        """Сохранить пользователей Bitrix24 в кэш с вытеснением давно использованных"""
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            for user_id, user in users.items():
+                self._remote[user_id] = (expires_at, user)
+                self._remote.move_to_end(user_id)
+            while len(self._remote) > self.remote_cache_size:
+                self._remote.popitem(last=False)
+    
+    async def resolve_users(self, db: Session, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """
+        Получить пользователей по ID: таблица users, затем кэш Bitrix24, затем один user.get по оставшимся ID
+        
+        Args:
+            db: Сессия базы данных
+            user_ids: ID пользователей
+        
+        Returns:
+            Словарь {ID: {'id', 'name', 'email', 'active'}} для найденных пользователей
+        """
+        local = self._get_local(db)
+        result = {}
+        remote_ids = []
+        for user_id in set(user_ids):
+            if not user_id:
+                continue
+            user = local.get(user_id)
+            if user is not None:
+                result[user_id] = user
+            else:
+                remote_ids.append(user_id)
+        
+        cached, missing = self._get_remote_cached(remote_ids)
+        result.update({user_id: user for user_id, user in cached.items() if user is not None})
+        if not missing:
+            return result
+        
+        logger.debug(f"Получение пользователей из Bitrix24 для ID: {missing}")
+        try:
+            bitrix_users = await get_bitrix_client().get_users_by_ids(missing)
+        except Exception as e:
+            logger.warning(f"Ошибка при получении пользователей из Bitrix24: {e}")
+            return result
+        
+        fetched: Dict[int, Optional[Dict[str, Any]]] = {user_id: None for user_id in missing}
+        for bitrix_user in bitrix_users:
+            try:
+                user_id = int(bitrix_user.get('ID'))
+            except (TypeError, ValueError):
+                continue
+            if user_id not in fetched:
+                continue
+            fetched[user_id] = {
+                'id': user_id,
+                'name': format_user_name(bitrix_user.get('NAME'), bitrix_user.get('LAST_NAME')),
+                'email': bitrix_user.get('EMAIL'),
+                'active': bitrix_user.get('ACTIVE') in (True, 'Y'),
+            }
+        self._put_remote(fetched)
+        with self._lock:
+            self._stats['remote_requests'] += 1
+            self._stats['remote_fetched'] += sum(1 for user in fetched.values() if user is not None)
+        
+        result.update({user_id: user for user_id, user in fetched.items() if user is not None})
+        return result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить счетчики справочника"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_users'] = len(self._local) if self._local is not None else None
+            stats['remote_cached'] = len(self._remote)
+        return stats
+
+
+_user_directory: Optional[UserDirectory] = None
+_user_directory_lock = threading.Lock()
+
+
+def get_user_directory() -> UserDirectory:
+    """Получить общий для процесса справочник имен пользователей"""
+    global _user_directory
+    if _user_directory is None:
+        with _user_directory_lock:
+            if _user_directory is None:
+                _user_directory = UserDirectory()
+    return _user_directory
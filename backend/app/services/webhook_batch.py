@@ -0,0 +1,243 @@
+from fast_bitrix24.utils import http_build_query
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+from app.services.bitrix_client import decode_deal_contact_items
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключи команд первого запроса batch (чтение)
+READ_DEAL = 'deal'
+READ_CONTACT_ITEMS = 'contact_items'
+READ_CONTACTS = 'contacts'
+READ_COMPANY = 'company'
+
+# Ключ команды обновления сделки во втором запросе batch (запись)
+WRITE_DEAL = 'deal'
+
+# Поля связанных контактов и компании, необходимые для назначения ответственного
+RELATED_SELECT = ['ID', 'ASSIGNED_BY_ID']
+
+
+def result_reference(command: str, *path: Any) -> str:
+    """
+    Ссылка на результат предыдущей команды того же запроса batch
+    
+    Bitrix24 выполняет команды batch по порядку и подставляет вместо $result[команда][...]
+    значение из результата указанной команды.
+    
+    Args:
+        command: Ключ команды
+        path: Путь внутри результата команды (индексы и имена полей)
+    
+    Returns:
+        Строка вида $result[команда][0][ПОЛЕ]
+    """
+    return f"$result[{command}]" + ''.join(f"[{part}]" for part in path)
+
+
+def build_command(method: str, params: Dict[str, Any], references: Optional[Iterable[Tuple[str, str]]] = None) -> str:
+    """
+    Собрать команду batch 'метод?параметры'
+    
+    Ссылки $result добавляются без URL-кодирования, чтобы Bitrix24 распознал их при подстановке.
+    
+    Args:
+        method: Метод REST API
+        params: Параметры команды
+        references: Пары (имя параметра, ссылка result_reference)
+    
+    Returns:
+        Команда batch
+    """
+    parts = [http_build_query(params).rstrip('&')] if params else []
+    parts.extend(f"{name}={reference}" for name, reference in references or [])
+    return f"{method}?{'&'.join(part for part in parts if part)}"
+
+
+def build_read_commands(
+    deal_id: int,
+    select: List[str],
+    with_related: bool,
+    single_contact: bool,
+    max_contacts: int
+) -> Dict[str, str]:
+    """
+    Построить первый запрос batch: сделка с полями правил, ее контакты и компания
+    
+    Контакты и компания запрашиваются ссылками на результаты предыдущих команд: компания -
+    по COMPANY_ID сделки, контакты - по первым max_contacts элементам crm.deal.contact.items.get
+    (или по CONTACT_ID сделки при single_contact).
+    
+    Args:
+        deal_id: ID сделки
+        select: Поля сделки, необходимые правилам
+        with_related: Запрашивать связанные контакты и компанию
+        single_contact: У сделок не больше одного контакта (BITRIX24_DEALS_SINGLE_CONTACT)
+        max_contacts: Сколько контактов сделки запросить ссылками на результат crm.deal.contact.items.get
+    
+    Returns:
+        Словарь {ключ команды: команда} в порядке выполнения
+    """
+    deal_select = list(select)
+    if with_related:
+        related_fields = ['COMPANY_ID', 'CONTACT_ID'] if single_contact else ['COMPANY_ID']
+        deal_select.extend(field for field in related_fields if field not in deal_select)
+    
+    commands = {
+        READ_DEAL: build_command('crm.deal.list', {'filter': {'ID': deal_id}, 'select': deal_select}),
+    }
+    if not with_related:
+        return commands
+    
+    if single_contact:
+        contact_references = [('filter[ID]', result_reference(READ_DEAL, 0, 'CONTACT_ID'))]
+    else:
+        commands[READ_CONTACT_ITEMS] = build_command('crm.deal.contact.items.get', {'id': deal_id})
+        contact_references = [
+            (f'filter[ID][{index}]', result_reference(READ_CONTACT_ITEMS, index, 'CONTACT_ID'))
+            for index in range(max_contacts)
+        ]
+    commands[READ_CONTACTS] = build_command('crm.contact.list', {'select': RELATED_SELECT}, contact_references)
+    commands[READ_COMPANY] = build_command(
+        'crm.company.list',
+        {'select': RELATED_SELECT},
+        [('filter[ID]', result_reference(READ_DEAL, 0, 'COMPANY_ID'))]
+    )
+    return commands
+
+
+def _positive_id(value: Any) -> Optional[int]:
+    """ID связанной сущности из поля сделки (None для пустого значения и 0)"""
+    try:
+        entity_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return entity_id if entity_id > 0 else None
+
+
+def _rows_by_id(rows: Any, entity_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Строки результата crm.*.list с ID из entity_ids (лишние строки отбрасываются)"""
+    wanted = set(entity_ids)
+    found = {}
+    for row in rows if isinstance(rows, list) else []:
+        entity_id = _positive_id(row.get('ID')) if isinstance(row, dict) else None
+        if entity_id in wanted:
+            found[entity_id] = row
+    return found
+
+
+class DealReadResult:
+    """
+    Разобранный результат первого запроса batch
+    
+    deal - сделка (None, если не найдена), contact_ids - связанные контакты, contacts - прочитанные
+    контакты {ID: строка}, unread_contact_ids - контакты, которые не удалось прочитать в запросе batch
+    (больше max_contacts или ошибка команды), company_id и company - связанная компания.
+    """
+    
+    def __init__(self):
+        self.deal: Optional[Dict[str, Any]] = None
+        self.contact_ids: List[int] = []
+        self.contacts: Dict[int, Dict[str, Any]] = {}
+        self.unread_contact_ids: List[int] = []
+        self.company_id: Optional[int] = None
+        self.company: Optional[Dict[str, Any]] = None
+        self.company_error: Optional[Any] = None
+
+
+def parse_read_results(
+    deal_id: int,
+    results: Dict[str, Any],
+    errors: Dict[str, Any],
+    with_related: bool,
+    single_contact: bool,
+    max_contacts: int
+) -> DealReadResult:
+    """
+    Разобрать результат первого запроса batch
+    
+    Ошибка команды чтения сделки не перехватывается (ValueError), чтобы очередь повторила событие;
+    ошибки чтения контактов и компании логируются.
+    
+    Args:
+        deal_id: ID сделки
+        results: Результаты команд {ключ: результат}
+        errors: Ошибки команд {ключ: описание ошибки}
+        with_related: Запрашивались связанные контакты и компания
+        single_contact: У сделок не больше одного контакта
+        max_contacts: Сколько контактов запрашивалось ссылками
+    
+    Returns:
+        DealReadResult
+    """
+    if READ_DEAL in errors:
+        raise ValueError(f"Ошибка при получении сделки {deal_id}: {errors[READ_DEAL]}")
+    
+    read = DealReadResult()
+    read.deal = _rows_by_id(results.get(READ_DEAL), [deal_id]).get(deal_id)
+    if read.deal is None or not with_related:
+        return read
+    
+    if single_contact:
+        contact_id = _positive_id(read.deal.get('CONTACT_ID'))
+        read.contact_ids = [contact_id] if contact_id else []
+    elif READ_CONTACT_ITEMS in errors:
+        logger.error(f"Ошибка при получении контактов для сделки {deal_id}: {errors[READ_CONTACT_ITEMS]}")
+    else:
+        read.contact_ids = decode_deal_contact_items(results.get(READ_CONTACT_ITEMS))
+    
+    if read.contact_ids:
+        if READ_CONTACTS in errors:
+            logger.warning(f"Ошибка при получении контактов сделки {deal_id} в запросе batch: {errors[READ_CONTACTS]}")
+            read.unread_contact_ids = list(read.contact_ids)
+        else:
+            referenced_ids = read.contact_ids if single_contact else read.contact_ids[:max_contacts]
+            read.contacts = _rows_by_id(results.get(READ_CONTACTS), referenced_ids)
+            read.unread_contact_ids = [contact_id for contact_id in read.contact_ids if contact_id not in referenced_ids]
+    
+    read.company_id = _positive_id(read.deal.get('COMPANY_ID'))
+    if read.company_id:
+        if READ_COMPANY in errors:
+            read.company_error = errors[READ_COMPANY]
+        else:
+            read.company = _rows_by_id(results.get(READ_COMPANY), [read.company_id]).get(read.company_id)
+    return read
+
+
+def write_command_key(entity_type: str, entity_id: int) -> str:
+    """Ключ команды обновления связанной сущности во втором запросе batch"""
+    return f"{entity_type}{entity_id}"
+
+
+def build_write_commands(
+    deal_id: int,
+    user_id: int,
+    contact_ids: Iterable[int],
+    company_id: Optional[int]
+) -> Dict[str, str]:
+    """
+    Построить второй запрос batch: назначение ответственного в сделке, контактах и компании
+    
+    Сделка обновляется первой командой.
+    
+    Args:
+        deal_id: ID сделки
+        user_id: ID назначаемого пользователя
+        contact_ids: Контакты, в которых нужно сменить ответственного
+        company_id: Компания, в которой нужно сменить ответственного (None - не менять)
+    
+    Returns:
+        Словарь {ключ команды: команда} в порядке выполнения
+    """
+    # ВРЕМЕННОЕ РЕШЕНИЕ: также обновляем поле UF_CRM_1770115634 (временное поле, будет удалено позже)
+    fields = {'ASSIGNED_BY_ID': user_id, 'UF_CRM_1770115634': user_id}
+    commands = {WRITE_DEAL: build_command('crm.deal.update', {'ID': deal_id, 'fields': fields})}
+    for contact_id in contact_ids:
+        commands[write_command_key('contact', contact_id)] = build_command(
+            'crm.contact.update', {'ID': contact_id, 'fields': fields}
+        )
+    if company_id:
+        commands[write_command_key('company', company_id)] = build_command(
+            'crm.company.update', {'ID': company_id, 'fields': fields}
+        )
+    return commands
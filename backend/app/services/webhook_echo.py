@@ -0,0 +1,106 @@
+from typing import Dict, List, Iterable, Any, Optional
+from app.config import settings
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookEchoRegistry:
+    """
+    Ожидаемые события OnCrmDealUpdate, вызванные собственной записью приложения в сделку
+    
+    Каждый успешный crm.deal.update приложения (webhook, обновление по планировщику, ручное
+    обновление) регистрирует одно ожидаемое событие по сделке со сроком WEBHOOK_ECHO_TTL_SECONDS.
+    Первое событие обновления сделки в пределах срока считается эхом записи и не обрабатывается:
+    ответственный уже назначен приложением. Обработка события все равно читает текущее состояние
+    сделки, поэтому поглощение одного события на одну запись не теряет изменений, внесенных позже
+    (их события придут следом). Экземпляр общий для процесса (get_webhook_echo_registry): записи
+    из потоков планировщика и события из loop API видят одни и те же ожидания.
+    """
+    
+    def __init__(self, ttl_seconds: Optional[float] = None):
+        self.ttl_seconds = settings.webhook_echo_ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._lock = threading.Lock()
+        # {ID сделки: [время истечения monotonic для каждой записи]}
+        self._expected: Dict[int, List[float]] = {}
+        self._last_prune = time.monotonic()
+    
+    def expect(self, deal_ids: Iterable[Any]):
+        """
+        Зарегистрировать эхо-события после записи в сделки
+        
+        Args:
+            deal_ids: ID обновленных сделок
+        """
+        if self.ttl_seconds <= 0:
+            return
+        
+        now = time.monotonic()
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            for deal_id in deal_ids:
+                try:
+                    self._expected.setdefault(int(deal_id), []).append(expires_at)
+                except (TypeError, ValueError):
+                    continue
+            if now - self._last_prune >= self.ttl_seconds:
+                self._prune(now)
+    
+    def _prune(self, now: float):
+        """Удалить истекшие ожидания (вызывается под блокировкой)"""
+        self._last_prune = now
+        for deal_id in list(self._expected):
+            expiries = [expires_at for expires_at in self._expected[deal_id] if expires_at > now]
+            if expiries:
+                self._expected[deal_id] = expiries
+            else:
+                del self._expected[deal_id]
+    
+    def consume(self, deal_id: int) -> bool:
+        """
+        Поглотить событие обновления сделки, если оно ожидается как эхо собственной записи
+        
+        Args:
+            deal_id: ID сделки из события
+        
+        Returns:
+            True, если событие является эхом и его не нужно обрабатывать
+        """
+        now = time.monotonic()
+        with self._lock:
+            expiries = self._expected.get(deal_id)
+            if not expiries:
+                return False
+            while expiries and expiries[0] <= now:
+                expiries.pop(0)
+            if not expiries:
+                del self._expected[deal_id]
+                return False
+            expiries.pop(0)
+            if not expiries:
+                del self._expected[deal_id]
+            return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить количество сделок и событий, ожидаемых как эхо"""
+        with self._lock:
+            return {
+                'deals': len(self._expected),
+                'events': sum(len(expiries) for expiries in self._expected.values()),
+            }
+
+
+_webhook_echo_registry: Optional[WebhookEchoRegistry] = None
+_webhook_echo_registry_lock = threading.Lock()
+
+
+def get_webhook_echo_registry() -> WebhookEchoRegistry:
+    """Получить общий для процесса реестр ожидаемых эхо-событий"""
+    global _webhook_echo_registry
+    if _webhook_echo_registry is None:
+        with _webhook_echo_registry_lock:
+            if _webhook_echo_registry is None:
+                _webhook_echo_registry = WebhookEchoRegistry()
+    return _webhook_echo_registry
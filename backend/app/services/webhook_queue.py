@@ -0,0 +1,399 @@
+from sqlalchemy import func, update, or_
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Set, Tuple, Callable
+from app.database import SessionLocal
+from app.models import WebhookEvent, WebhookEventStatus
+from app.services.webhook_service import WebhookService
+from app.services.webhook_echo import get_webhook_echo_registry
+from app.services.bitrix_rate_limiter import set_bitrix_priority, PRIORITY_INTERACTIVE
+from app.config import settings
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Интервал проверки очереди без новых событий (повторы после ошибок, события до запуска воркеров)
+POLL_INTERVAL = 1.0
+
+# Событие создания сделки (не бывает эхом собственной записи)
+EVENT_DEAL_ADD = 'ONCRMDEALADD'
+
+# Максимальная пауза перед повтором события после ошибки (секунды)
+MAX_RETRY_DELAY = 300
+
+# Интервал удаления обработанных событий старше WEBHOOK_EVENTS_RETENTION_DAYS (секунды)
+PURGE_INTERVAL = 3600
+
+# Интервал возврата в очередь событий с истекшей арендой (секунды)
+RECOVER_INTERVAL = 60
+
+# Попыток забрать событие, если выбранное событие уже забрал другой воркер
+CLAIM_ATTEMPTS = 3
+
+
+class WebhookQueue:
+    """
+    Очередь webhook событий Bitrix24 в таблице webhook_events с пулом асинхронных воркеров
+    
+    Обработчик webhook только сохраняет событие (enqueue) и сразу отвечает Bitrix24. Воркеры
+    (WEBHOOK_WORKERS задач в event loop приложения) забирают события по порядку поступления и
+    обрабатывают их через WebhookService. События одной сделки не обрабатываются параллельно.
+    При ошибке событие возвращается в очередь с экспоненциальной паузой, после WEBHOOK_MAX_ATTEMPTS
+    попыток помечается как failed.
+    
+    Событие забирается условным UPDATE (только из статуса pending) с владельцем (owner_id процесса)
+    и сроком аренды WEBHOOK_LEASE_SECONDS, поэтому очередь можно обрабатывать несколькими
+    процессами. При остановке очереди прерванные события процесса сразу возвращаются в очередь;
+    события с истекшей арендой (процесс завершился аварийно) возвращаются при запуске и
+    периодически. События других работающих процессов не затрагиваются.
+    
+    Повторные события одной сделки объединяются: новое событие ждет WEBHOOK_COALESCE_SECONDS перед
+    обработкой, и события, пришедшие за это время, не добавляются в очередь, пока ожидающее событие
+    сделки еще не обрабатывалось (обработка все равно читает текущее состояние сделки). События
+    обновления, вызванные собственной записью в сделку, подавляются (WebhookEchoRegistry).
+    """
+    
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal, workers: Optional[int] = None):
+        self.session_factory = session_factory
+        self.workers_count = max(1, settings.webhook_workers if workers is None else workers)
+        self._tasks: List[asyncio.Task] = []
+        # Сигналы воркерам о новых событиях (по одному на событие)
+        self._signals: Optional[asyncio.Queue] = None
+        # Сделки, события которых сейчас обрабатываются
+        self._active_deals: Set[int] = set()
+        self._last_purge = 0.0
+        self._last_recover = 0.0
+        # Владелец событий, забранных воркерами этого процесса
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stats = {
+            'received': 0,
+            'suppressed': 0,
+            'coalesced': 0,
+            'enqueued': 0,
+            'processed': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+    
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+    
+    def register_incoming(self, deal_id: int, data: Dict[str, Any]) -> bool:
+        """
+        Учесть входящее событие по сделке и проверить, не является ли оно эхом собственной записи
+        
+        Args:
+            deal_id: ID сделки
+            data: Данные события
+        
+        Returns:
+            False, если событие - эхо записи приложения в сделку и обрабатывать его не нужно
+        """
+        self._stats['received'] += 1
+        event_type = str(data.get('event') or '').upper()
+        if event_type != EVENT_DEAL_ADD and get_webhook_echo_registry().consume(deal_id):
+            self._stats['suppressed'] += 1
+            return False
+        return True
+    
+    def enqueue(self, db: Session, deal_id: int, data: Dict[str, Any]) -> Tuple[WebhookEvent, bool]:
+        """
+        Сохранить событие в очередь или объединить с ожидающим событием той же сделки
+        
+        Args:
+            db: Сессия базы данных
+            deal_id: ID сделки
+            data: Данные события
+        
+        Returns:
+            Кортеж (событие очереди, True если событие объединено с уже ожидающим событием сделки)
+        """
+        # Ожидающее событие сделки, которое еще не обрабатывалось (повторы после ошибок не учитываются)
+        pending = db.query(WebhookEvent).filter(
+            WebhookEvent.deal_id == deal_id,
+            WebhookEvent.status == WebhookEventStatus.PENDING,
+            WebhookEvent.attempts == 0
+        ).order_by(WebhookEvent.id).first()
+        if pending is not None:
+            self._stats['coalesced'] += 1
+            return pending, True
+        
+        event = WebhookEvent(
+            event_type=data.get('event'),
+            deal_id=deal_id,
+            payload=json.dumps(data, ensure_ascii=False, default=str),
+            status=WebhookEventStatus.PENDING,
+            attempts=0,
+            available_at=datetime.now(timezone.utc) + timedelta(seconds=settings.webhook_coalesce_seconds)
+        )
+        db.add(event)
+        db.commit()
+        db.refresh(event)
+        
+        self._stats['enqueued'] += 1
+        if self._signals is not None:
+            # Воркер получит сигнал, когда окно объединения закончится
+            asyncio.get_running_loop().call_later(settings.webhook_coalesce_seconds, self._signals.put_nowait, None)
+        return event, False
+    
+    async def start(self):
+        """Запустить воркеры в текущем event loop"""
+        if self._tasks:
+            return
+        
+        self._signals = asyncio.Queue()
+        self._recover()
+        self._purge()
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers_count)]
+        logger.info(f"Очередь webhook событий запущена: воркеров {self.workers_count}")
+    
+    async def stop(self):
+        """Остановить воркеры и вернуть в очередь события, обработка которых прервана остановкой"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._release_owned()
+            logger.info("Очередь webhook событий остановлена")
+        self._signals = None
+    
+    def _release_owned(self):
+        """Вернуть в очередь события в обработке, забранные воркерами этого процесса"""
+        db = self.session_factory()
+        try:
+            released = db.query(WebhookEvent).filter(
+                WebhookEvent.status == WebhookEventStatus.PROCESSING,
+                WebhookEvent.locked_by == self.owner_id
+            ).update({
+                WebhookEvent.status: WebhookEventStatus.PENDING,
+                WebhookEvent.locked_by: None,
+                WebhookEvent.locked_until: None,
+            }, synchronize_session=False)
+            db.commit()
+            if released:
+                logger.warning(f"Возвращено в очередь webhook событий, прерванных остановкой: {released}")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при возврате в очередь прерванных webhook событий: {e}")
+        finally:
+            db.close()
+    
+    def _recover(self):
+        """
+        Вернуть в очередь события, обработка которых прервалась остановкой процесса
+        
+        Возвращаются только события в статусе processing с истекшей арендой (или без аренды -
+        события, забранные до появления аренды). События этого процесса не возвращаются.
+        """
+        self._last_recover = time.monotonic()
+        db = self.session_factory()
+        try:
+            recovered = db.query(WebhookEvent).filter(
+                WebhookEvent.status == WebhookEventStatus.PROCESSING,
+                or_(WebhookEvent.locked_until.is_(None), WebhookEvent.locked_until < datetime.now(timezone.utc)),
+                or_(WebhookEvent.locked_by.is_(None), WebhookEvent.locked_by != self.owner_id)
+            ).update({
+                WebhookEvent.status: WebhookEventStatus.PENDING,
+                WebhookEvent.locked_by: None,
+                WebhookEvent.locked_until: None,
+            }, synchronize_session=False)
+            db.commit()
+            if recovered:
+                logger.warning(f"Возвращено в очередь webhook событий с истекшей арендой: {recovered}")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при восстановлении очереди webhook событий: {e}")
+        finally:
+            db.close()
+    
+    def _purge(self):
+        """Удалить обработанные и неудачные события старше WEBHOOK_EVENTS_RETENTION_DAYS"""
+        self._last_purge = time.monotonic()
+        threshold = datetime.now(timezone.utc) - timedelta(days=settings.webhook_events_retention_days)
+        db = self.session_factory()
+        try:
+            deleted = db.query(WebhookEvent).filter(
+                WebhookEvent.status.in_([WebhookEventStatus.DONE, WebhookEventStatus.FAILED]),
+                WebhookEvent.processed_at < threshold
+            ).delete(synchronize_session=False)
+            db.commit()
+            if deleted:
+                logger.info(f"Удалено обработанных webhook событий: {deleted}")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при удалении обработанных webhook событий: {e}")
+        finally:
+            db.close()
+    
+    def _claim(self) -> Optional[Tuple[int, int]]:
+        """
+        Забрать следующее событие, готовое к обработке
+        
+        Событие переводится в processing условным UPDATE (WHERE status = pending): если его уже
+        забрал воркер другого процесса, строка не обновляется и выбирается следующее событие.
+        Выполняется без await, поэтому воркеры одного event loop не забирают одно событие дважды.
+        
+        Returns:
+            Кортеж (ID события, ID сделки) или None, если готовых событий нет
+        """
+        db = self.session_factory()
+        try:
+            skipped: Set[int] = set()
+            for _ in range(CLAIM_ATTEMPTS):
+                now = datetime.now(timezone.utc)
+                query = db.query(WebhookEvent.id, WebhookEvent.deal_id).filter(
+                    WebhookEvent.status == WebhookEventStatus.PENDING,
+                    WebhookEvent.available_at <= now
+                )
+                if self._active_deals:
+                    query = query.filter(WebhookEvent.deal_id.notin_(self._active_deals))
+                if skipped:
+                    query = query.filter(WebhookEvent.id.notin_(skipped))
+                candidate = query.order_by(WebhookEvent.id).first()
+                if candidate is None:
+                    return None
+                
+                claimed = db.execute(
+                    update(WebhookEvent)
+                    .where(WebhookEvent.id == candidate.id, WebhookEvent.status == WebhookEventStatus.PENDING)
+                    .values(
+                        status=WebhookEventStatus.PROCESSING,
+                        attempts=WebhookEvent.attempts + 1,
+                        locked_by=self.owner_id,
+                        locked_until=now + timedelta(seconds=settings.webhook_lease_seconds)
+                    )
+                )
+                db.commit()
+                if claimed.rowcount == 1:
+                    self._active_deals.add(candidate.deal_id)
+                    return candidate.id, candidate.deal_id
+                skipped.add(candidate.id)
+            return None
+        finally:
+            db.close()
+    
+    async def _process(self, event_id: int, deal_id: int):
+        """Обработать событие и сохранить результат или вернуть его в очередь после ошибки"""
+        db = self.session_factory()
+        try:
+            try:
+                result = await WebhookService(db).process_deal_event(deal_id)
+            except Exception as e:
+                db.rollback()
+                event = db.get(WebhookEvent, event_id)
+                event.error = str(e)
+                event.locked_by = None
+                event.locked_until = None
+                if event.attempts >= settings.webhook_max_attempts:
+                    event.status = WebhookEventStatus.FAILED
+                    event.processed_at = datetime.now(timezone.utc)
+                    self._stats['failed'] += 1
+                    logger.error(
+                        f"Ошибка при обработке webhook события {event_id} (сделка {deal_id}), "
+                        f"попыток {event.attempts}, событие не будет повторено: {e}",
+                        exc_info=True
+                    )
+                else:
+                    delay = min(MAX_RETRY_DELAY, 2 ** event.attempts)
+                    event.status = WebhookEventStatus.PENDING
+                    event.available_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                    self._stats['retried'] += 1
+                    logger.error(
+                        f"Ошибка при обработке webhook события {event_id} (сделка {deal_id}), "
+                        f"повтор через {delay} с: {e}"
+                    )
+                db.commit()
+                return
+            
+            event = db.get(WebhookEvent, event_id)
+            event.status = WebhookEventStatus.DONE
+            event.result = json.dumps(result, ensure_ascii=False, default=str)
+            event.error = None
+            event.locked_by = None
+            event.locked_until = None
+            event.processed_at = datetime.now(timezone.utc)
+            db.commit()
+            self._stats['processed'] += 1
+            logger.info(f"Webhook событие {event_id} (сделка {deal_id}) обработано: {result.get('status')}")
+        finally:
+            self._active_deals.discard(deal_id)
+            db.close()
+    
+    async def _worker(self, index: int):
+        """Цикл воркера: обрабатывать события, пока они есть, затем ждать сигнала или интервала опроса"""
+        # Запросы к Bitrix24 из обработки webhook выполняются с наивысшим приоритетом
+        set_bitrix_priority(PRIORITY_INTERACTIVE)
+        
+        while True:
+            try:
+                claimed = self._claim()
+                if claimed is not None:
+                    await self._process(*claimed)
+                    continue
+                
+                if time.monotonic() - self._last_recover >= RECOVER_INTERVAL:
+                    self._recover()
+                if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+                    self._purge()
+                try:
+                    await asyncio.wait_for(self._signals.get(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в воркере {index} очереди webhook событий: {e}", exc_info=True)
+                await asyncio.sleep(POLL_INTERVAL)
+    
+    def get_stats(self, db: Session) -> Dict[str, Any]:
+        """
+        Получить состояние очереди
+        
+        Args:
+            db: Сессия базы данных
+        
+        Returns:
+            Словарь с количеством событий по статусам, возрастом старейшего ожидающего события,
+            количеством воркеров, счетчиками процесса (получено, подавлено эхо, объединено, поставлено
+            в очередь, обработано, повторено, неудачно) и ожидаемыми эхо-событиями
+        """
+        counts = {status.value: 0 for status in WebhookEventStatus}
+        for status, count in db.query(WebhookEvent.status, func.count(WebhookEvent.id)).group_by(WebhookEvent.status):
+            counts[status.value] = count
+        
+        oldest_pending = db.query(func.min(WebhookEvent.created_at)).filter(
+            WebhookEvent.status == WebhookEventStatus.PENDING
+        ).scalar()
+        oldest_pending_seconds = None
+        if oldest_pending is not None:
+            if oldest_pending.tzinfo is None:
+                oldest_pending = oldest_pending.replace(tzinfo=timezone.utc)
+            oldest_pending_seconds = round((datetime.now(timezone.utc) - oldest_pending).total_seconds(), 1)
+        
+        return {
+            'events': counts,
+            'oldest_pending_seconds': oldest_pending_seconds,
+            'workers': len(self._tasks),
+            'active_deals': len(self._active_deals),
+            'counters': dict(self._stats),
+            'echo': get_webhook_echo_registry().get_stats(),
+        }
+
+
+_webhook_queue: Optional[WebhookQueue] = None
+
+
+def get_webhook_queue() -> WebhookQueue:
+    """Получить очередь webhook событий приложения"""
+    global _webhook_queue
+    if _webhook_queue is None:
+        _webhook_queue = WebhookQueue()
+    return _webhook_queue
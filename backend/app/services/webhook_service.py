@@ -0,0 +1,428 @@
+from sqlalchemy.orm import Session
+from typing import List, Dict, Any, Optional, Tuple
+from app.config import settings
+from app.services.bitrix_client import BitrixClient, get_bitrix_client, BATCH_MAX_COMMANDS
+from app.services.webhook_batch import (
+    DealReadResult, RELATED_SELECT, WRITE_DEAL,
+    build_read_commands, parse_read_results, build_write_commands, write_command_key
+)
+from app.services.webhook_echo import get_webhook_echo_registry
+from app.services.duty_registry import get_duty_registry
+from app.services.rule_cursor import get_rule_cursor_registry
+from app.services.history_writer import HistoryWriter
+from app.models import UpdateSource
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Названия связанных сущностей для логов (предложный падеж)
+RELATED_ENTITY_NAMES = {'contact': 'контакте', 'company': 'компании'}
+
+
+def parse_deal_event(data: Dict[str, Any]) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    """
+    Извлечь ID сделки из данных webhook события Bitrix24
+    
+    Формат: document_id[0]='crm', document_id[1]='CCrmDocumentDeal', document_id[2]='DEAL_1'
+    
+    Args:
+        data: Данные события (form-data или JSON)
+    
+    Returns:
+        Кортеж (ID сделки, None) или (None, ответ для событий не по сделке и неверного формата ID)
+    """
+    document_type = data.get('document_id[1]', '')
+    deal_id_str = data.get('document_id[2]', '')
+    
+    # Проверяем, что это событие для сделки
+    if not document_type.startswith('CCrmDocumentDeal') or not deal_id_str.startswith('DEAL_'):
+        logger.warning(f"Событие не относится к сделке: document_type={document_type}, deal_id={deal_id_str}")
+        return None, {"status": "ignored", "reason": "Not a deal event"}
+    
+    # Извлекаем ID сделки из строки вида 'DEAL_1'
+    try:
+        return int(deal_id_str.replace('DEAL_', '')), None
+    except ValueError:
+        logger.error(f"Не удалось извлечь ID сделки из строки: {deal_id_str}")
+        return None, {"status": "error", "reason": "Invalid deal ID format"}
+
+
+def _parse_user_id(value: Any) -> Optional[int]:
+    """ID ответственного из поля ASSIGNED_BY_ID (None, если значение пустое или некорректное)"""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+class WebhookService:
+    """
+    Обработка webhook события по сделке: назначение ответственного из графика дежурств
+    
+    Используется воркерами очереди webhook событий (WebhookQueue) и обработчиком webhook
+    при WEBHOOK_ASYNC_PROCESSING=false. Bitrix24 вызывается двумя запросами batch (webhook_batch.py):
+    чтение сделки с контактами и компанией и запись ответственных. Ошибки чтения и записи сделки
+    не перехватываются, чтобы очередь могла повторить обработку события.
+    """
+    
+    def __init__(self, db: Session, bitrix_client: Optional[BitrixClient] = None):
+        self.db = db
+        self.bitrix_client = bitrix_client or get_bitrix_client()
+    
+    async def _call_batch_chunked(
+        self,
+        commands: Dict[str, str],
+        halt: bool = False
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Выполнить команды последовательными запросами batch по BATCH_MAX_COMMANDS (обычно один запрос)
+        
+        При halt выполнение останавливается на первой ошибке: внутри запроса (halt=1 в batch)
+        и между запросами (следующие части не отправляются).
+        """
+        items = list(commands.items())
+        results = {}
+        errors = {}
+        for i in range(0, len(items), BATCH_MAX_COMMANDS):
+            chunk_results, chunk_errors = await self.bitrix_client.call_batch_commands(
+                dict(items[i:i + BATCH_MAX_COMMANDS]), halt=halt
+            )
+            results.update(chunk_results)
+            errors.update(chunk_errors)
+            if halt and chunk_errors:
+                break
+        return results, errors
+    
+    async def _read_deal(self, deal_id: int, select: List[str], with_related: bool) -> DealReadResult:
+        """
+        Прочитать сделку, ее контакты и компанию одним запросом batch
+        
+        Args:
+            deal_id: ID сделки
+            select: Поля сделки, необходимые применимым правилам
+            with_related: Читать связанные контакты и компанию
+        
+        Returns:
+            DealReadResult
+        """
+        single_contact = settings.bitrix24_deals_single_contact
+        max_contacts = max(1, settings.webhook_batch_max_contacts)
+        commands = build_read_commands(deal_id, select, with_related, single_contact, max_contacts)
+        results, errors = await self.bitrix_client.call_batch_commands(commands)
+        return parse_read_results(deal_id, results, errors, with_related, single_contact, max_contacts)
+    
+    async def _get_related_contacts_to_update(
+        self,
+        deal_id: int,
+        read: DealReadResult,
+        user_id: int
+    ) -> Dict[int, Optional[int]]:
+        """
+        Выбрать контакты сделки, в которых нужно сменить ответственного
+        
+        Контакты, не прочитанные в запросе batch (больше WEBHOOK_BATCH_MAX_CONTACTS или ошибка
+        команды), запрашиваются отдельно.
+        
+        Returns:
+            Словарь {ID контакта: ID прежнего ответственного или None}
+        """
+        contacts = dict(read.contacts)
+        if read.unread_contact_ids:
+            try:
+                contacts.update(await self.bitrix_client.get_entities_batch('contact', read.unread_contact_ids, select=RELATED_SELECT))
+            except Exception as e:
+                logger.error(f"Ошибка при получении контактов для сделки {deal_id}: {e}", exc_info=True)
+        logger.info(f"Получено {len(read.contact_ids)} связанных контактов для сделки {deal_id}: {read.contact_ids}")
+        
+        to_update = {}
+        for contact_id in read.contact_ids:
+            contact_data = contacts.get(contact_id)
+            if not contact_data:
+                logger.warning(f"Контакт {contact_id} не найден в Bitrix24")
+                continue
+            
+            current_contact_assigned = contact_data.get('ASSIGNED_BY_ID')
+            logger.info(f"Контакт {contact_id}: текущий ответственный = {current_contact_assigned}, новый = {user_id}")
+            if current_contact_assigned == str(user_id):
+                logger.info(f"Контакт {contact_id} уже имеет правильного ответственного {user_id}, пропускаем обновление")
+                continue
+            to_update[contact_id] = _parse_user_id(current_contact_assigned)
+        return to_update
+    
+    def _get_related_company_to_update(
+        self,
+        deal_id: int,
+        read: DealReadResult,
+        user_id: int
+    ) -> Optional[Tuple[int, Optional[int]]]:
+        """
+        Проверить компанию сделки: нужно ли сменить ответственного
+        
+        Returns:
+            Кортеж (ID компании, ID прежнего ответственного или None) или None, если обновлять не нужно
+        """
+        if not read.company_id:
+            return None
+        if read.company_error is not None:
+            logger.warning(f"Ошибка при получении компании {read.company_id} для сделки {deal_id}: {read.company_error}")
+            return None
+        if not read.company:
+            logger.warning(f"Компания {read.company_id} не найдена в Bitrix24")
+            return None
+        
+        current_company_assigned = read.company.get('ASSIGNED_BY_ID')
+        logger.info(f"Компания {read.company_id}: текущий ответственный = {current_company_assigned}, новый = {user_id}")
+        if current_company_assigned == str(user_id):
+            logger.info(f"Компания {read.company_id} уже имеет правильного ответственного {user_id}, пропускаем обновление")
+            return None
+        return read.company_id, _parse_user_id(current_company_assigned)
+    
+    async def process_deal_event(self, deal_id: int) -> Dict[str, Any]:
+        """
+        Назначить ответственного в сделке на пользователя, который стоит в графике дежурств на текущий день
+        
+        Args:
+            deal_id: ID сделки
+        
+        Returns:
+            Словарь с результатом обработки (status: success, skipped или error)
+        """
+        # Дежурные пользователи на сегодня (МСК) и применимые правила сделок без запросов к базе данных
+        snapshot = get_duty_registry().get_snapshot(self.db)
+        today = snapshot.date
+        duty_users = snapshot.duty_users
+        
+        if not duty_users:
+            logger.info(f"Нет пользователей на дежурстве на дату {today}, пропускаем обновление сделки {deal_id}")
+            return {
+                "status": "skipped",
+                "reason": "No duty users for today",
+                "deal_id": deal_id,
+                "date": str(today)
+            }
+        
+        if not snapshot.rules_count:
+            logger.info(f"Нет активных правил для сделок, пропускаем обновление сделки {deal_id}")
+            return {
+                "status": "skipped",
+                "reason": "No active rules for deals",
+                "deal_id": deal_id,
+                "date": str(today)
+            }
+        
+        # Применимые правила: пользователи правила есть на дежурстве
+        applicable_rules = snapshot.applicable_rules
+        
+        if not applicable_rules:
+            logger.info(f"Нет применимых правил для сделки {deal_id} (пользователи правил не на дежурстве)")
+            return {
+                "status": "skipped",
+                "reason": "No applicable rules (rule users not on duty)",
+                "deal_id": deal_id,
+                "date": str(today)
+            }
+        
+        # Первое применимое правило определяет пользователей для назначения и обновление связанных сущностей
+        rule = applicable_rules[0]
+        with_related = rule.entity_type == 'deal' and rule.update_related_contacts_companies
+        
+        # Первый запрос batch: сделка с полями, необходимыми применимым правилам, ее контакты и компания
+        read = await self._read_deal(deal_id, snapshot.required_fields, with_related)
+        deal = read.deal
+        
+        if not deal:
+            logger.warning(f"Сделка {deal_id} не найдена в Bitrix24")
+            return {
+                "status": "error",
+                "reason": "Deal not found",
+                "deal_id": deal_id
+            }
+        
+        # Применяем правила для проверки, нужно ли обновлять эту сделку
+        if not snapshot.matches(deal):
+            logger.info(f"Сделка {deal_id} не соответствует правилам фильтрации")
+            return {
+                "status": "skipped",
+                "reason": "Deal does not match rule filters",
+                "deal_id": deal_id,
+                "date": str(today)
+            }
+        
+        # Проверяем, есть ли текущий ответственный в графике дежурств
+        current_assigned_str = deal.get('ASSIGNED_BY_ID')
+        if current_assigned_str:
+            try:
+                current_assigned_id = int(current_assigned_str)
+                # Проверяем, есть ли текущий ответственный среди всех дежурных пользователей
+                if current_assigned_id in snapshot.duty_user_ids:
+                    # Ответственный уже в графике - не обновляем, но записываем в историю
+                    history_writer = HistoryWriter(self.db)
+                    history_writer.add(
+                        entity_type='deal',
+                        entity_id=deal_id,
+                        old_assigned_by_id=current_assigned_id,
+                        new_assigned_by_id=current_assigned_id,
+                        update_source=UpdateSource.WEBHOOK,
+                        rule_id=rule.id
+                    )
+                    history_writer.flush()
+                    
+                    logger.info(
+                        f"Сделка {deal_id} уже имеет ответственного {current_assigned_id}, "
+                        f"который есть в графике дежурств. Обновление не требуется."
+                    )
+                    return {
+                        "status": "skipped",
+                        "reason": "Already assigned to duty user",
+                        "deal_id": deal_id,
+                        "assigned_user_id": current_assigned_id,
+                        "date": str(today)
+                    }
+            except (ValueError, TypeError):
+                # Если не удалось преобразовать в int, продолжаем обычную логику
+                pass
+        
+        # Определяем пользователя для назначения из дежурных пользователей правила
+        rule_duty_users = [u for u in duty_users if u.id in rule.user_ids]
+        
+        if not rule_duty_users:
+            logger.warning(f"Нет дежурных пользователей для правила {rule.id}")
+            return {
+                "status": "error",
+                "reason": "No duty users for rule",
+                "deal_id": deal_id,
+                "rule_id": rule.id
+            }
+        
+        # Выбираем пользователя поочередно по курсору правила (следующий по ID после последнего назначенного);
+        # курсор фиксируется только после успешного обновления сделки
+        cursor_registry = get_rule_cursor_registry()
+        reservation = cursor_registry.peek(rule.id, [u.id for u in rule_duty_users])
+        assigned_user = next(u for u in rule_duty_users if u.id == reservation.user_id)
+        
+        # Проверяем, нужно ли обновлять ответственного
+        current_assigned = deal.get('ASSIGNED_BY_ID')
+        if current_assigned == str(assigned_user.id):
+            cursor_registry.release(reservation)
+            logger.info(f"Сделка {deal_id} уже имеет правильного ответственного {assigned_user.id}")
+            return {
+                "status": "skipped",
+                "reason": "Already assigned correctly",
+                "deal_id": deal_id,
+                "assigned_user_id": assigned_user.id
+            }
+        
+        # Получаем старый ответственный для истории
+        old_assigned_id = _parse_user_id(current_assigned)
+        
+        try:
+            # Связанные контакты и компания, в которых нужно сменить ответственного
+            contacts_to_update = {}
+            company_to_update = None
+            if with_related:
+                contacts_to_update = await self._get_related_contacts_to_update(deal_id, read, assigned_user.id)
+                company_to_update = self._get_related_company_to_update(deal_id, read, assigned_user.id)
+            
+            # Второй запрос batch: ответственный в сделке, контактах и компании
+            write_commands = build_write_commands(
+                deal_id,
+                assigned_user.id,
+                contacts_to_update.keys(),
+                company_to_update[0] if company_to_update else None
+            )
+            # halt: при ошибке обновления сделки (первая команда) контакты и компания не обновляются,
+            # событие повторяется очередью без частично примененных изменений
+            write_results, write_errors = await self._call_batch_chunked(write_commands, halt=True)
+            
+            if WRITE_DEAL in write_errors or WRITE_DEAL not in write_results:
+                raise ValueError(
+                    f"Ошибка при обновлении ответственного в сделке {deal_id}: {write_errors.get(WRITE_DEAL, 'нет результата')}"
+                )
+            
+            # Запрос остановлен на ошибке связанной сущности - оставшиеся команды выполняем без остановки
+            not_executed = {
+                key: command for key, command in write_commands.items()
+                if key not in write_results and key not in write_errors
+            }
+            if not_executed:
+                more_results, more_errors = await self._call_batch_chunked(not_executed)
+                write_results.update(more_results)
+                write_errors.update(more_errors)
+        except BaseException:
+            # Сделка не обновлена - пользователь не назначен, очередь правила не расходуется
+            cursor_registry.release(reservation)
+            raise
+        cursor_registry.commit(reservation)
+        get_webhook_echo_registry().expect([deal_id])
+        
+        # Записываем историю изменения
+        history_writer = HistoryWriter(self.db)
+        history_writer.add(
+            entity_type='deal',
+            entity_id=deal_id,
+            old_assigned_by_id=old_assigned_id,
+            new_assigned_by_id=assigned_user.id,
+            update_source=UpdateSource.WEBHOOK,
+            rule_id=rule.id
+        )
+        
+        # История связанных сущностей записывается только для успешно выполненных команд
+        updated_contacts = []
+        updated_company = None
+        related_updates = [('contact', contact_id, old_id) for contact_id, old_id in contacts_to_update.items()]
+        if company_to_update:
+            related_updates.append(('company', company_to_update[0], company_to_update[1]))
+        
+        for entity_type, entity_id, old_entity_assigned_id in related_updates:
+            key = write_command_key(entity_type, entity_id)
+            if key in write_errors or key not in write_results:
+                logger.error(
+                    f"Ошибка при обновлении ответственного в {RELATED_ENTITY_NAMES[entity_type]} {entity_id} "
+                    f"для сделки {deal_id}: "
+                    f"{write_errors.get(key, 'нет результата')}"
+                )
+                continue
+            
+            history_writer.add(
+                entity_type=entity_type,
+                entity_id=entity_id,
+                old_assigned_by_id=old_entity_assigned_id,
+                new_assigned_by_id=assigned_user.id,
+                update_source=UpdateSource.WEBHOOK,
+                rule_id=rule.id,
+                related_entity_type='deal',
+                related_entity_id=deal_id
+            )
+            if entity_type == 'contact':
+                updated_contacts.append(entity_id)
+            else:
+                updated_company = entity_id
+            logger.info(
+                f"Обновлен ответственный в {RELATED_ENTITY_NAMES[entity_type]} {entity_id} для сделки {deal_id} "
+                f"на пользователя {assigned_user.id}"
+            )
+        
+        history_writer.flush()
+        
+        logger.info(
+            f"Обновлен ответственный в сделке {deal_id} на пользователя {assigned_user.id} "
+            f"({assigned_user.name} {assigned_user.last_name})"
+        )
+        
+        result = {
+            "status": "success",
+            "deal_id": deal_id,
+            "assigned_user_id": assigned_user.id,
+            "assigned_user_name": f"{assigned_user.name} {assigned_user.last_name}".strip(),
+            "date": str(today),
+            "rule_id": rule.id
+        }
+        
+        if updated_contacts:
+            result["updated_contacts"] = updated_contacts
+        if updated_company:
+            result["updated_company"] = updated_company
+        
+        return result
@@ -0,0 +1,59 @@
+"""add_entity_mirror_tables
+
+Revision ID: 5d2f8c41a7b9
+Revises: 13a4e683a360
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2f8c41a7b9'
+down_revision: Union[str, None] = '13a4e683a360'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'entity_mirror',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('entity_type', sa.String(), nullable=False),
+        sa.Column('entity_id', sa.Integer(), nullable=False),
+        sa.Column('assigned_by_id', sa.Integer(), nullable=True),
+        sa.Column('category_id', sa.String(), nullable=True),
+        sa.Column('stage_id', sa.String(), nullable=True),
+        sa.Column('stage_semantic_id', sa.String(), nullable=True),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.Column('contact_id', sa.Integer(), nullable=True),
+        sa.Column('date_modify', sa.String(), nullable=True),
+        sa.Column('synced_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('entity_type', 'entity_id', name='uq_entity_mirror_entity')
+    )
+    op.create_index(op.f('ix_entity_mirror_id'), 'entity_mirror', ['id'], unique=False)
+    op.create_index(op.f('ix_entity_mirror_entity_type'), 'entity_mirror', ['entity_type'], unique=False)
+    op.create_table(
+        'entity_sync_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('entity_type', sa.String(), nullable=False),
+        sa.Column('high_water_mark', sa.String(), nullable=True),
+        sa.Column('entities_count', sa.Integer(), nullable=False),
+        sa.Column('last_full_sync_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('last_delta_sync_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('entity_type')
+    )
+    op.create_index(op.f('ix_entity_sync_state_id'), 'entity_sync_state', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_entity_sync_state_id'), table_name='entity_sync_state')
+    op.drop_table('entity_sync_state')
+    op.drop_index(op.f('ix_entity_mirror_entity_type'), table_name='entity_mirror')
+    op.drop_index(op.f('ix_entity_mirror_id'), table_name='entity_mirror')
+    op.drop_table('entity_mirror')
@@ -0,0 +1,61 @@
+"""add_metadata_cache_tables
+
+Revision ID: a3c9e1f7b2d4
+Revises: 5d2f8c41a7b9
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c9e1f7b2d4'
+down_revision: Union[str, None] = '5d2f8c41a7b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('field_mappings', sa.Column('field_data', sa.Text(), nullable=True))
+    op.add_column('field_mappings', sa.Column('content_hash', sa.String(), nullable=True))
+    op.create_table(
+        'metadata_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('scope', sa.String(), nullable=False),
+        sa.Column('item_id', sa.String(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('semantics', sa.String(), nullable=True),
+        sa.Column('sort', sa.Integer(), nullable=True),
+        sa.Column('content_hash', sa.String(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('kind', 'scope', 'item_id', name='uq_metadata_items_item')
+    )
+    op.create_index(op.f('ix_metadata_items_id'), 'metadata_items', ['id'], unique=False)
+    op.create_index(op.f('ix_metadata_items_scope'), 'metadata_items', ['scope'], unique=False)
+    op.create_table(
+        'metadata_cache_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('cache_key', sa.String(), nullable=False),
+        sa.Column('content_hash', sa.String(), nullable=True),
+        sa.Column('items_count', sa.Integer(), nullable=False),
+        sa.Column('checked_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('changed_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('cache_key')
+    )
+    op.create_index(op.f('ix_metadata_cache_state_id'), 'metadata_cache_state', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_metadata_cache_state_id'), table_name='metadata_cache_state')
+    op.drop_table('metadata_cache_state')
+    op.drop_index(op.f('ix_metadata_items_scope'), table_name='metadata_items')
+    op.drop_index(op.f('ix_metadata_items_id'), table_name='metadata_items')
+    op.drop_table('metadata_items')
+    op.drop_column('field_mappings', 'content_hash')
+    op.drop_column('field_mappings', 'field_data')
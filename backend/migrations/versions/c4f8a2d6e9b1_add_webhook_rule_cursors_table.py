@@ -0,0 +1,34 @@
+"""add_webhook_rule_cursors_table
+
+Revision ID: c4f8a2d6e9b1
+Revises: b7e4d2a9c1f3
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f8a2d6e9b1'
+down_revision: Union[str, None] = 'b7e4d2a9c1f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'webhook_rule_cursors',
+        sa.Column('rule_id', sa.Integer(), nullable=False),
+        sa.Column('last_user_id', sa.Integer(), nullable=False),
+        sa.Column('assignments', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+        sa.ForeignKeyConstraint(['rule_id'], ['update_rules.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('rule_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('webhook_rule_cursors')
@@ -0,0 +1,30 @@
+"""add_webhook_event_lease
+
+Revision ID: d9a3f6b1c5e8
+Revises: c4f8a2d6e9b1
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9a3f6b1c5e8'
+down_revision: Union[str, None] = 'c4f8a2d6e9b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Владелец и срок аренды события в обработке: после перезапуска в очередь возвращаются
+    # только события с истекшей арендой, а не события других процессов
+    op.add_column('webhook_events', sa.Column('locked_by', sa.String(), nullable=True))
+    op.add_column('webhook_events', sa.Column('locked_until', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('webhook_events', 'locked_until')
+    op.drop_column('webhook_events', 'locked_by')
@@ -0,0 +1,108 @@
+"""
+Бенчмарк поиска сущностей после распределения между дежурными пользователями
+
+Сравнивает поиск сущности по назначенному ID через индекс (UpdateService._build_entity_index)
+с прежним линейным проходом next(...) по отфильтрованному списку на каждый ID (O(n^2)).
+В обоих вариантах время включает UpdateService._distribute_entities.
+
+Линейный проход на 100k сделок занимает минуты, поэтому по умолчанию для размеров больше
+LINEAR_FULL_LIMIT он измеряется на выборке ID и пересчитывается на весь список;
+полный прогон - с аргументом --full.
+
+Запуск из каталога backend:
+    python -m scripts.benchmark_entity_index [--full]
+"""
+import logging
+import random
+import sys
+import time
+from types import SimpleNamespace
+from typing import List, Dict, Any
+
+from app.services.update_service import UpdateService
+
+SIZES = [1_000, 10_000, 100_000]
+DUTY_USERS_COUNT = 5
+LINEAR_FULL_LIMIT = 10_000
+LINEAR_SAMPLE = 1_000
+
+
+def build_entities(count: int) -> List[Dict[str, Any]]:
+    """Сгенерировать сделки, похожие на результат crm.deal.list"""
+    rnd = random.Random(42)
+    return [
+        {'ID': str(i), 'ASSIGNED_BY_ID': str(rnd.randint(1, 50)), 'CONTACT_ID': str(100000 + i), 'COMPANY_ID': None}
+        for i in range(1, count + 1)
+    ]
+
+
+def indexed_lookup(service: UpdateService, entities: List[Dict[str, Any]], duty_users: List[Any]) -> int:
+    """Распределение и поиск сущностей через индекс по ID (текущая реализация)"""
+    distribution = service._distribute_entities(entities, duty_users, 100)
+    entity_index = service._build_entity_index(entities)
+    found = 0
+    for entity_ids in distribution.values():
+        for entity_id in entity_ids:
+            if entity_index.get(entity_id) is not None:
+                found += 1
+    return found
+
+
+def linear_lookup(service: UpdateService, entities: List[Dict[str, Any]], duty_users: List[Any], step: int = 1) -> int:
+    """
+    Распределение и поиск сущностей линейным проходом (прежняя реализация)
+    
+    При step > 1 ищется каждый step-й назначенный ID: выборка равномерно покрывает весь список,
+    поэтому среднее время одного поиска такое же, как при полном прогоне.
+    """
+    distribution = service._distribute_entities(entities, duty_users, 100)
+    found = 0
+    position = 0
+    for entity_ids in distribution.values():
+        for entity_id in entity_ids:
+            position += 1
+            if position % step:
+                continue
+            entity = next((e for e in entities if e['ID'] == entity_id), None)
+            if entity is not None:
+                found += 1
+    return found
+
+
+def measure(func, *args) -> float:
+    """Время выполнения (секунды)"""
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    logging.disable(logging.WARNING)
+    full = '--full' in sys.argv[1:]
+    # _distribute_entities и _build_entity_index не используют сессию базы данных
+    service = UpdateService.__new__(UpdateService)
+    duty_users = [SimpleNamespace(id=10 + i) for i in range(DUTY_USERS_COUNT)]
+    
+    print(f"Дежурных пользователей: {DUTY_USERS_COUNT}, распределение 100%")
+    for size in SIZES:
+        entities = build_entities(size)
+        
+        assert indexed_lookup(service, entities, duty_users) == size, "Индекс нашел не все сущности"
+        indexed_time = measure(indexed_lookup, service, entities, duty_users)
+        
+        if full or size <= LINEAR_FULL_LIMIT:
+            linear_time = measure(linear_lookup, service, entities, duty_users)
+            linear_note = ''
+        else:
+            step = size // LINEAR_SAMPLE
+            linear_time = measure(linear_lookup, service, entities, duty_users, step) * step
+            linear_note = f" (оценка по {LINEAR_SAMPLE} ID, полный прогон: --full)"
+        
+        print(
+            f"{size:>7} сделок: индекс {indexed_time:.4f} с, линейный проход {linear_time:.2f} с{linear_note}, "
+            f"ускорение {linear_time / indexed_time:.0f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Бенчмарк записи истории изменений (UpdateHistory) в SQLite
+
+Сравнивает построчное добавление ORM объектов (db.add на каждую запись) с пакетной
+вставкой через HistoryWriter (Core insert() в режиме executemany частями).
+
+Запуск из каталога backend:
+    python -m scripts.benchmark_history_writer
+"""
+import logging
+import os
+import tempfile
+import time
+from typing import List, Dict, Any
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app.models import UpdateHistory, UpdateSource
+from app.services.history_writer import HistoryWriter
+
+ROWS_COUNT = 30_000
+
+
+def build_entries(count: int) -> List[Dict[str, Any]]:
+    """Сгенерировать записи истории как при обновлении сделок с контактами"""
+    entries = []
+    for i in range(count):
+        entry = {
+            'entity_type': 'deal' if i % 3 == 0 else 'contact',
+            'entity_id': 100000 + i,
+            'old_assigned_by_id': i % 50,
+            'new_assigned_by_id': 1 + i % 7,
+            'update_source': UpdateSource.SCHEDULED,
+            'rule_id': None,
+        }
+        if entry['entity_type'] == 'contact':
+            entry['related_entity_type'] = 'deal'
+            entry['related_entity_id'] = 100000 + i - i % 3
+        entries.append(entry)
+    return entries
+
+
+def write_orm(db, entries: List[Dict[str, Any]]):
+    """Прежний способ: ORM объект на каждую запись"""
+    for entry in entries:
+        db.add(UpdateHistory(**entry))
+    db.commit()
+
+
+def write_bulk(db, entries: List[Dict[str, Any]]):
+    """Пакетная вставка через HistoryWriter"""
+    history_writer = HistoryWriter(db)
+    history_writer.extend(entries)
+    history_writer.flush()
+
+
+def measure(name: str, writer, entries: List[Dict[str, Any]]):
+    """Записать entries в новую базу SQLite и вывести скорость"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'history.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        try:
+            started = time.perf_counter()
+            writer(db, entries)
+            elapsed = time.perf_counter() - started
+            
+            stored = db.query(func.count(UpdateHistory.id)).scalar()
+            sources = {row[0] for row in db.query(UpdateHistory.update_source).distinct()}
+            assert stored == len(entries), f"{name}: записано {stored} из {len(entries)}"
+            assert sources == {UpdateSource.SCHEDULED}, f"{name}: неверный update_source {sources}"
+        finally:
+            db.close()
+            engine.dispose()
+    
+    print(f"{name}: {len(entries)} строк за {elapsed:.3f} с ({len(entries) / elapsed:,.0f} строк/с)")
+
+
+def main():
+    logging.disable(logging.WARNING)
+    entries = build_entries(ROWS_COUNT)
+    measure("ORM db.add", write_orm, entries)
+    measure("HistoryWriter (Core insert)", write_bulk, entries)
+
+
+if __name__ == '__main__':
+    main()
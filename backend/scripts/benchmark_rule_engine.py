@@ -0,0 +1,94 @@
+"""
+Микробенчмарк проверки условий combined с логикой OR
+
+Сравнивает скомпилированный однопроходный предикат RuleEngine с прежней реализацией,
+которая прогоняла каждое условие по всему списку, собирала ID в множество и сканировала список повторно.
+
+Запуск из каталога backend:
+    python -m scripts.benchmark_rule_engine
+"""
+import logging
+import random
+import time
+from typing import List, Dict, Any
+
+from app.services.rule_engine import RuleEngine
+
+ENTITIES_COUNT = 100_000
+CONDITIONS_COUNT = 10
+REPEATS = 3
+
+
+def build_entities(count: int) -> List[Dict[str, Any]]:
+    """Сгенерировать сущности, похожие на сделки из crm.deal.list"""
+    rnd = random.Random(42)
+    return [
+        {
+            'ID': str(i),
+            'ASSIGNED_BY_ID': str(rnd.randint(1, 50)),
+            'CATEGORY_ID': str(rnd.randint(0, 5)),
+            'STAGE_ID': rnd.choice(['NEW', 'PREPARATION', 'C1:NEW', 'C2:EXECUTING']),
+            'OPPORTUNITY': f"{rnd.randint(0, 100000)}.00",
+            'TITLE': rnd.choice(['Сделка', 'Заказ', 'Повторная продажа', 'Тендер']),
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def build_conditions(count: int) -> List[Dict[str, Any]]:
+    """Сгенерировать разнотипные условия для combined"""
+    templates = [
+        {'type': 'assigned_by_condition', 'operator': 'in', 'user_ids': [1, 2, 3]},
+        {'type': 'field_condition', 'field_id': 'OPPORTUNITY', 'operator': 'greater_than', 'value': '95000'},
+        {'type': 'field_condition', 'field_id': 'TITLE', 'operator': 'contains', 'value': 'Тендер'},
+        {'type': 'field_condition', 'field_id': 'CATEGORY_ID', 'category_ids': [5], 'stage_ids': ['C2:EXECUTING']},
+        {'type': 'field_condition', 'field_id': 'OPPORTUNITY', 'operator': 'less_than', 'value': '1000'},
+    ]
+    return [dict(templates[i % len(templates)]) for i in range(count)]
+
+
+def legacy_or(entities: List[Dict[str, Any]], conditions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Прежняя реализация OR: список на каждое условие, множество ID и повторный проход"""
+    result_set = set()
+    for condition in conditions:
+        predicate = RuleEngine.compile_condition(condition['type'], condition)
+        filtered = [e for e in entities if predicate(e)]
+        for entity in filtered:
+            result_set.add(entity.get('ID'))
+    return [e for e in entities if e.get('ID') in result_set]
+
+
+def measure(func, *args) -> float:
+    """Лучшее время выполнения из нескольких повторов (секунды)"""
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    logging.disable(logging.WARNING)
+    entities = build_entities(ENTITIES_COUNT)
+    conditions = build_conditions(CONDITIONS_COUNT)
+    
+    predicate = RuleEngine.compile_condition('combined', {'logic': 'OR', 'conditions': conditions})
+    compiled_or = lambda items: [e for e in items if predicate(e)]
+    
+    legacy_ids = [e['ID'] for e in legacy_or(entities, conditions)]
+    compiled_ids = [e['ID'] for e in compiled_or(entities)]
+    assert legacy_ids == compiled_ids, "Результаты реализаций различаются"
+    
+    legacy_time = measure(legacy_or, entities, conditions)
+    compiled_time = measure(compiled_or, entities)
+    
+    print(f"Сущностей: {ENTITIES_COUNT}, условий OR: {CONDITIONS_COUNT}, подходит: {len(compiled_ids)}")
+    print(f"Прежняя реализация (множество ID): {legacy_time:.3f} с")
+    print(f"Однопроходный предикат:           {compiled_time:.3f} с")
+    print(f"Ускорение: {legacy_time / compiled_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
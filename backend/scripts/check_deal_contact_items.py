@@ -0,0 +1,67 @@
+"""
+Проверка разбора ответа crm.deal.contact.items.get (decode_deal_contact_items)
+
+Проверяет форматы, в которых ответ приходит из fast_bitrix24 и из команд batch: список контактов,
+один контакт словарем, ответ с ключом result, batch формат, а также пустые ответы и ответы с ошибкой.
+
+Запуск из каталога backend:
+    python -m scripts.check_deal_contact_items
+"""
+import logging
+import sys
+from typing import List, Any, Tuple
+
+from app.services.bitrix_client import decode_deal_contact_items
+
+CONTACT_ITEMS = [
+    {'CONTACT_ID': 6, 'SORT': 10, 'ROLE_ID': 0, 'IS_PRIMARY': 'Y'},
+    {'CONTACT_ID': '8', 'SORT': 20, 'ROLE_ID': 0, 'IS_PRIMARY': 'N'},
+]
+
+# (описание, ответ, ожидаемые ID контактов)
+CASES: List[Tuple[str, Any, List[int]]] = [
+    ('список контактов', CONTACT_ITEMS, [6, 8]),
+    ('один контакт словарем', {'CONTACT_ID': '6', 'IS_PRIMARY': 'Y'}, [6]),
+    ('result со списком', {'result': CONTACT_ITEMS}, [6, 8]),
+    ('result со словарем', {'result': {'CONTACT_ID': 6}}, [6]),
+    ('result с пустым списком', {'result': []}, []),
+    ('batch формат', {'result': {'result': {'order0000000000': CONTACT_ITEMS}}}, [6, 8]),
+    ('batch формат с ключом команды', {'result': {'result': {'contact_items': CONTACT_ITEMS}, 'result_error': []}}, [6, 8]),
+    ('batch формат: берется первая команда', {'result': {'result': {'a': [{'CONTACT_ID': 1}], 'b': [{'CONTACT_ID': 2}]}}}, [1]),
+    ('batch формат со списком результатов', {'result': {'result': [CONTACT_ITEMS]}}, [6, 8]),
+    ('batch формат с пустым результатом', {'result': {'result': {}}}, []),
+    ('batch формат с пустым списком контактов', {'result': {'result': {'order0000000000': []}}}, []),
+    ('пустой список', [], []),
+    ('пустой словарь', {}, []),
+    ('None', None, []),
+    ('result None', {'result': None}, []),
+    ('ответ с ошибкой', {'error': 'ACCESS_DENIED', 'error_description': 'Access denied.'}, []),
+    ('batch с ошибкой команды', {'result': {'result': {}, 'result_error': {'contact_items': {'error': 'NOT_FOUND'}}}}, []),
+    ('строка', 'error', []),
+    ('число', 0, []),
+    ('пустой и нулевой CONTACT_ID', [{'CONTACT_ID': 0}, {'CONTACT_ID': None}, {'CONTACT_ID': ''}, {'CONTACT_ID': 5}], [5]),
+    ('некорректный CONTACT_ID', [{'CONTACT_ID': 'abc'}, {'CONTACT_ID': [1]}, {'CONTACT_ID': 7}], [7]),
+    ('элементы не словари', [None, 'x', 3, {'CONTACT_ID': 9}], [9]),
+    ('элемент без CONTACT_ID', [{'ID': 4}, {'CONTACT_ID': 4}], [4]),
+]
+
+
+def main():
+    logging.disable(logging.WARNING)
+    failures = 0
+    for description, response, expected in CASES:
+        try:
+            actual = decode_deal_contact_items(response)
+        except Exception as e:
+            actual = f"{type(e).__name__}: {e}"
+        status = 'OK' if actual == expected else 'ОШИБКА'
+        if actual != expected:
+            failures += 1
+        print(f"{status:7} {description}: {actual} (ожидается {expected})")
+    
+    print(f"Проверок: {len(CASES)}, ошибок: {failures}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Проверка приоритетов BitrixRateLimiter при паузе метода по time.operating
+
+Проверяет:
+- запрос manual, ожидающий паузу метода, не задерживает запросы bulk к другим методам;
+- запрос manual, ожидающий токен, по-прежнему пропускается раньше запроса bulk.
+
+Запуск из каталога backend:
+    python -m scripts.check_rate_limiter_priority
+"""
+import asyncio
+import logging
+import sys
+import time
+from typing import List
+
+from app.services.bitrix_rate_limiter import BitrixRateLimiter, PRIORITY_MANUAL, PRIORITY_BULK
+
+PAUSE_SECONDS = 3.0
+BULK_REQUESTS = 20
+
+
+async def check_paused_method() -> List[str]:
+    limiter = BitrixRateLimiter(rate=100, burst=50, interactive_reserve=10, operating_soft_limit=400)
+    pause_until = time.monotonic() + PAUSE_SECONDS
+    limiter._method_pause_until['crm.deal.list'] = pause_until
+    
+    manual = asyncio.create_task(limiter.acquire(PRIORITY_MANUAL, ['crm.deal.list']))
+    await asyncio.sleep(0.1)
+    
+    started = time.monotonic()
+    for _ in range(BULK_REQUESTS):
+        await limiter.acquire(PRIORITY_BULK, ['crm.deal.update'])
+    bulk_seconds = time.monotonic() - started
+    
+    await manual
+    
+    failures = []
+    if time.monotonic() < pause_until:
+        failures.append("запрос manual к приостановленному методу выполнен до окончания паузы")
+    if bulk_seconds >= 1.0:
+        failures.append(f"{BULK_REQUESTS} запросов bulk к другому методу ждали {bulk_seconds:.2f} с паузы manual")
+    print(f"Запросы bulk при паузе метода manual: {bulk_seconds:.2f} с")
+    return failures
+
+
+async def check_token_priority() -> List[str]:
+    limiter = BitrixRateLimiter(rate=10, burst=10, interactive_reserve=4, operating_soft_limit=400)
+    limiter._tokens = 0.0
+    order = []
+    
+    async def request(priority: int, name: str):
+        await limiter.acquire(priority, ['crm.deal.update'])
+        order.append(name)
+    
+    manual = asyncio.create_task(request(PRIORITY_MANUAL, 'manual'))
+    await asyncio.sleep(0.05)
+    bulk = asyncio.create_task(request(PRIORITY_BULK, 'bulk'))
+    await asyncio.gather(manual, bulk)
+    
+    if order != ['manual', 'bulk']:
+        return [f"порядок запросов {order}, ожидается manual раньше bulk"]
+    return []
+
+
+def main():
+    logging.disable(logging.WARNING)
+    failures = []
+    for name, check in (('пауза метода', check_paused_method), ('приоритет ожидания токена', check_token_priority)):
+        check_failures = asyncio.run(check())
+        for failure in check_failures:
+            print(f"ОШИБКА  {name}: {failure}")
+        print(f"{'OK' if not check_failures else 'ОШИБКА':7} {name}")
+        failures.extend(check_failures)
+    
+    print(f"Ошибок: {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Проверка эквивалентности переноса условий правил в фильтр Bitrix24
+
+Для набора правил сравнивает два способа отбора сделок на имитации портала:
+- прежний: весь список сделок (только базовый фильтр) и проверка правила целиком в Python;
+- текущий: get_entities_list с фильтром RuleEngine.compile_pushdown и RuleEngine.apply_residual.
+
+Имитация портала выполняет фильтр так, как это делает crm.deal.list: список значений - вхождение,
+!ПОЛЕ - исключение, >ПОЛЕ / <ПОЛЕ - числовое сравнение (для множественного поля достаточно одного значения),
+%ПОЛЕ - поиск подстроки без учета регистра. Покрываются assigned_by in/not_in, CATEGORY_ID/STAGE_ID,
+> / < по обычным и пользовательским (UF_) полям, % и комбинированные правила AND/OR.
+
+Запуск из каталога backend:
+    python -m scripts.check_rule_pushdown
+"""
+import asyncio
+import json
+import logging
+import random
+import sys
+from typing import List, Dict, Any, Optional
+
+from app.models import UpdateRule
+from app.services.rule_engine import RuleEngine
+
+ENTITIES_COUNT = 3000
+RANDOM_RULES_COUNT = 400
+BASE_FILTER = {'STAGE_SEMANTIC_ID': 'P'}
+
+# Типы полей сделки, как их возвращает crm.deal.fields
+FIELD_TYPES = {
+    'ASSIGNED_BY_ID': 'user',
+    'CATEGORY_ID': 'crm_category',
+    'STAGE_ID': 'crm_status',
+    'OPPORTUNITY': 'double',
+    'PROBABILITY': 'integer',
+    'TITLE': 'string',
+    'UF_CRM_AMOUNT': 'double',
+    'UF_CRM_NOTE': 'string',
+}
+
+STAGES = ['NEW', 'PREPARATION', 'C1:NEW', 'C1:EXECUTING', 'C2:NEW', 'C2:EXECUTING']
+TITLES = ['Сделка', 'Тендер', 'тендер на поставку', 'ТЕНДЕР', 'Заказ', '', None]
+NOTES = ['срочно', 'Срочно', 'не срочно', '', None, ['срочно', 'позже'], ['Позже']]
+
+
+def build_entities(count: int) -> List[Dict[str, Any]]:
+    """Сгенерировать сделки в формате crm.deal.list (значения - строки, множественные UF - списки)"""
+    rnd = random.Random(7)
+    entities = []
+    for i in range(1, count + 1):
+        amount_kind = rnd.random()
+        if amount_kind < 0.15:
+            amount = None
+        elif amount_kind < 0.35:
+            amount = [str(rnd.randint(0, 2000)) for _ in range(rnd.randint(0, 3))]
+        else:
+            amount = f"{rnd.randint(0, 2000)}.{rnd.randint(0, 99):02d}"
+        entities.append({
+            'ID': str(i),
+            'STAGE_SEMANTIC_ID': rnd.choice(['P', 'P', 'P', 'S', 'F']),
+            'ASSIGNED_BY_ID': str(rnd.randint(1, 12)),
+            'CATEGORY_ID': str(rnd.randint(0, 3)),
+            'STAGE_ID': rnd.choice(STAGES),
+            'OPPORTUNITY': rnd.choice([f"{rnd.randint(0, 100000)}.00", '0', None]),
+            'PROBABILITY': rnd.choice([str(rnd.randint(0, 100)), None]),
+            'TITLE': rnd.choice(TITLES),
+            'UF_CRM_AMOUNT': amount,
+            'UF_CRM_NOTE': rnd.choice(NOTES),
+        })
+    return entities
+
+
+def _as_values(value: Any) -> List[Any]:
+    """Значения поля: множественное поле - список, пустое - пустой список"""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _to_number(value: Any) -> Optional[float]:
+    """Числовое значение поля (None, если поле не число)"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _matches_filter_item(entity: Dict[str, Any], key: str, expected: Any) -> bool:
+    """Проверить одно условие фильтра crm.*.list"""
+    prefix = ''
+    while key[:1] in ('!', '>', '<', '%'):
+        prefix += key[0]
+        key = key[1:]
+    values = _as_values(entity.get(key))
+    
+    if prefix == '':
+        allowed = {str(v) for v in _as_values(expected)}
+        return any(str(v) in allowed for v in values)
+    if prefix == '!':
+        excluded = {str(v) for v in _as_values(expected)}
+        return not any(str(v) in excluded for v in values)
+    if prefix in ('>', '<'):
+        numbers = [n for n in (_to_number(v) for v in values) if n is not None]
+        bound = float(expected)
+        return any(n > bound if prefix == '>' else n < bound for n in numbers)
+    if prefix == '%':
+        needle = str(expected).lower()
+        return any(needle in str(v).lower() for v in values if v not in (None, ''))
+    raise ValueError(f"Неподдерживаемый префикс фильтра: {prefix}{key}")
+
+
+class FakePortal:
+    """Имитация crm.deal.list с выполнением фильтра на стороне портала"""
+    
+    def __init__(self, entities: List[Dict[str, Any]]):
+        self.entities = entities
+        self.returned = 0
+    
+    async def get_entities_list(
+        self,
+        entity_type: str,
+        select: Optional[List[str]] = None,
+        filter_dict: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        result = [
+            dict(entity) for entity in self.entities
+            if all(_matches_filter_item(entity, key, value) for key, value in (filter_dict or {}).items())
+        ]
+        self.returned += len(result)
+        return result
+
+
+def build_fixed_configs() -> List[Dict[str, Any]]:
+    """Правила, покрывающие каждый вид переносимого условия"""
+    return [
+        {'rule_type': 'assigned_by_condition', 'condition_config': {'operator': 'in', 'user_ids': [1, 2, 3]}},
+        {'rule_type': 'assigned_by_condition', 'condition_config': {'operator': 'equals', 'user_ids': ['5']}},
+        {'rule_type': 'assigned_by_condition', 'condition_config': {'operator': 'not_in', 'user_ids': [10, 11]}},
+        {'rule_type': 'assigned_by_condition', 'condition_config': {'operator': 'not_equals', 'user_ids': [4]}},
+        {'rule_type': 'assigned_by_condition', 'condition_config': {'operator': 'in', 'user_ids': []}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'CATEGORY_ID', 'category_id': 1}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'CATEGORY_ID', 'category_ids': [1, 2], 'stage_ids': ['C1:NEW', 'C2:EXECUTING']}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'STAGE_ID', 'stage_ids': ['NEW', 'PREPARATION']}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'OPPORTUNITY', 'operator': 'greater_than', 'value': '50000'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'OPPORTUNITY', 'operator': 'less_than', 'value': 1000}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'PROBABILITY', 'operator': 'greater_than', 'value': '50'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'UF_CRM_AMOUNT', 'operator': 'greater_than', 'value': '1000'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'UF_CRM_AMOUNT', 'operator': 'less_than', 'value': '500'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'TITLE', 'operator': 'greater_than', 'value': '10'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'OPPORTUNITY', 'operator': 'greater_than', 'value': 'abc'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'TITLE', 'operator': 'contains', 'value': 'Тендер'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'UF_CRM_NOTE', 'operator': 'contains', 'value': 'срочно'}},
+        {'rule_type': 'field_condition', 'condition_config': {'field_id': 'TITLE', 'operator': 'contains', 'value': ''}},
+        {'rule_type': 'combined', 'condition_config': {'logic': 'AND', 'conditions': [
+            {'type': 'assigned_by_condition', 'operator': 'not_in', 'user_ids': [10, 11]},
+            {'type': 'field_condition', 'field_id': 'CATEGORY_ID', 'category_ids': [1], 'stage_ids': ['C1:NEW']},
+            {'type': 'field_condition', 'field_id': 'UF_CRM_AMOUNT', 'operator': 'greater_than', 'value': '100'},
+        ]}},
+        {'rule_type': 'combined', 'condition_config': {'logic': 'AND', 'conditions': [
+            {'type': 'field_condition', 'field_id': 'OPPORTUNITY', 'operator': 'greater_than', 'value': '1000'},
+            {'type': 'field_condition', 'field_id': 'OPPORTUNITY', 'operator': 'greater_than', 'value': '20000'},
+            {'type': 'combined', 'logic': 'AND', 'conditions': [
+                {'type': 'assigned_by_condition', 'operator': 'in', 'user_ids': [1, 2, 3, 4, 5]},
+                {'type': 'assigned_by_condition', 'operator': 'in', 'user_ids': [3, 4]},
+            ]},
+        ]}},
+        {'rule_type': 'combined', 'condition_config': {'logic': 'AND', 'conditions': [
+            {'type': 'field_condition', 'field_id': 'TITLE', 'operator': 'contains', 'value': 'тендер'},
+            {'type': 'combined', 'logic': 'OR', 'conditions': [
+                {'type': 'assigned_by_condition', 'operator': 'in', 'user_ids': [1]},
+                {'type': 'field_condition', 'field_id': 'STAGE_ID', 'stage_ids': ['NEW']},
+            ]},
+        ]}},
+        {'rule_type': 'combined', 'condition_config': {'logic': 'OR', 'conditions': [
+            {'type': 'assigned_by_condition', 'operator': 'in', 'user_ids': [1, 2]},
+            {'type': 'field_condition', 'field_id': 'OPPORTUNITY', 'operator': 'less_than', 'value': '100'},
+        ]}},
+        {'rule_type': 'combined', 'condition_config': {'logic': 'AND', 'conditions': []}},
+    ]
+
+
+def random_condition(rnd: random.Random, depth: int = 0) -> Dict[str, Any]:
+    """Сгенерировать случайное условие (при depth < 2 - возможно, вложенное combined)"""
+    kind = rnd.randint(0, 5 if depth < 2 else 4)
+    if kind == 0:
+        return {
+            'type': 'assigned_by_condition',
+            'operator': rnd.choice(['in', 'not_in', 'equals', 'not_equals']),
+            'user_ids': rnd.sample(range(1, 13), rnd.randint(1, 4)),
+        }
+    if kind == 1:
+        condition = {'type': 'field_condition', 'field_id': 'CATEGORY_ID'}
+        if rnd.random() < 0.7:
+            condition['category_ids'] = rnd.sample(range(0, 4), rnd.randint(1, 2))
+        if rnd.random() < 0.6 or 'category_ids' not in condition:
+            condition['stage_ids'] = rnd.sample(STAGES, rnd.randint(1, 3))
+        return condition
+    if kind in (2, 3):
+        return {
+            'type': 'field_condition',
+            'field_id': rnd.choice(['OPPORTUNITY', 'PROBABILITY', 'UF_CRM_AMOUNT']),
+            'operator': rnd.choice(['greater_than', 'less_than']),
+            'value': rnd.choice([str(rnd.randint(0, 2000)), rnd.randint(0, 100000), f"{rnd.randint(0, 500)}.5"]),
+        }
+    if kind == 4:
+        return {
+            'type': 'field_condition',
+            'field_id': rnd.choice(['TITLE', 'UF_CRM_NOTE']),
+            'operator': 'contains',
+            'value': rnd.choice(['Тендер', 'тендер', 'срочно', 'Позже', 'Сделка']),
+        }
+    return {
+        'type': 'combined',
+        'logic': rnd.choice(['AND', 'AND', 'OR']),
+        'conditions': [random_condition(rnd, depth + 1) for _ in range(rnd.randint(1, 3))],
+    }
+
+
+def build_random_configs(count: int) -> List[Dict[str, Any]]:
+    """Случайные правила всех типов"""
+    rnd = random.Random(42)
+    configs = []
+    for _ in range(count):
+        condition = random_condition(rnd)
+        rule_type = condition.pop('type')
+        configs.append({'rule_type': rule_type, 'condition_config': condition})
+    return configs
+
+
+async def check_rule(portal: FakePortal, entities: List[Dict[str, Any]], rule: UpdateRule) -> Optional[str]:
+    """
+    Сравнить отбор сделок с переносом условий и без него
+    
+    Returns:
+        Описание расхождения или None
+    """
+    condition_config = json.loads(rule.condition_config)
+    predicate = RuleEngine.compile_condition(rule.rule_type, condition_config)
+    expected = {
+        e['ID'] for e in entities
+        if all(_matches_filter_item(e, key, value) for key, value in BASE_FILTER.items()) and predicate(e)
+    }
+    
+    pushdown = RuleEngine.compile_pushdown(rule, field_types=FIELD_TYPES, base_filter=BASE_FILTER)
+    filter_dict = {**BASE_FILTER, **pushdown.filter_dict}
+    fetched = await portal.get_entities_list('deal', filter_dict=filter_dict)
+    actual = {e['ID'] for e in RuleEngine([rule]).apply_residual(fetched, rule, pushdown)}
+    
+    if actual == expected:
+        return None
+    return (
+        f"{rule.rule_type} {rule.condition_config}: фильтр {filter_dict}, "
+        f"лишние {sorted(actual - expected, key=int)[:10]}, пропущенные {sorted(expected - actual, key=int)[:10]}"
+    )
+
+
+async def run() -> int:
+    entities = build_entities(ENTITIES_COUNT)
+    portal = FakePortal(entities)
+    configs = build_fixed_configs() + build_random_configs(RANDOM_RULES_COUNT)
+    
+    mismatches = []
+    pushed_rules = 0
+    fully_pushed_rules = 0
+    for rule_id, config in enumerate(configs, start=1):
+        rule = UpdateRule(
+            id=rule_id,
+            entity_type='deal',
+            entity_name=f'Проверка {rule_id}',
+            rule_type=config['rule_type'],
+            condition_config=json.dumps(config['condition_config'], ensure_ascii=False),
+        )
+        pushdown = RuleEngine.compile_pushdown(rule, field_types=FIELD_TYPES, base_filter=BASE_FILTER)
+        pushed_rules += bool(pushdown.filter_dict)
+        fully_pushed_rules += pushdown.fully_pushed
+        
+        mismatch = await check_rule(portal, entities, rule)
+        if mismatch:
+            mismatches.append(mismatch)
+    
+    print(f"Сделок: {ENTITIES_COUNT}, правил: {len(configs)}")
+    print(f"С переносом в фильтр: {pushed_rules}, полностью в фильтре: {fully_pushed_rules}")
+    base_count = sum(1 for e in entities if all(_matches_filter_item(e, key, value) for key, value in BASE_FILTER.items()))
+    print(f"Сделок получено с портала: {portal.returned} (только с базовым фильтром было бы {base_count * len(configs)})")
+    
+    if mismatches:
+        print(f"Расхождения: {len(mismatches)}")
+        for mismatch in mismatches[:20]:
+            print(f"  {mismatch}")
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+def main():
+    logging.disable(logging.WARNING)
+    sys.exit(asyncio.run(run()))
+
+
+if __name__ == '__main__':
+    main()
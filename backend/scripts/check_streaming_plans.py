@@ -0,0 +1,147 @@
+"""
+Проверка повторного использования планов потоковой загрузки (BITRIX24_STREAM_ENTITIES)
+
+Подсчет сущностей запуска (UpdateService._count_pending_entities) сохраняет планы правил,
+построенные потоковой загрузкой, чтобы обновление правила не загружало выборку второй раз.
+Скрипт проверяет на имитации портала:
+- каждая выборка, не общая с другими правилами, загружается при подсчете ровно один раз;
+- запись поля, не входящего в условия правила (ASSIGNED_BY_ID для правила по воронке),
+  применяется к сохраненному плану, и он остается актуальным;
+- запись поля из условий правила (ASSIGNED_BY_ID для правила по ответственному) делает план
+  устаревшим: такой план строится заново.
+
+Запуск из каталога backend:
+    python -m scripts.check_streaming_plans
+"""
+import asyncio
+import json
+import logging
+import sys
+from collections import Counter
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional
+
+from app.config import settings
+from app.models import UpdateRule, UpdateRuleUser
+from app.services.update_service import UpdateService, RuleExecutionPlan
+
+DEALS_COUNT = 300
+DUTY_USERS = [SimpleNamespace(id=10), SimpleNamespace(id=11)]
+PAGE_SIZE = 50
+
+
+class FakePortal:
+    """Имитация портала: iter_entities выполняет фильтр списком значений и !ПОЛЕ"""
+    
+    def __init__(self, deals: List[Dict[str, Any]]):
+        self.deals = deals
+        self.calls = Counter()
+    
+    @staticmethod
+    def _match(deal: Dict[str, Any], filter_dict: Optional[Dict[str, Any]]) -> bool:
+        for key, value in (filter_dict or {}).items():
+            field = key.lstrip('!')
+            values = {str(v) for v in (value if isinstance(value, list) else [value])}
+            if key.startswith('!') == (str(deal.get(field)) in values):
+                return False
+        return True
+    
+    async def iter_entities(self, entity_type: str, select: List[str] = None, filter_dict: Dict = None):
+        self.calls[json.dumps(filter_dict, sort_keys=True)] += 1
+        fields = set(select or []) | {'ID', 'ASSIGNED_BY_ID'}
+        rows = [{f: d.get(f) for f in fields} for d in self.deals if self._match(d, filter_dict)]
+        for start in range(0, len(rows), PAGE_SIZE):
+            yield rows[start:start + PAGE_SIZE]
+
+
+def build_rule(rule_id: int, rule_type: str, condition_config: Dict[str, Any]) -> UpdateRule:
+    """Правило для сделок с дежурными пользователями 10 и 11"""
+    rule = UpdateRule(
+        id=rule_id,
+        entity_type='deal',
+        entity_name=f'Правило {rule_id}',
+        rule_type=rule_type,
+        condition_config=json.dumps(condition_config),
+        distribution_percentage=100,
+        update_related_contacts_companies=False
+    )
+    rule.rule_users = [UpdateRuleUser(user_id=user.id) for user in DUTY_USERS]
+    return rule
+
+
+def build_updates(plan: RuleExecutionPlan) -> List[Dict[str, Any]]:
+    """Обновления, которые запишет правило по своему плану"""
+    return [
+        {'ID': entity_id, 'fields': {'ASSIGNED_BY_ID': user_id}}
+        for user_id, entity_ids in plan.user_assignments.items()
+        for entity_id in entity_ids
+    ]
+
+
+async def run() -> List[str]:
+    deals = [
+        {'ID': str(i), 'ASSIGNED_BY_ID': str(i % 3 + 1), 'CATEGORY_ID': str(i % 4), 'STAGE_SEMANTIC_ID': 'P'}
+        for i in range(1, DEALS_COUNT + 1)
+    ]
+    portal = FakePortal(deals)
+    
+    # Сервису без базы данных нужны только клиент Bitrix24 и типы полей
+    service = UpdateService.__new__(UpdateService)
+    service.bitrix_client = portal
+    service._entity_mirror = None
+    service._field_types = {'deal': {'CATEGORY_ID': 'crm_category', 'ASSIGNED_BY_ID': 'user'}}
+    
+    by_category = [build_rule(1, 'field_condition', {'field_id': 'CATEGORY_ID', 'category_ids': [0]}),
+                   build_rule(2, 'field_condition', {'field_id': 'CATEGORY_ID', 'category_ids': [1]})]
+    by_assigned = build_rule(3, 'assigned_by_condition', {'operator': 'not_in', 'user_ids': [10, 11]})
+    rules = by_category + [by_assigned]
+    
+    failures = []
+    kept_plans: Dict[int, RuleExecutionPlan] = {}
+    total_count = await service._count_pending_entities(rules, DUTY_USERS, kept_plans=kept_plans)
+    
+    expected_total = len(deals) // 4 * 2 + len(deals)
+    if total_count != expected_total:
+        failures.append(f"количество сущностей {total_count}, ожидается {expected_total}")
+    if sorted(kept_plans) != [1, 2, 3]:
+        failures.append(f"сохранены планы правил {sorted(kept_plans)}, ожидаются [1, 2, 3]")
+    if any(count != 1 for count in portal.calls.values()) or len(portal.calls) != len(rules):
+        failures.append(f"загрузки выборок при подсчете: {dict(portal.calls)}, ожидается по одной на правило")
+    if failures:
+        return failures
+    
+    # Правило 1 записывает ASSIGNED_BY_ID своих сделок
+    first_plan = kept_plans.pop(1)
+    updates = build_updates(first_plan)
+    stale = [rule_id for rule_id, plan in kept_plans.items() if not plan.apply_updates('deal', updates)]
+    
+    if stale != [3]:
+        failures.append(f"устаревшие планы {stale}, ожидается [3] (условие правила по ASSIGNED_BY_ID)")
+    second_plan = kept_plans[2]
+    if second_plan.pending_count != len(deals) // 4:
+        failures.append(f"план правила 2 изменен чужими обновлениями: {second_plan.pending_count} сущностей")
+    
+    # Запись правила 2 применяется к своему плану: обновлять больше нечего
+    second_plan.apply_updates('deal', build_updates(second_plan))
+    if second_plan.pending_count != 0:
+        failures.append(f"после применения обновлений в плане правила 2 осталось {second_plan.pending_count} сущностей")
+    
+    # Обновления связанных сущностей не влияют на план сделок
+    if not second_plan.apply_updates('contact', [{'ID': '1', 'fields': {'CATEGORY_ID': '9'}}]):
+        failures.append("план сделок устарел после обновления контактов")
+    
+    return failures
+
+
+def main():
+    logging.disable(logging.WARNING)
+    settings.bitrix24_stream_entities = True
+    failures = asyncio.run(run())
+    for failure in failures:
+        print(f"ОШИБКА  {failure}")
+    print(f"Планы потоковой загрузки: {'OK' if not failures else f'ошибок: {len(failures)}'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
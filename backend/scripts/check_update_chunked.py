@@ -0,0 +1,145 @@
+"""
+Проверка массового обновления частями (BitrixClient.update_entities_chunked)
+
+На фейковом сервере Bitrix24 из scripts.loadtest_webhook проверяет:
+- результат batch разбирается по командам: при ошибке части команд (сделка не найдена)
+  остальные обновления части попадают в updated, а в failed - только ID с ошибкой;
+- ограничение BITRIX24_MAX_CONCURRENT_BATCHES общее для процесса: обновления из нескольких
+  потоков со своими event loop не выполняют больше batch запросов одновременно.
+
+Запуск из каталога backend:
+    python -m scripts.check_update_chunked
+"""
+import asyncio
+import logging
+import sys
+import threading
+from typing import List, Dict, Any
+
+from scripts.loadtest_webhook import FakeBitrix, DEALS_COUNT
+
+from app.config import settings
+from app.services.bitrix_client import get_bitrix_client
+
+MISSING_IDS = [DEALS_COUNT + 1, DEALS_COUNT + 7]
+THREADS_COUNT = 3
+
+
+class CheckedPortal(FakeBitrix):
+    """Фейковый портал: crm.*.update несуществующей сущности возвращает ошибку, считаются одновременные batch"""
+    
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    def execute(self, method: str, params: Dict[str, Any]) -> Any:
+        if method.endswith('.update'):
+            entity_type = method.split('.')[1]
+            if int(params.get('ID') or 0) not in self.entities[entity_type]:
+                raise ValueError('Not found')
+        return super().execute(method, params)
+    
+    async def handle(self, request):
+        if request.match_info['method'] != 'batch':
+            return await super().handle(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().handle(request)
+        finally:
+            self.in_flight -= 1
+
+
+def build_updates(entity_ids: List[int], user_id: int) -> List[Dict[str, Any]]:
+    return [{'ID': entity_id, 'fields': {'ASSIGNED_BY_ID': user_id}} for entity_id in entity_ids]
+
+
+def check_partial_errors(portal: CheckedPortal) -> List[str]:
+    failures = []
+    entity_ids = list(range(1, DEALS_COUNT + 1)) + MISSING_IDS
+    chunk_counts = []
+    
+    async def on_chunk(count: int):
+        chunk_counts.append(count)
+    
+    async def run():
+        client = get_bitrix_client()
+        try:
+            return await client.update_entities_chunked('deal', build_updates(entity_ids, 10), on_chunk=on_chunk, chunk_size=10)
+        finally:
+            await client.close_loop_session()
+    
+    result = asyncio.run(run())
+    updated_ids = sorted(update['ID'] for update in result['updated'])
+    failed_ids = sorted(failure['ID'] for failure in result['failed'])
+    
+    if updated_ids != list(range(1, DEALS_COUNT + 1)):
+        failures.append(f"updated: {updated_ids}, ожидаются все существующие сделки")
+    if failed_ids != MISSING_IDS:
+        failures.append(f"failed: {failed_ids}, ожидается {MISSING_IDS}")
+    if not all('Not found' in failure['error'] for failure in result['failed']):
+        failures.append(f"описание ошибки не содержит ответ Bitrix24: {result['failed']}")
+    if len(result['errors']) != len(MISSING_IDS):
+        failures.append(f"errors: {result['errors']}")
+    if sum(chunk_counts) != DEALS_COUNT:
+        failures.append(f"on_chunk получил {sum(chunk_counts)} обновлений, ожидается {DEALS_COUNT}")
+    not_written = [deal_id for deal_id, deal in portal.entities['deal'].items() if deal['ASSIGNED_BY_ID'] != '10']
+    if not_written:
+        failures.append(f"не записаны сделки {not_written}")
+    return failures
+
+
+def check_process_limit(portal: CheckedPortal) -> List[str]:
+    portal.max_in_flight = 0
+    errors = []
+    
+    def run_thread(user_id: int):
+        async def run():
+            client = get_bitrix_client()
+            try:
+                updates = build_updates(list(range(1, DEALS_COUNT + 1)), user_id)
+                return await client.update_entities_chunked('deal', updates, chunk_size=2)
+            finally:
+                await client.close_loop_session()
+        
+        try:
+            result = asyncio.run(run())
+            if result['errors']:
+                errors.append(result['errors'][0])
+        except Exception as e:
+            errors.append(str(e))
+    
+    threads = [threading.Thread(target=run_thread, args=(11 + i,)) for i in range(THREADS_COUNT)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    failures = [f"ошибка обновления: {error}" for error in errors]
+    limit = settings.bitrix24_max_concurrent_batches
+    if portal.max_in_flight > limit:
+        failures.append(f"одновременных batch запросов {portal.max_in_flight}, ограничение {limit}")
+    print(f"Одновременных batch запросов из {THREADS_COUNT} потоков: {portal.max_in_flight} (ограничение {limit})")
+    return failures
+
+
+def main():
+    logging.disable(logging.ERROR)
+    portal = CheckedPortal()
+    portal.start()
+    
+    failures = []
+    for name, check in (('ошибки части команд', check_partial_errors), ('общее ограничение процесса', check_process_limit)):
+        check_failures = check(portal)
+        for failure in check_failures:
+            print(f"ОШИБКА  {name}: {failure}")
+        print(f"{'OK' if not check_failures else 'ОШИБКА':7} {name}")
+        failures.extend(check_failures)
+    
+    print(f"Ошибок: {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Проверка захвата и восстановления событий очереди webhook (WebhookQueue) несколькими процессами
+
+На временной базе SQLite проверяет:
+- воркеры нескольких очередей (как в разных процессах), одновременно забирающие события из
+  потоков, забирают каждое событие ровно один раз (условный UPDATE ... WHERE status = pending);
+- при запуске возвращаются в очередь только события с истекшей арендой: события с действующей
+  арендой другого процесса и события своего процесса не затрагиваются;
+- при остановке очереди ее незавершенные события сразу возвращаются в очередь.
+
+Запуск из каталога backend:
+    python -m scripts.check_webhook_queue_claims
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+_tmp_dir = tempfile.mkdtemp(prefix='check_webhook_queue_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'queue.db')}"
+os.environ['SCHEDULER_ENABLED'] = 'false'
+
+from app.config import settings  # noqa: E402
+from app.database import Base, engine, SessionLocal  # noqa: E402
+from app.models import WebhookEvent, WebhookEventStatus  # noqa: E402
+from app.services.webhook_queue import WebhookQueue  # noqa: E402
+
+EVENTS_COUNT = 200
+QUEUES_COUNT = 4
+
+
+def enqueue_events(count: int, first_deal_id: int = 1):
+    """Добавить события по разным сделкам, готовые к обработке"""
+    db = SessionLocal()
+    try:
+        queue = WebhookQueue(workers=1)
+        for deal_id in range(first_deal_id, first_deal_id + count):
+            queue.enqueue(db, deal_id, {'event': 'ONCRMDEALADD'})
+    finally:
+        db.close()
+
+
+def check_concurrent_claims() -> List[str]:
+    enqueue_events(EVENTS_COUNT)
+    queues = [WebhookQueue(workers=1) for _ in range(QUEUES_COUNT)]
+    claims = Counter()
+    errors = []
+    lock = threading.Lock()
+    
+    def run(queue: WebhookQueue):
+        while True:
+            try:
+                claimed = queue._claim()
+            except Exception as e:
+                errors.append(str(e))
+                return
+            if claimed is None:
+                return
+            with lock:
+                claims[claimed[0]] += 1
+    
+    threads = [threading.Thread(target=run, args=(queue,)) for queue in queues]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    failures = [f"ошибка захвата: {error}" for error in errors[:3]]
+    duplicates = [event_id for event_id, count in claims.items() if count > 1]
+    if duplicates:
+        failures.append(f"события забраны несколько раз: {duplicates[:10]}")
+    if len(claims) != EVENTS_COUNT:
+        failures.append(f"забрано {len(claims)} событий из {EVENTS_COUNT}")
+    
+    db = SessionLocal()
+    try:
+        owners = {queue.owner_id for queue in queues}
+        events = db.query(WebhookEvent).all()
+        if any(e.status != WebhookEventStatus.PROCESSING or e.attempts != 1 or e.locked_by not in owners for e in events):
+            failures.append("у забранных событий неверный статус, количество попыток или владелец")
+        db.query(WebhookEvent).delete()
+        db.commit()
+    finally:
+        db.close()
+    return failures
+
+
+def check_recover_and_release() -> List[str]:
+    enqueue_events(3, first_deal_id=1000)
+    crashed = WebhookQueue(workers=1)
+    alive = WebhookQueue(workers=1)
+    restarted = WebhookQueue(workers=1)
+    crashed_event = crashed._claim()
+    alive_event = alive._claim()
+    own_event = restarted._claim()
+    
+    db = SessionLocal()
+    try:
+        # Аренда события аварийно завершенного процесса истекла
+        db.query(WebhookEvent).filter(WebhookEvent.id == crashed_event[0]).update(
+            {WebhookEvent.locked_until: datetime.now(timezone.utc) - timedelta(seconds=1)}
+        )
+        db.commit()
+    finally:
+        db.close()
+    
+    restarted._recover()
+    
+    failures = []
+    db = SessionLocal()
+    try:
+        statuses = {e.id: e.status for e in db.query(WebhookEvent)}
+        if statuses[crashed_event[0]] != WebhookEventStatus.PENDING:
+            failures.append("событие с истекшей арендой не возвращено в очередь")
+        if statuses[alive_event[0]] != WebhookEventStatus.PROCESSING:
+            failures.append("событие другого работающего процесса возвращено в очередь")
+        if statuses[own_event[0]] != WebhookEventStatus.PROCESSING:
+            failures.append("событие своего процесса возвращено в очередь")
+    finally:
+        db.close()
+    
+    alive._release_owned()
+    db = SessionLocal()
+    try:
+        event = db.get(WebhookEvent, alive_event[0])
+        if event.status != WebhookEventStatus.PENDING or event.locked_by is not None:
+            failures.append("при остановке событие процесса не возвращено в очередь")
+        if db.get(WebhookEvent, own_event[0]).status != WebhookEventStatus.PROCESSING:
+            failures.append("при остановке возвращено событие другого процесса")
+    finally:
+        db.close()
+    return failures
+
+
+def main():
+    logging.disable(logging.ERROR)
+    settings.webhook_coalesce_seconds = 0
+    Base.metadata.create_all(bind=engine)
+    
+    failures = []
+    for name, check in (('одновременный захват', check_concurrent_claims), ('восстановление и остановка', check_recover_and_release)):
+        check_failures = check()
+        for failure in check_failures:
+            print(f"ОШИБКА  {name}: {failure}")
+        print(f"{'OK' if not check_failures else 'ОШИБКА':7} {name}")
+        failures.extend(check_failures)
+    
+    print(f"Ошибок: {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""
+Нагрузочный тест обработчика webhook Bitrix24 (POST /api/webhook/bitrix)
+
+Отправляет пачки событий по сделкам в приложение (ASGI вызов без HTTP сервера) при встроенном
+фейковом сервере Bitrix24 с задержкой ответа и сравнивает задержку ответа webhook:
+- inline: обработка в запросе webhook (WEBHOOK_ASYNC_PROCESSING=false, прежнее поведение);
+- queued: сохранение события в очередь webhook_events и ответ сразу, обработка воркерами.
+Для режима queued дополнительно выводится время, за которое воркеры обработали все события.
+У правила включено обновление связанных контактов и компании (у каждой сделки CONTACTS_PER_DEAL
+контактов и компания).
+
+Запуск из каталога backend:
+    python -m scripts.loadtest_webhook
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import time as dt_time
+from typing import List, Dict, Any, Tuple
+import re
+from urllib.parse import urlencode, parse_qsl
+
+from aiohttp import web
+
+EVENTS_COUNT = 60
+# В режиме inline каждый запрос держит соединение с базой данных на время запросов к Bitrix24:
+# больше 15 одновременных запросов (пул SQLAlchemy 5 + 10) блокируют event loop ожиданием соединения
+CONCURRENCY = 10
+DEALS_COUNT = 30
+BITRIX_DELAY = 0.15  # Задержка ответа фейкового Bitrix24 (секунды)
+BITRIX_PORT = 18790
+DUTY_USER_IDS = (10, 11)
+CONTACTS_PER_DEAL = 2
+# fast_bitrix24 ограничивает клиента 2 запросами в секунду с запасом 50 запросов:
+# пауза между прогонами восстанавливает запас, чтобы режимы были в равных условиях
+RUN_PAUSE = 25
+
+# Настройки приложения задаются до импорта app
+_tmp_dir = tempfile.mkdtemp(prefix='loadtest_webhook_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'loadtest.db')}"
+os.environ['SCHEDULER_ENABLED'] = 'false'
+os.environ['BITRIX24_WEBHOOK'] = f"http://127.0.0.1:{BITRIX_PORT}/rest/1/loadtest/"
+os.environ['BITRIX24_RATE_LIMIT'] = '200'
+os.environ['BITRIX24_RATE_BURST'] = '200'
+# Фейковый Bitrix24 не отправляет события на запись в сделку: повторные события теста не должны считаться эхом
+os.environ['WEBHOOK_ECHO_TTL_SECONDS'] = '0'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from app.config import settings  # noqa: E402
+from app.database import SessionLocal  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import (  # noqa: E402
+    User, DutySchedule, DutyScheduleUser, UpdateRule, UpdateRuleUser,
+    UpdateHistory, WebhookEvent, WebhookEventStatus
+)
+from app.services.update_service import get_today_msk  # noqa: E402
+from app.services.webhook_queue import get_webhook_queue  # noqa: E402
+
+
+class FakeBitrix:
+    """
+    Фейковый REST API Bitrix24 с задержкой ответа: crm.*.list по ID, crm.*.update, crm.deal.contact.items.get
+    и batch с подстановкой ссылок $result[команда][...] (неразрешенная ссылка заменяется пустой строкой)
+    """
+    
+    REFERENCE = re.compile(r'\$result\[([^\]]+)\]((?:\[[^\]]*\])*)')
+    
+    def __init__(self):
+        self.entities: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self.requests = 0
+        self.reset()
+    
+    def reset(self):
+        self.entities = {'deal': {}, 'contact': {}, 'company': {}}
+        for deal_id in range(1, DEALS_COUNT + 1):
+            contact_ids = [deal_id * 100 + i for i in range(CONTACTS_PER_DEAL)]
+            company_id = deal_id * 1000
+            self.entities['deal'][deal_id] = {
+                'ID': str(deal_id), 'ASSIGNED_BY_ID': '1', 'COMPANY_ID': str(company_id),
+                'CONTACT_ID': str(contact_ids[0]) if contact_ids else None, 'CONTACT_IDS': contact_ids
+            }
+            for contact_id in contact_ids:
+                self.entities['contact'][contact_id] = {'ID': str(contact_id), 'ASSIGNED_BY_ID': '1'}
+            self.entities['company'][company_id] = {'ID': str(company_id), 'ASSIGNED_BY_ID': '1'}
+    
+    @staticmethod
+    def parse_query(query: str) -> Dict[str, Any]:
+        """Разобрать строку параметров команды batch во вложенный словарь (a[b][c]=v)"""
+        params: Dict[str, Any] = {}
+        for key, value in parse_qsl(query, keep_blank_values=True):
+            parts = re.findall(r'[^\[\]]+|\[\]', key)
+            node = params
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = value
+        return params
+    
+    def resolve(self, params: Any, results: Dict[str, Any]) -> Any:
+        """Подставить ссылки $result в значения параметров"""
+        if isinstance(params, dict):
+            return {key: self.resolve(value, results) for key, value in params.items()}
+        if not isinstance(params, str):
+            return params
+        match = self.REFERENCE.fullmatch(params)
+        if not match:
+            return params
+        value = results.get(match.group(1))
+        for part in re.findall(r'\[([^\]]*)\]', match.group(2)):
+            if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+                value = value[int(part)]
+            elif isinstance(value, dict) and part in value:
+                value = value[part]
+            else:
+                return ''
+        return value
+    
+    def execute(self, method: str, params: Dict[str, Any]) -> Any:
+        """Выполнить метод REST API над сущностями фейкового портала"""
+        if method == 'crm.deal.contact.items.get':
+            deal = self.entities['deal'].get(int(params.get('id') or 0))
+            return [{'CONTACT_ID': contact_id} for contact_id in (deal['CONTACT_IDS'] if deal else [])]
+        entity_type, _, action = method[len('crm.'):].partition('.')
+        entities = self.entities.get(entity_type)
+        if entities is None or action not in ('list', 'update'):
+            raise KeyError(method)
+        if action == 'update':
+            entity = entities.get(int(params.get('ID') or 0))
+            if entity:
+                entity['ASSIGNED_BY_ID'] = str(params.get('fields', {}).get('ASSIGNED_BY_ID'))
+            return bool(entity)
+        
+        ids = params.get('filter', {}).get('ID', '')
+        ids = ids.values() if isinstance(ids, dict) else ids if isinstance(ids, list) else [ids]
+        select = params.get('select') or []
+        select = list(select.values()) if isinstance(select, dict) else select
+        rows = []
+        for entity_id in ids:
+            entity = entities.get(int(entity_id)) if str(entity_id).isdigit() else None
+            if entity:
+                rows.append({field: entity.get(field) for field in select} if select else dict(entity))
+        return rows
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        method = request.match_info['method']
+        body = await request.json()
+        await asyncio.sleep(BITRIX_DELAY)
+        
+        try:
+            if method != 'batch':
+                result = self.execute(method, body)
+                return web.json_response({'result': result, 'total': len(result) if isinstance(result, list) else 1, 'time': {'operating': 0}})
+            
+            results = {}
+            errors = {}
+            for key, command in body.get('cmd', {}).items():
+                command_method, _, query = command.partition('?')
+                try:
+                    results[key] = self.execute(command_method, self.resolve(self.parse_query(query), results))
+                except (KeyError, ValueError) as e:
+                    errors[key] = {'error': 'ERROR', 'error_description': str(e)}
+                    if body.get('halt'):
+                        break
+        except KeyError:
+            return web.json_response({'error': 'ERROR_METHOD_NOT_FOUND'}, status=404)
+        return web.json_response({
+            'result': {'result': results, 'result_error': errors, 'result_total': [], 'result_next': [], 'result_time': {}},
+            'time': {'operating': 0}
+        })
+    
+    def start(self):
+        """Запустить сервер в отдельном потоке со своим event loop"""
+        ready = threading.Event()
+        
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            server_app = web.Application()
+            server_app.router.add_post('/rest/1/loadtest/{method}', self.handle)
+            runner = web.AppRunner(server_app)
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', BITRIX_PORT).start())
+            ready.set()
+            loop.run_forever()
+        
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+
+def seed():
+    """Дежурные пользователи на сегодня и правило для сделок с ответственными не из графика"""
+    db = SessionLocal()
+    try:
+        for user_id in (1,) + DUTY_USER_IDS:
+            db.add(User(id=user_id, name=f"User{user_id}", last_name='Test', email=f"user{user_id}@example.com"))
+        schedule = DutySchedule(date=get_today_msk())
+        db.add(schedule)
+        db.flush()
+        rule = UpdateRule(
+            entity_type='deal',
+            entity_name='Сделки',
+            rule_type='assigned_by_condition',
+            condition_config='{"operator": "not_in", "user_ids": [10, 11]}',
+            update_time=dt_time(9, 0),
+            update_related_contacts_companies=True
+        )
+        db.add(rule)
+        db.flush()
+        for user_id in DUTY_USER_IDS:
+            db.add(DutyScheduleUser(duty_schedule_id=schedule.id, user_id=user_id))
+            db.add(UpdateRuleUser(update_rule_id=rule.id, user_id=user_id))
+        db.commit()
+    finally:
+        db.close()
+
+
+def reset_state(bitrix: FakeBitrix):
+    """Вернуть сделки и базу данных в исходное состояние перед прогоном"""
+    bitrix.reset()
+    db = SessionLocal()
+    try:
+        db.query(UpdateHistory).delete()
+        db.query(WebhookEvent).delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+async def post_webhook(deal_id: int) -> Tuple[int, float]:
+    """Отправить событие OnCrmDealUpdate в приложение и вернуть (HTTP статус, время ответа)"""
+    body = urlencode({
+        'event': 'ONCRMDEALUPDATE',
+        'document_id[0]': 'crm',
+        'document_id[1]': 'CCrmDocumentDeal',
+        'document_id[2]': f"DEAL_{deal_id}",
+    }).encode()
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': '/api/webhook/bitrix',
+        'raw_path': b'/api/webhook/bitrix',
+        'query_string': b'',
+        'root_path': '',
+        'headers': [
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+        'client': ('127.0.0.1', 50000),
+        'server': ('127.0.0.1', 8000),
+    }
+    received = False
+    response = {}
+    
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await asyncio.Future()
+    
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+    
+    started = time.perf_counter()
+    await app(scope, receive, send)
+    return response.get('status'), time.perf_counter() - started
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def wait_queue_drained(timeout: float = 300.0) -> float:
+    """Дождаться обработки всех событий очереди и вернуть время ожидания"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        db = SessionLocal()
+        try:
+            pending = db.query(WebhookEvent).filter(
+                WebhookEvent.status.in_([WebhookEventStatus.PENDING, WebhookEventStatus.PROCESSING])
+            ).count()
+        finally:
+            db.close()
+        if not pending:
+            break
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def run_load(name: str, async_processing: bool, bitrix: FakeBitrix):
+    """Отправить EVENTS_COUNT событий по CONCURRENCY одновременно и вывести задержки ответа"""
+    reset_state(bitrix)
+    settings.webhook_async_processing = async_processing
+    requests_before = bitrix.requests
+    deal_ids = [1 + i % DEALS_COUNT for i in range(EVENTS_COUNT)]
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    
+    async def send_one(deal_id: int) -> Tuple[int, float]:
+        async with semaphore:
+            return await post_webhook(deal_id)
+    
+    started = time.perf_counter()
+    results = await asyncio.gather(*(send_one(deal_id) for deal_id in deal_ids))
+    elapsed = time.perf_counter() - started
+    drained = await wait_queue_drained() if async_processing else 0.0
+    
+    latencies = [latency * 1000 for status, latency in results]
+    errors = sum(1 for status, latency in results if status != 200)
+    updated = sum(1 for deal in bitrix.entities['deal'].values() if deal['ASSIGNED_BY_ID'] in {str(u) for u in DUTY_USER_IDS})
+    print(
+        f"{name}: {EVENTS_COUNT} событий за {elapsed:.2f} с, ответ webhook "
+        f"p50 {percentile(latencies, 50):.1f} мс, p95 {percentile(latencies, 95):.1f} мс, "
+        f"p99 {percentile(latencies, 99):.1f} мс, max {max(latencies):.1f} мс, ошибок HTTP {errors}"
+    )
+    related = [
+        entity for entity_type in ('contact', 'company') for entity in bitrix.entities[entity_type].values()
+    ]
+    related_updated = sum(1 for entity in related if entity['ASSIGNED_BY_ID'] in {str(u) for u in DUTY_USER_IDS})
+    print(
+        f"{name}: обработка завершена через {elapsed + drained:.2f} с, сделок обновлено "
+        f"{updated} из {DEALS_COUNT}, контактов и компаний {related_updated} из {len(related)}, "
+        f"запросов к Bitrix24 {bitrix.requests - requests_before}"
+    )
+
+
+async def main():
+    logging.getLogger('fast_bitrix24').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    bitrix = FakeBitrix()
+    bitrix.start()
+    seed()
+    print(
+        f"Событий {EVENTS_COUNT}, одновременно {CONCURRENCY}, сделок {DEALS_COUNT}, "
+        f"задержка Bitrix24 {BITRIX_DELAY * 1000:.0f} мс, воркеров очереди {settings.webhook_workers}"
+    )
+    
+    queue = get_webhook_queue()
+    await queue.start()
+    try:
+        await run_load('inline', False, bitrix)
+        await asyncio.sleep(RUN_PAUSE)
+        await run_load('queued', True, bitrix)
+    finally:
+        await queue.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())